@@ -1,6 +1,7 @@
 import os
 import sys
 import emcee
+import _pickle as pickle
 import numpy as np
 import scipy as sp
 import pandas as pd
@@ -16,25 +17,115 @@ from pymc3.plots import utils, artists
 
 # SAMPLING
 
+class BatchPool:
+    """
+    Pool for the emcee samplers that scores all the walkers proposed in a half-step with a single call of a batched
+    function, (B x ndim) -> B, instead of evaluating them one by one. With logp_batch it serves an EnsembleSampler,
+    and with loglike_batch and logprior_batch a PTSampler (as its PTLikePrior, the log likelihood of the points
+    out of the support of the prior is -inf and it is not evaluated).
+
+    With processes > 1, a pool of forked workers, which inherit the batched functions, is created once and each
+    batch is split among them until close.
+    """
+    def __init__(self, logp_batch=None, loglike_batch=None, logprior_batch=None, processes=None):
+        global _batch_pool_functions
+        self.logp_batch = logp_batch
+        self.loglike_batch = loglike_batch
+        self.logprior_batch = logprior_batch
+        self.processes = processes
+        self.pool = None
+        if processes is not None and processes > 1:
+            _batch_pool_functions = (logp_batch, loglike_batch, logprior_batch)
+            self.pool = mp.get_context('fork').Pool(processes)
+
+    def map(self, f, points):
+        points = np.array(list(points))
+        if self.pool is None or len(points) < 2 * self.processes:
+            r = _batch_pool_score(points, self.logp_batch, self.loglike_batch, self.logprior_batch)
+        else:
+            parts = self.pool.map(_batch_pool_call, np.array_split(points, self.processes))
+            r = np.concatenate(parts)
+        if self.logp_batch is not None:
+            return list(r)
+        return [tuple(v) for v in r]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+# batched functions of the last BatchPool with processes, inherited by its forked workers
+_batch_pool_functions = None
+
+
+def _batch_pool_call(points):
+    return _batch_pool_score(points, *_batch_pool_functions)
+
+
+def _batch_pool_score(points, logp_batch, loglike_batch, logprior_batch):
+    if logp_batch is not None:
+        return np.asarray(logp_batch(points))
+    logprior = np.asarray(logprior_batch(points), dtype=np.float64)
+    loglike = np.full(len(points), -np.inf)
+    support = np.isfinite(logprior)
+    if np.any(support):
+        loglike[support] = loglike_batch(points[support])
+    return np.stack([loglike, logprior], axis=1)
+
+
 #@jit
 def mcmc_ensemble(ndim, samples=1000, chains=None, ntemps=None, start=None, logp=None, loglike=None, logprior=None,
-                  args=[], kwargs={}, noise_mult=0.1, noise_sum=0.01, live_dangerously=False, threads=1):
+                  args=[], kwargs={}, noise_mult=0.1, noise_sum=0.01, live_dangerously=False, threads=1,
+                  logp_batch=None, loglike_batch=None, logprior_batch=None, checkpoint=None, checkpoint_every=100,
+                  monitor_every=None, ess_min=None, rhat_tol=None, callback=None, rhat_method='multi-sum',
+                  adapt_temps=None, return_stats=False):
+    """
+    Ensemble (or parallel tempering) MCMC with emcee. If the batched functions are given, (B x ndim) -> B, all the
+    walkers of a half-step are scored with one call through a BatchPool (vectorized mode), split among threads
+    persistent forked processes.
 
+    If checkpoint (a directory) is given, the chains are appended there in blocks of checkpoint_every iterations
+    together with the state of the sampler, and an interrupted run with the same shape resumes where it stopped.
+
+    If monitor_every is given, the R-hat, the multivariate ESS and the acceptance fraction of the chains sampled so
+    far are computed every monitor_every iterations (see convergence_stats) and passed to callback (or printed).
+    The sampling stops early once the ESS reaches ess_min and the R-hat falls below rhat_tol (those given).
+
+    If adapt_temps is given (with ntemps), the temperature ladder is first tuned during adapt_temps discarded
+    iterations towards uniform swap acceptance between neighbouring temperatures (see adapt_ladder), and then kept
+    fixed while sampling. If return_stats, the statistics of the run are also returned: for parallel tempering, the
+    ladder, the swap acceptance of each pair of temperatures and the thermodynamic integration log evidence.
+    """
     if chains is None:
         chains = 2 * ndim
     if threads is 'auto':
         threads = mp.cpu_count() // 2
+    pool = None
+    if logp_batch is not None or (loglike_batch is not None and logprior_batch is not None):
+        pool = BatchPool(logp_batch, loglike_batch, logprior_batch,
+                         processes=threads if type(threads) is int and threads > 1 else None)
+    state = None
+    if checkpoint is not None:
+        state = load_checkpoint(checkpoint, ndim, chains, ntemps)
 
     if ntemps is None:
-        sampler = emcee.EnsembleSampler(chains, ndim, logp, args=args, kwargs=kwargs, live_dangerously=live_dangerously, threads=threads)
-        if start.shape == (chains, ndim):
+        sampler = emcee.EnsembleSampler(chains, ndim, logp, args=args, kwargs=kwargs, live_dangerously=live_dangerously,
+                                        threads=threads, pool=pool)
+        if state is not None:
+            p0 = state['p']
+        elif start.shape == (chains, ndim):
             p0 = start
         else:
             noise = np.random.normal(loc=1, scale=noise_mult, size=(chains, ndim))
             p0 = noise * np.ones((chains, 1)) * start
     else:
-        sampler = emcee.PTSampler(ntemps, chains, ndim, loglike, logprior, threads=threads)
-        if start.shape == (ntemps, chains, ndim):
+        sampler = emcee.PTSampler(ntemps, chains, ndim, loglike, logprior, threads=threads, pool=pool,
+                                  betas=None if state is None else state['betas'])
+        if state is not None:
+            p0 = state['p']
+        elif start.shape == (ntemps, chains, ndim):
             p0 = start
         elif start.shape == (chains, ndim):
             noise = np.random.normal(loc=1, scale=noise_mult, size=(ntemps, chains, ndim))
@@ -42,18 +133,540 @@ def mcmc_ensemble(ndim, samples=1000, chains=None, ntemps=None, start=None, logp
         else:
             noise = np.random.normal(loc=1, scale=noise_mult, size=(ntemps, chains, ndim))
             p0 = noise * np.ones((ntemps, chains, 1)) * start
-    p0 += (p0 == 0) * np.random.normal(loc=0, scale=noise_sum, size=p0.shape)
+    done, resume, converged = 0, {}, False
+    if state is None:
+        p0 += (p0 == 0) * np.random.normal(loc=0, scale=noise_sum, size=p0.shape)
+    else:
+        done = state['iterations']
+        converged = state.get('converged', False)
+        if ntemps is None:
+            sampler.random_state = state['random_state']
+            resume['lnprob0'] = state['lnprob']
+        else:
+            # the PTSampler draws from the global numpy generator
+            np.random.set_state(state['random_state'])
+        print('Resuming from {} at iteration {}'.format(checkpoint, done))
+    if ntemps is not None and adapt_temps and state is None:
+        p0, resume['lnprob0'], resume['lnlike0'] = adapt_ladder(sampler, p0, adapt_temps)
+        sampler.reset()
     print('Sampling {} variables, {} chains, {} times ({} temps)'.format(ndim, chains, samples, ntemps))
     sys.stdout.flush()
-    for result in tqdm(sampler.sample(p0, iterations=samples), total=samples):
-        pass
-    lnprob, echain = sampler.lnprobability, sampler.chain
+    written, current = 0, 0
+    if done < samples and not converged:
+        monitor = monitor_every is not None and (ess_min is not None or rhat_tol is not None or callback is not None)
+        progress = tqdm(sampler.sample(p0, iterations=samples - done, **resume), total=samples, initial=done)
+        for current, result in enumerate(progress, 1):
+            if monitor and current % monitor_every == 0:
+                stats = convergence_stats(sampler, current, method=rhat_method)
+                stats['iteration'] = done + current
+                if callback is not None:
+                    callback(stats)
+                else:
+                    progress.write('Iteration {iteration}: R-hat {rhat:.4f}, ESS {ess:.0f}, '
+                                   'acceptance {acceptance:.3f}'.format(**stats))
+                converged = (ess_min is None or stats['ess'] >= ess_min) and \
+                            (rhat_tol is None or stats['rhat'] <= rhat_tol) and \
+                            (ess_min is not None or rhat_tol is not None)
+            if checkpoint is not None and (current % checkpoint_every == 0 or done + current == samples or converged):
+                written = save_checkpoint(checkpoint, sampler, result[0], result[1], done, written, current,
+                                          converged=converged)
+            if converged:
+                progress.close()
+                print('Converged at iteration {}'.format(done + current))
+                break
+    if checkpoint is not None:
+        lnprob, echain = load_checkpoint_chains(checkpoint, samples)
+    else:
+        lnprob, echain = sampler.lnprobability, sampler.chain
+        if ntemps is not None:
+            lnprob, echain = lnprob[0, :, :], echain[0, :, :]
+        # emcee allocates the whole run, so the iterations after an early stop are dropped
+        lnprob, echain = lnprob[:, :current], echain[:, :current, :]
+    stats = {'acceptance': np.mean(sampler.acceptance_fraction) if current > 0 else None}
+    if ntemps is not None and current > 0:
+        stats.update(tempering_stats(sampler, current))
+        print('Swap acceptance between temperatures: ' +
+              ', '.join('{:.3f}'.format(a) for a in stats['swap_acceptance']))
+        print('Thermodynamic integration log evidence: {:.4f} +- {:.4f}'.format(stats['log_evidence'],
+                                                                                 stats['log_evidence_error']))
     sampler.reset()
-    if ntemps is not None:
-        lnprob, echain = lnprob[0, :, :], echain[0, :, :]
+    if pool is not None:
+        pool.close()
+    if return_stats:
+        return lnprob, echain, stats
+    return lnprob, echain
+
+
+def adapt_ladder(sampler, p0, iterations, every=1, lag=7, nu=1):
+    """
+    Tunes the temperatures of a PTSampler (Vousden, Farr & Mandel, 2016): every few iterations, the log gaps
+    between neighbouring temperatures grow where their swap acceptance is above the one of the next pair and
+    shrink where it is below, with a gain per iteration decaying as lag / (t + lag) / nu. The hottest and coldest
+    temperatures are fixed. The iterations are not stored.
+    The gain is applied at every iteration, and decays within the first tens of them: the ladder must move far from
+    the default one of emcee in a short adaptation, while with a few walkers per temperature the acceptance of an
+    iteration is noisy, and a late gain makes the ladder follow that noise (updates every 5 iterations, with a gain
+    decaying as 100 / (t + 100) / 2, left swap acceptances as uneven as 0.06, 0.56, 0.27 on the posterior of a GP).
+    :return: the positions, the tempered log p and the log likelihood at the end, for the ladder tuned
+    """
+    p, lnprob, logl = p0, None, None
+    for t in tqdm(range(0, iterations, every), desc='Adapting temperatures'):
+        nswap, naccepted = np.copy(sampler.nswap), np.copy(sampler.nswap_accepted)
+        for p, lnprob, logl in sampler.sample(p, lnprob0=lnprob, lnlike0=logl, iterations=min(every, iterations - t),
+                                              storechain=False):
+            pass
+        ratios = _pair_counts(sampler.nswap_accepted - naccepted) / np.maximum(_pair_counts(sampler.nswap - nswap), 1)
+        betas = np.copy(sampler.betas)
+        kappa = every * lag / (t + every + lag) / nu
+        gaps = np.diff(1 / betas[:-1]) * np.exp(kappa * (ratios[:-1] - ratios[1:]))
+        betas[1:-1] = 1 / (np.cumsum(gaps) + 1 / betas[0])
+        # the log p of the positions at the new temperatures
+        lnprob = lnprob + (betas - sampler.betas)[:, None] * logl
+        # PTSampler.betas is a read-only property over _betas, which sample reads at every iteration
+        sampler._betas = betas
+    print('Adapted temperatures: ' + ', '.join('{:.4g}'.format(1 / b) for b in sampler.betas))
+    return p, lnprob, logl
+
+
+def _pair_counts(counts):
+    """Counts of each pair of neighbouring temperatures from the counts of each temperature, which are the sums
+    of the counts of its pairs with the colder and the hotter one"""
+    pairs = np.zeros(len(counts) - 1)
+    for i in range(len(pairs)):
+        pairs[i] = counts[i] - (pairs[i - 1] if i > 0 else 0)
+    return pairs
+
+
+def tempering_stats(sampler, iterations, burnin=0.1):
+    """
+    Statistics of the first iterations of a PTSampler: its ladder (betas), the swap acceptance of each pair of
+    neighbouring temperatures, and the thermodynamic integration estimate of the log evidence, integrating the
+    mean log likelihood of each temperature (discarded the burnin fraction) over the betas, and its error as the
+    difference with the integral over every other temperature.
+    """
+    logls = sampler.lnlikelihood[:, :, int(burnin * iterations):iterations]
+    mean = np.mean(logls, axis=(1, 2))
+
+    def integrate(betas, mean):
+        # trapezoidal rule down to beta = 0, where the mean log likelihood is taken as the one of the hottest
+        betas, mean = np.concatenate([betas, [0]]), np.concatenate([mean, mean[-1:]])
+        return -np.sum((mean[1:] + mean[:-1]) / 2 * np.diff(betas))
+
+    log_evidence = integrate(sampler.betas, mean)
+    log_evidence_coarse = integrate(sampler.betas[::2], mean[::2])
+    swaps = _pair_counts(sampler.nswap_accepted) / np.maximum(_pair_counts(sampler.nswap), 1)
+    return {'betas': np.copy(sampler.betas), 'swap_acceptance': swaps, 'log_evidence': log_evidence,
+            'log_evidence_error': np.abs(log_evidence - log_evidence_coarse)}
+
+
+def save_checkpoint(path, sampler, position, lnprob, done, written, current, converged=False):
+    """
+    Appends the iterations [written, current) of the running sampler, started at iteration done, as a block in
+    path, and then replaces its state (positions, log p, random state, temperature ladder and whether the run
+    stopped because it converged).
+    :return: the number of iterations of the running sampler already written
+    """
+    os.makedirs(path, exist_ok=True)
+    ll, chain = sampler.lnprobability, sampler.chain
+    if len(chain.shape) == 4:
+        ll, chain = ll[0], chain[0]
+    np.savez(os.path.join(path, 'block_{:09d}.npz'.format(done + written)), lnprob=ll[:, written:current],
+             chain=chain[:, written:current, :])
+    random_state = np.random.get_state() if isinstance(sampler, emcee.PTSampler) else sampler.random_state
+    state = {'iterations': done + current, 'p': position, 'lnprob': lnprob, 'random_state': random_state,
+             'betas': getattr(sampler, 'betas', None), 'shape': position.shape, 'converged': converged}
+    with open(os.path.join(path, 'state.pkl.tmp'), 'wb') as f:
+        pickle.dump(state, f, protocol=-1)
+    os.replace(os.path.join(path, 'state.pkl.tmp'), os.path.join(path, 'state.pkl'))
+    return current
+
+
+def load_checkpoint_state(path):
+    with open(os.path.join(path, 'state.pkl'), 'rb') as f:
+        return pickle.load(f)
+
+
+def load_checkpoint(path, ndim, chains, ntemps=None):
+    """
+    :return: the state of the sampler checkpointed in path, or None if there is not one with the same shape
+    """
+    try:
+        state = load_checkpoint_state(path)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+    if state['shape'] != ((chains, ndim) if ntemps is None else (ntemps, chains, ndim)):
+        print('Ignoring the checkpoint {} with shape {}'.format(path, state['shape']))
+        return None
+    return state
+
+
+def load_checkpoint_chains(path, samples=None):
+    """
+    :return: the log p and the chains (of the lowest temperature) of the blocks checkpointed in path, up to the
+    last saved state (or samples)
+    """
+    state = load_checkpoint_state(path)
+    stop = state['iterations'] if samples is None else min(samples, state['iterations'])
+    blocks = sorted(f for f in os.listdir(path) if f.startswith('block_') and f.endswith('.npz'))
+    blocks = [np.load(os.path.join(path, f)) for f in blocks if int(f[6:-4]) < stop]
+    lnprob = np.concatenate([b['lnprob'] for b in blocks], axis=1)[:, :stop]
+    echain = np.concatenate([b['chain'] for b in blocks], axis=1)[:, :stop, :]
     return lnprob, echain
 
 
+# logp_dlogp of the chains of mcmc_nuts, inherited by its forked workers
+_nuts_logp_dlogp = None
+
+
+def mcmc_nuts(ndim, samples=1000, chains=None, start=None, logp_dlogp=None, warmup=None, target_accept=0.8,
+              max_depth=10, mass='diag', noise_mult=0.1, noise_sum=0.01, processes=None):
+    """
+    No-U-Turn Sampler (Hoffman & Gelman, 2014) with a dual-averaging step size and a diagonal or dense mass matrix
+    estimated at the middle of the warmup. logp_dlogp(x) returns the log p and its gradient in one call.
+    Args:
+        ndim (int): the number of dimensions
+        samples (int): the number of samples of each chain after the warmup
+        chains (int): the number of chains, 4 by default
+        start (numpy.ndarray): the start of all chains (ndim), perturbed with noise_mult and noise_sum, or one for
+            each chain (chains x ndim)
+        logp_dlogp (callable): the log p and its gradient
+        warmup (int): the number of adaptation iterations, discarded (samples by default)
+        target_accept (float): the target mean acceptance probability of the step size
+        max_depth (int): the maximum depth of the trees (2^max_depth leapfrog steps)
+        mass (str): 'diag' or 'dense' mass matrix, or None for the identity
+        processes (int): the number of forked processes among which the chains are split
+    Returns:
+        The log p (chains x samples) and the chains (chains x samples x ndim), as mcmc_ensemble.
+    """
+    global _nuts_logp_dlogp
+    if chains is None:
+        chains = 4
+    if warmup is None:
+        warmup = samples
+    if start.shape == (chains, ndim):
+        p0 = np.array(start, dtype=np.float64)
+    else:
+        p0 = np.random.normal(loc=1, scale=noise_mult, size=(chains, ndim)) * np.ones((chains, 1)) * start
+        p0 += (p0 == 0) * np.random.normal(loc=0, scale=noise_sum, size=p0.shape)
+    seeds = np.random.randint(2 ** 31 - 1, size=chains)
+    jobs = [(x0, seed, samples, warmup, target_accept, max_depth, mass) for x0, seed in zip(p0, seeds)]
+    print('Sampling {} variables, {} chains, {} times ({} warmup) with NUTS'.format(ndim, chains, samples, warmup))
+    sys.stdout.flush()
+    _nuts_logp_dlogp = logp_dlogp
+    if processes in [None, 0, 1]:
+        results = [_nuts_job(job) for job in tqdm(jobs)]
+    else:
+        with mp.get_context('fork').Pool(processes) as pool:
+            results = pool.map(_nuts_job, jobs)
+    for k, (_, _, stats) in enumerate(results):
+        print('Chain {}: step {step:.4g}, acceptance {acceptance:.3f}, depth {depth:.1f}, '
+              '{divergences} divergences'.format(k, **stats))
+    return np.array([ll for ll, _, _ in results]), np.array([chain for _, chain, _ in results])
+
+
+def _nuts_job(job):
+    x0, seed, samples, warmup, target_accept, max_depth, mass = job
+    return nuts_chain(_nuts_logp_dlogp, x0, samples=samples, warmup=warmup, target_accept=target_accept,
+                      max_depth=max_depth, mass=mass, random=np.random.RandomState(seed))
+
+
+def nuts_chain(logp_dlogp, x0, samples=1000, warmup=1000, target_accept=0.8, max_depth=10, mass='diag',
+               random=np.random):
+    """
+    One chain of the No-U-Turn Sampler (Algorithm 6 of Hoffman & Gelman, 2014) from x0. The first warmup iterations
+    adapt the step size by dual averaging, and at their middle the mass matrix is set to the (regularized)
+    covariance of their second quarter and the step size is adapted again.
+    :return: the log p (samples), the chain (samples x ndim) and the statistics of the sampling
+    """
+    def target(x):
+        # an error of the model (e.g. a failed decomposition) is an invalid point, so it becomes a divergence
+        try:
+            logp, dlogp = logp_dlogp(x)
+        except Exception:
+            return -np.inf, np.zeros_like(x)
+        logp = np.float64(logp)
+        if not np.isfinite(logp):
+            return -np.inf, np.zeros_like(x)
+        return logp, np.asarray(dlogp, dtype=np.float64)
+
+    ndim = len(x0)
+    metric = _NUTSMetric(np.ones(ndim))
+    x = np.array(x0, dtype=np.float64)
+    logp, grad = target(x)
+    eps = _nuts_initial_step(target, x, logp, grad, metric, random)
+    adapt = _DualAveraging(eps, target_accept)
+    window = warmup // 2 if warmup >= 20 and mass is not None else None
+
+    lnprob, chain = np.empty(samples), np.empty((samples, ndim))
+    history = []
+    stats = {'acceptance': 0.0, 'depth': 0.0, 'divergences': 0}
+    for m in range(warmup + samples):
+        r0 = metric.momentum(random)
+        H0 = logp - metric.kinetic(r0)
+        logu = H0 + np.log(random.uniform())
+        xm, rm, gm, xp, rp, gp = x, r0, grad, x, r0, grad
+        depth, n, s, alpha, n_alpha = 0, 1, True, 0.0, 0
+        divergent = False
+        while s and depth < max_depth:
+            v = 1 if random.uniform() < 0.5 else -1
+            if v == -1:
+                xm, rm, gm, _, _, _, x1, logp1, grad1, n1, s1, a1, na1, d1 = \
+                    _nuts_tree(target, xm, rm, gm, logu, v, depth, eps, H0, metric, random)
+            else:
+                _, _, _, xp, rp, gp, x1, logp1, grad1, n1, s1, a1, na1, d1 = \
+                    _nuts_tree(target, xp, rp, gp, logu, v, depth, eps, H0, metric, random)
+            if s1 and random.uniform() < n1 / n:
+                x, logp, grad = x1, logp1, grad1
+            n += n1
+            alpha, n_alpha = alpha + a1, n_alpha + na1
+            divergent |= d1
+            s = s1 and metric.no_uturn(xp - xm, rm, rp)
+            depth += 1
+        accept = alpha / max(n_alpha, 1)
+
+        if m < warmup:
+            eps = adapt.update(accept)
+            if window is not None and window // 2 <= m:
+                history.append(x)
+            if m + 1 == window:
+                metric = _NUTSMetric(_nuts_mass(np.array(history), mass))
+                eps = _nuts_initial_step(target, x, logp, grad, metric, random)
+                adapt = _DualAveraging(eps, target_accept)
+            elif m + 1 == warmup:
+                eps = adapt.final()
+        else:
+            lnprob[m - warmup], chain[m - warmup] = logp, x
+            stats['acceptance'] += accept / samples
+            stats['depth'] += depth / samples
+            stats['divergences'] += int(divergent)
+    stats['step'] = eps
+    return lnprob, chain, stats
+
+
+def _nuts_tree(target, x, r, grad, logu, v, depth, eps, H0, metric, random, delta_max=1000.0):
+    """
+    Builds a tree of 2^depth leapfrog steps in the direction v.
+    :return: the leftmost and rightmost states, the proposal, its log p and gradient, the number of valid states,
+    whether the tree can keep growing, the sum and number of acceptance probabilities and whether it diverged
+    """
+    if depth == 0:
+        x1, r1, logp1, grad1 = metric.leapfrog(target, x, r, grad, v * eps)
+        H1 = logp1 - metric.kinetic(r1)
+        if not np.isfinite(H1):
+            H1 = -np.inf
+        s1 = logu < H1 + delta_max
+        alpha = min(1.0, np.exp(H1 - H0)) if np.isfinite(H1) else 0.0
+        return x1, r1, grad1, x1, r1, grad1, x1, logp1, grad1, int(logu <= H1), s1, alpha, 1, not s1
+    xm, rm, gm, xp, rp, gp, x1, logp1, grad1, n1, s1, a1, na1, d1 = \
+        _nuts_tree(target, x, r, grad, logu, v, depth - 1, eps, H0, metric, random, delta_max)
+    if s1:
+        if v == -1:
+            xm, rm, gm, _, _, _, x2, logp2, grad2, n2, s2, a2, na2, d2 = \
+                _nuts_tree(target, xm, rm, gm, logu, v, depth - 1, eps, H0, metric, random, delta_max)
+        else:
+            _, _, _, xp, rp, gp, x2, logp2, grad2, n2, s2, a2, na2, d2 = \
+                _nuts_tree(target, xp, rp, gp, logu, v, depth - 1, eps, H0, metric, random, delta_max)
+        if n1 + n2 > 0 and random.uniform() < n2 / (n1 + n2):
+            x1, logp1, grad1 = x2, logp2, grad2
+        a1, na1, n1, d1 = a1 + a2, na1 + na2, n1 + n2, d1 or d2
+        s1 = s2 and metric.no_uturn(xp - xm, rm, rp)
+    return xm, rm, gm, xp, rp, gp, x1, logp1, grad1, n1, s1, a1, na1, d1
+
+
+def _nuts_initial_step(target, x, logp, grad, metric, random):
+    """Heuristic for a reasonable first step size, where the acceptance probability of one leapfrog crosses 0.5"""
+    r = metric.momentum(random)
+    H0 = logp - metric.kinetic(r)
+
+    def log_ratio(eps):
+        _, r1, logp1, _ = metric.leapfrog(target, x, r, grad, eps)
+        ratio = logp1 - metric.kinetic(r1) - H0
+        return ratio if np.isfinite(ratio) else -np.inf
+
+    eps = 1.0
+    ratio = log_ratio(eps)
+    a = 1 if ratio > np.log(0.5) else -1
+    for _ in range(100):
+        if not a * ratio > -a * np.log(2):
+            break
+        eps *= 2.0 ** a
+        ratio = log_ratio(eps)
+    return eps
+
+
+def _nuts_mass(history, mass):
+    """Inverse mass matrix from the warmup samples, shrunk to the identity as in Stan"""
+    n = len(history)
+    if mass == 'dense':
+        cov = np.atleast_2d(np.cov(history.T))
+        return (n / (n + 5.0)) * cov + 1e-3 * (5.0 / (n + 5.0)) * np.eye(len(cov))
+    return (n / (n + 5.0)) * np.var(history, axis=0) + 1e-3 * (5.0 / (n + 5.0))
+
+
+class _NUTSMetric:
+    """Euclidean metric of the Hamiltonian with a diagonal (vector) or dense (matrix) inverse mass matrix"""
+    def __init__(self, inv_mass):
+        self.inv_mass = inv_mass
+        if len(inv_mass.shape) == 1:
+            self.chol_mass = 1.0 / np.sqrt(inv_mass)
+        else:
+            self.chol_mass = np.linalg.cholesky(np.linalg.inv(inv_mass))
+
+    def velocity(self, r):
+        if len(self.inv_mass.shape) == 1:
+            return self.inv_mass * r
+        return self.inv_mass.dot(r)
+
+    def kinetic(self, r):
+        return 0.5 * r.dot(self.velocity(r))
+
+    def momentum(self, random):
+        z = random.normal(size=len(self.inv_mass))
+        if len(self.inv_mass.shape) == 1:
+            return self.chol_mass * z
+        return self.chol_mass.dot(z)
+
+    def leapfrog(self, target, x, r, grad, eps):
+        r = r + 0.5 * eps * grad
+        x = x + eps * self.velocity(r)
+        logp, grad = target(x)
+        r = r + 0.5 * eps * grad
+        return x, r, logp, grad
+
+    def no_uturn(self, dx, rm, rp):
+        return dx.dot(self.velocity(rm)) >= 0 and dx.dot(self.velocity(rp)) >= 0
+
+
+class _DualAveraging:
+    """Dual-averaging adaptation of the step size towards a target mean acceptance probability"""
+    def __init__(self, eps, target, gamma=0.05, t0=10.0, kappa=0.75):
+        self.mu = np.log(10 * eps)
+        self.target = target
+        self.gamma, self.t0, self.kappa = gamma, t0, kappa
+        self.m, self.h, self.log_eps_bar = 0, 0.0, 0.0
+
+    def update(self, accept):
+        self.m += 1
+        w = 1.0 / (self.m + self.t0)
+        self.h = (1 - w) * self.h + w * (self.target - accept)
+        log_eps = self.mu - np.sqrt(self.m) / self.gamma * self.h
+        w = self.m ** -self.kappa
+        self.log_eps_bar = w * log_eps + (1 - w) * self.log_eps_bar
+        return np.exp(log_eps)
+
+    def final(self):
+        return np.exp(self.log_eps_bar)
+
+
+def mcmc_smc(ndim, particles=1000, start=None, loglike_batch=None, logprior_batch=None, reference='gaussian',
+             ess=0.5, max_steps=25, noise_mult=0.1, noise_sum=0.01):
+    """
+    Sequential Monte Carlo with adaptive tempering. The particles move from a reference distribution r to the
+    posterior through log p_b = log r + b (logprior + loglike - log r), each temperature b chosen by bisection so
+    the effective sample size of the incremental weights is ess * particles. After each reweighting the particles
+    are resampled and rejuvenated by random walk Metropolis steps, proposed and scored for all of them at once
+    with the batched functions, (B x ndim) -> B.
+    Args:
+        ndim (int): the number of dimensions
+        particles (int): the number of particles
+        start (numpy.ndarray): the center of the initial particles (ndim), or the initial particles (B x ndim)
+        loglike_batch (callable): the batched log likelihood
+        logprior_batch (callable): the batched log prior
+        reference (str): 'prior' if the initial particles given in start are draws of the prior (r is the prior and
+            the tempering is of the likelihood), or 'gaussian' for a Gaussian r fitted to the initial particles
+        ess (float): the fraction of effective sample size kept by each step of temperature
+        max_steps (int): the maximum number of Metropolis steps of each rejuvenation
+    Returns:
+        The log p (B) and the particles (B x ndim) at the posterior, the estimate of the log marginal likelihood
+        and the statistics of each stage (temperature, acceptance and steps).
+    """
+    if len(start.shape) == 2:
+        x = np.array(start, dtype=np.float64)
+    else:
+        x = np.random.normal(loc=1, scale=noise_mult, size=(particles, ndim)) * np.ones((particles, 1)) * start
+        x += (x == 0) * np.random.normal(loc=0, scale=noise_sum, size=x.shape)
+    particles = len(x)
+
+    if reference == 'prior':
+        logref = lambda y, prior: prior
+    elif reference == 'gaussian':
+        mean = np.mean(x, axis=0)
+        cov = np.atleast_2d(np.cov(x.T)) + 1e-8 * np.eye(ndim)
+        chol = np.linalg.cholesky(cov)
+        norm = -0.5 * ndim * np.log(2 * np.pi) - np.sum(np.log(np.diag(chol)))
+        logref = lambda y, prior: norm - 0.5 * np.sum(np.linalg.solve(chol, (y - mean).T) ** 2, axis=0)
+    else:
+        raise ValueError('reference must be prior or gaussian: ' + str(reference))
+
+    def evaluate(y):
+        prior = np.asarray(logprior_batch(y), dtype=np.float64)
+        like = np.asarray(loglike_batch(y), dtype=np.float64)
+        delta = prior + like - logref(y, prior)
+        return np.where(np.isfinite(delta), delta, -np.inf), prior + like
+
+    delta, lnprob = evaluate(x)
+    beta, logz, scale = 0.0, 0.0, 2.38 / np.sqrt(ndim)
+    stats = []
+    print('Sampling {} variables, {} particles with SMC'.format(ndim, particles))
+    sys.stdout.flush()
+    while beta < 1:
+        step = _smc_step(delta, ess * particles, 1 - beta)
+        beta = min(1.0, beta + step)
+        logw = step * delta
+        w = np.exp(logw - np.max(logw))
+        logz += np.max(logw) + np.log(np.mean(w))
+        index = _systematic_resample(w / np.sum(w))
+        x, delta, lnprob = x[index], delta[index], lnprob[index]
+
+        # random walk Metropolis over the tempered target, as many steps as needed to move most particles
+        proposal = np.linalg.cholesky(np.atleast_2d(np.cov(x.T)) + 1e-8 * np.eye(ndim))
+        logp = lnprob - (1 - beta) * delta
+        steps, acceptance, accepted = 0, 0.0, np.zeros(particles, dtype=bool)
+        while steps < max_steps:
+            y = x + scale * np.random.randn(particles, ndim).dot(proposal.T)
+            delta_y, lnprob_y = evaluate(y)
+            logp_y = lnprob_y - (1 - beta) * delta_y
+            accept = np.log(np.random.uniform(size=particles)) < np.where(np.isfinite(logp_y), logp_y - logp, -np.inf)
+            x[accept], delta[accept], lnprob[accept], logp[accept] = y[accept], delta_y[accept], lnprob_y[accept], \
+                                                                     logp_y[accept]
+            accepted |= accept
+            acceptance += (np.mean(accept) - acceptance) / (steps + 1)
+            steps += 1
+            if steps >= max(2, np.ceil(np.log(0.01) / np.log(max(1 - acceptance, 1e-10)))) or np.mean(accepted) > 0.99:
+                break
+        scale *= np.exp(acceptance - 0.234)
+        stats.append({'beta': beta, 'acceptance': acceptance, 'steps': steps})
+        print('Temperature {:.5f}: acceptance {:.3f}, {} steps'.format(beta, acceptance, steps))
+    print('log marginal likelihood {:.4f}'.format(logz))
+    return lnprob, x, logz, stats
+
+
+def _smc_step(delta, target, upper):
+    """Step of temperature (at most upper) where the effective sample size of the weights exp(step * delta) is
+    target, by bisection"""
+    def ess(step):
+        logw = step * delta
+        logw -= np.max(logw)
+        w = np.exp(logw)
+        return np.sum(w) ** 2 / np.sum(w ** 2)
+
+    if ess(upper) >= target:
+        return upper
+    lower = 0.0
+    for _ in range(60):
+        middle = (lower + upper) / 2
+        if ess(middle) < target:
+            upper = middle
+        else:
+            lower = middle
+    return max(lower, 1e-12)
+
+
+def _systematic_resample(weights):
+    positions = (np.random.uniform() + np.arange(len(weights))) / len(weights)
+    return np.minimum(np.searchsorted(np.cumsum(weights), positions), len(weights) - 1)
+
+
 # DATATRACE
 
 def chains_to_datatrace(process, chains, ll=None, transforms=True, burnin_tol=0.01, burnin_method='multi-sum', burnin_dims=None,
@@ -682,6 +1295,28 @@ def gelman_rubin(chains, method='multi-sum'):
         return np.max(np.abs(Rhat - 1))
 
 
+def convergence_stats(sampler, iterations, method='multi-sum', ess_method='mIS'):
+    """
+    Diagnostics of the first iterations of a running emcee sampler (the lowest temperature of a PTSampler): the
+    R-hat (as abs(R-hat - 1), see gelman_rubin) and the multivariate ESS over the second half of the chains,
+    discarded the first half as burn-in, and the mean acceptance fraction.
+    """
+    chains = sampler.chain
+    acceptance = sampler.acceptance_fraction
+    if len(chains.shape) == 4:
+        chains, acceptance = chains[0], acceptance[0]
+    chains = chains[:, iterations // 2:iterations, :]
+    try:
+        rhat = gelman_rubin(chains, method)
+    except Exception:
+        rhat = np.inf
+    try:
+        ess = np.sum([_mESS(chain, ess_method) for chain in chains])
+    except Exception:
+        ess = 0
+    return {'rhat': rhat, 'ess': ess, 'acceptance': np.mean(acceptance)}
+
+
 def burn_in_samples(chains, tol=0.1, method='multi-sum'):
     try:
         score = gelman_rubin(chains, method)
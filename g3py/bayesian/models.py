@@ -7,7 +7,7 @@ import theano as th
 import theano.tensor as tt
 import matplotlib.pyplot as plt
 from ..libs import clone, DictObj, save_pkl, load_pkl
-from ..libs.tensors import makefn, tt_to_num
+from ..libs.tensors import makefn, compile_function, tt_to_num
 from ..libs.plots import figure, plot, show, plot_text
 from .. import config
 from ipywidgets import interact, interact_manual, FloatSlider
@@ -142,7 +142,12 @@ class GraphicalModel:
 
     @property
     def bijection(self):
-        return pm.DictToArrayBijection(pm.ArrayOrdering(pm.inputvars(self.model.cont_vars)), self.model.test_point)
+        # the bijection only changes when new variables are added to the model
+        if getattr(self, 'bijection_cache', None) is None or self.bijection_cache[0] != len(self.model.vars):
+            self.bijection_cache = (len(self.model.vars),
+                                    pm.DictToArrayBijection(pm.ArrayOrdering(pm.inputvars(self.model.cont_vars)),
+                                                            self.model.test_point))
+        return self.bijection_cache[1]
 
     @property
     def ndim(self):
@@ -218,12 +223,12 @@ class GraphicalModel:
         for v in self.model.deterministics:
             dist = v.transformed.distribution
             # makefn(th_vars, dist.transform_used.backward(self.th_vector), precompile)
-            self.transformations[str(v.transformed)] = th.function(th_vars, dist.transform_used.backward(self.th_vector),
-                                                                   allow_input_downcast=True, on_unused_input='ignore')
+            self.transformations[str(v.transformed)] = compile_function(th_vars,
+                                                                        dist.transform_used.backward(self.th_vector),
+                                                                        key='backward')
             # makefn(th_vars, dist.transform_used.forward(self.th_vector), precompile)
-            self.transformations[str(v
-                                     )] = th.function(th_vars, dist.transform_used.forward(self.th_vector),
-                                                       allow_input_downcast=True, on_unused_input='ignore')
+            self.transformations[str(v)] = compile_function(th_vars, dist.transform_used.forward(self.th_vector),
+                                                            key='forward')
         th_vars = self.model.vars
         for pot in self.model.potentials:
             self.potentials[str(pot)] = makefn(th_vars, pot, bijection=None)
@@ -5,14 +5,45 @@ import pandas as pd
 import seaborn as sb
 import matplotlib.pyplot as plt
 from datetime import datetime as dt
+from collections import OrderedDict
 from tqdm import tqdm
 from inspect import signature
 from ..libs import random_obs, uniform_obs, save_pkl, load_pkl, save_datatrace, load_datatrace, nan_to_high, MaxTime
 from .average import marginal_datatrace
 
 
-def optimize(logp, start, dlogp=None, fmin=None, max_time=None, *args, **kwargs):
-    if fmin in [None, 'bfgs', 'BFGS']:
+class CachedObjective:
+    """Evaluations of a function f(x) -> (value, gradient), keeping the last points in an LRU cache"""
+    def __init__(self, f, size=8):
+        self.f = f
+        self.size = size
+        self.cache = OrderedDict()
+
+    def __call__(self, x):
+        key = np.asarray(x).tobytes()
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        r = self.f(x)
+        self.cache[key] = r
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+        return r
+
+
+# the options of scipy.optimize.minimize(method='BFGS') for the keyword arguments of fmin_bfgs
+bfgs_options = {'gtol': 'gtol', 'norm': 'norm', 'epsilon': 'eps', 'maxiter': 'maxiter', 'disp': 'disp'}
+
+
+def optimize(logp, start, dlogp=None, fmin=None, max_time=None, logp_dlogp=None, *args, **kwargs):
+    """
+    Maximizes logp from start, with BFGS (default) or Powell. If logp_dlogp, a function returning (logp, dlogp)
+    at the same point, is given, BFGS evaluates it once per point through scipy.optimize.minimize(jac=True),
+    which takes the keyword arguments of fmin_bfgs in bfgs_options, but neither positional arguments nor the ones
+    changing what fmin_bfgs returns.
+    """
+    bfgs = fmin in [None, 'bfgs', 'BFGS']
+    if bfgs:
         fmin = sp.optimize.fmin_bfgs
     else:
         fmin = sp.optimize.fmin_powell
@@ -33,6 +64,22 @@ def optimize(logp, start, dlogp=None, fmin=None, max_time=None, *args, **kwargs)
         except:
             return np.float32(1e32)
 
+    if bfgs and logp_dlogp is not None:
+        unsupported = [k for k in kwargs if k not in bfgs_options]
+        if len(args) > 0 or len(unsupported) > 0:
+            raise TypeError('optimize with logp_dlogp does not take the arguments ' + str(list(args) + unsupported))
+        objective = CachedObjective(logp_dlogp)
+
+        def f_df(x):
+            try:
+                value, grad = objective(x)
+                return nan_to_high(-value), np.nan_to_num(-grad)
+            except:
+                return np.float32(1e32), np.zeros_like(x)
+
+        options = {'disp': False}
+        options.update({bfgs_options[k]: v for k, v in kwargs.items()})
+        return sp.optimize.minimize(f_df, start, jac=True, method='BFGS', callback=callback, options=options).x
     if ('fprime' in signature(fmin).parameters) and (dlogp is not None):
         r = fmin(f,  start, #process.model.bijection.map(start)[process.sampling_dims],
                  fprime=df, callback=callback, *args, **kwargs)
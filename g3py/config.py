@@ -11,4 +11,7 @@ th.config.warn_float64 = 'raise'
 #th.config.int_division = 'raise'
 
 
-plot_big = False
\ No newline at end of file
+plot_big = False
+
+# directory of the persistent cache of compiled functions, shared among sessions (None disables it)
+compile_cache = os.environ.get('G3PY_COMPILE_CACHE', None)
@@ -0,0 +1,355 @@
+import os
+import numpy as np
+import scipy as sp
+import scipy.linalg
+
+
+def correlate(u, v, n=None):
+    """r_k = sum_i u_i v_{i+k} for k=0..n-1 along the first axis, computed with FFT"""
+    if n is None:
+        n = len(u)
+    size = 1 << int(np.ceil(np.log2(2 * n)))
+    fu = np.fft.rfft(u, size, axis=0)
+    fv = np.fft.rfft(v, size, axis=0)
+    return np.fft.irfft(np.conj(fu) * fv, size, axis=0)[:n]
+
+
+def toeplitz_solve(c, b):
+    """
+    Solve T(c) x = b with the Levinson recursion, O(N^2), for the symmetric Toeplitz T with first column c.
+    The recursion breaks down when a leading block of T is (numerically) singular, even if T is positive
+    semi-definite, and then T is solved densely with the cholesky of cholesky_jitter, O(N^3).
+    """
+    try:
+        x = sp.linalg.solve_toeplitz(c, b)
+        if np.all(np.isfinite(x)):
+            return x
+    except np.linalg.LinAlgError:
+        pass
+    return sp.linalg.cho_solve((cholesky_jitter(sp.linalg.toeplitz(c)), True), b)
+
+
+def toeplitz_durbin(c):
+    """
+    Durbin recursion for the symmetric Toeplitz T with first column c, O(N^2) time and O(N) memory.
+    :param c: the first column of T
+    :return: the first column of T^-1 and log|T|
+    """
+    c = np.asarray(c, dtype=np.float64)
+    n = len(c)
+    logdet = n * np.log(c[0])
+    if n == 1:
+        return np.array([1.0 / c[0]]), logdet
+    r = c[1:] / c[0]
+    y = np.zeros(n - 1)
+    alpha = -r[0]
+    beta = 1.0
+    y[0] = alpha
+    err = 1.0 - alpha ** 2
+    logdet += np.log(err)
+    for k in range(1, n - 1):
+        beta = (1.0 - alpha ** 2) * beta
+        alpha = -(r[k] + r[k - 1::-1].dot(y[:k])) / beta
+        y[:k] = y[:k] + alpha * y[k - 1::-1]
+        y[k] = alpha
+        err *= 1.0 - alpha ** 2
+        logdet += np.log(err)
+    return np.concatenate([[1.0], y]) / (err * c[0]), logdet
+
+
+def toeplitz_logdet(c):
+    return toeplitz_durbin(c)[1]
+
+
+def toeplitz_inverse_diagsums(c):
+    """
+    Sums of the diagonals of T^-1 (s_k = trace(T^-1, k), k=0..n-1) through the Gohberg-Semencul formula
+    T^-1 = (L(a) L(a)^T - L(b) L(b)^T) / a_0, without forming T^-1.
+    """
+    a, _ = toeplitz_durbin(c)
+    n = len(a)
+    b = np.concatenate([[0.0], a[:0:-1]])
+    m = np.arange(n)
+
+    def sums(l):
+        return (n - m) * correlate(l, l, n) - correlate(l * m, l, n)
+    return (sums(a) - sums(b)) / a[0]
+
+
+def toeplitz_outer_diagsums(u, v):
+    """Gradient of sum(u * T(c) v) with respect to c: sums over |i-j|=k of u_i v_j (+ u_j v_i)"""
+    n = len(u)
+    r = correlate(u, v, n) + correlate(v, u, n)
+    if r.ndim > 1:
+        r = r.sum(axis=1)
+    r[0] /= 2
+    return r
+
+
+def rademacher(n, probes, seed=0):
+    """Fixed random probes with entries +-1, for the stochastic trace estimators"""
+    return np.random.RandomState(seed).choice([-1.0, 1.0], size=(n, probes))
+
+
+def cg_solve(A, B, tol=1e-4, maxiter=None):
+    """
+    Solve A X = B for a symmetric positive-definite A with Jacobi-preconditioned conjugate gradients, iterating all
+    the columns of B at once so each step is a single blocked product A.dot(P).
+    :param tol: the relative tolerance on the norm of the residual of each column
+    :param maxiter: the maximum number of iterations, by default the size of A
+    """
+    A = np.asarray(A, dtype=np.float64)
+    vector = B.ndim == 1
+    B = np.asarray(B, dtype=np.float64).reshape(len(B), -1)
+    if maxiter is None:
+        maxiter = len(A)
+    d = np.diag(A)
+    d = np.where(d > 0, 1.0 / np.where(d > 0, d, 1.0), 1.0)
+    X = np.zeros_like(B)
+    R = B.copy()
+    Z = d[:, None] * R
+    P = Z.copy()
+    rz = np.sum(R * Z, axis=0)
+    stop = tol * np.maximum(np.linalg.norm(B, axis=0), np.finfo(np.float64).tiny)
+    for _ in range(maxiter):
+        AP = A.dot(P)
+        pap = np.sum(P * AP, axis=0)
+        alpha = np.where(pap > 0, rz / np.where(pap > 0, pap, 1.0), 0.0)
+        X += alpha * P
+        R -= alpha * AP
+        if np.all(np.linalg.norm(R, axis=0) <= stop):
+            break
+        Z = d[:, None] * R
+        rz_new = np.sum(R * Z, axis=0)
+        beta = np.where(rz > 0, rz_new / np.where(rz > 0, rz, 1.0), 0.0)
+        P = Z + beta * P
+        rz = rz_new
+    if vector:
+        return X[:, 0]
+    return X
+
+
+def slq_logdet(A, probes=16, steps=32, seed=0):
+    """
+    Stochastic Lanczos quadrature of log|A| for a symmetric positive-definite A: for each probe z, m steps of
+    Lanczos give the tridiagonal T = U diag(theta) U^T and z^T log(A) z ~ n sum_k U_0k^2 log(theta_k).
+    All the probes share the blocked products A.dot(Q).
+    """
+    A = np.asarray(A, dtype=np.float64)
+    n = len(A)
+    steps = min(steps, n)
+    Q = rademacher(n, probes, seed) / np.sqrt(n)
+    Q_prev = np.zeros_like(Q)
+    beta = np.zeros(probes)
+    alphas, betas = [], []
+    for j in range(steps):
+        W = A.dot(Q)
+        alpha = np.sum(Q * W, axis=0)
+        W -= alpha * Q + beta * Q_prev
+        alphas.append(alpha)
+        beta = np.linalg.norm(W, axis=0)
+        if j == steps - 1 or np.any(beta < 1e-10):
+            break
+        betas.append(beta)
+        Q_prev, Q = Q, W / beta
+    alphas = np.array(alphas)
+    if len(alphas) == 1:
+        # the probes are eigenvectors of A (e.g. A is a multiple of the identity), so T is 1 x 1
+        return n * np.mean(np.log(np.maximum(alphas[0], np.finfo(np.float64).tiny)))
+    betas = np.array(betas).reshape(len(alphas) - 1, probes)
+    r = 0.0
+    for i in range(probes):
+        # the QR driver, since the default (MRRR) fails on the ghost eigenvalues of long runs without
+        # reorthogonalization
+        theta, U = sp.linalg.eigh_tridiagonal(alphas[:, i], betas[:, i], lapack_driver='stev')
+        r += np.sum(U[0] ** 2 * np.log(np.maximum(theta, np.finfo(np.float64).tiny)))
+    return n * r / probes
+
+
+def hutchinson_inverse(A, probes=16, seed=0, tol=1e-4, maxiter=None):
+    """Unbiased estimate of A^-1 = E[(A^-1 z) z^T], symmetrized, with the same probes of slq_logdet"""
+    Z = rademacher(len(A), probes, seed)
+    X = cg_solve(A, Z, tol=tol, maxiter=maxiter)
+    return (X.dot(Z.T) + Z.dot(X.T)) / (2 * probes)
+
+
+def cholesky_jitter(K, maxtries=10):
+    """Lower cholesky of K, adding a growing jitter to the diagonal when K is not numerically positive-definite"""
+    jitter = np.abs(np.diag(K)).mean() * 1e-8
+    for _ in range(maxtries):
+        try:
+            return sp.linalg.cholesky(K, lower=True)
+        except np.linalg.LinAlgError:
+            K = K + jitter * np.eye(len(K))
+            jitter *= 10
+    raise np.linalg.LinAlgError("not approximate positive-definite")
+
+
+def cholesky_update(L, x):
+    """Rank-1 update in O(n^2): the cholesky of L L^T + x x^T"""
+    L = L.copy()
+    x = x.copy()
+    for k in range(len(x)):
+        r = np.hypot(L[k, k], x[k])
+        c = r / L[k, k]
+        s = x[k] / L[k, k]
+        L[k, k] = r
+        L[k + 1:, k] = (L[k + 1:, k] + s * x[k + 1:]) / c
+        x[k + 1:] = c * x[k + 1:] - s * L[k + 1:, k]
+    return L
+
+
+def cholesky_append(L, K12, K22):
+    """Cholesky of [[K11, K12], [K12^T, K22]] given the cholesky L of K11, in O(n^2 k) for k new rows"""
+    S = sp.linalg.solve_triangular(L, K12, lower=True)
+    L22 = cholesky_jitter(K22 - S.T.dot(S))
+    n, k = S.shape
+    R = np.zeros((n + k, n + k), dtype=L.dtype)
+    R[:n, :n] = L
+    R[n:, :n] = S.T
+    R[n:, n:] = L22
+    return R
+
+
+def cholesky_delete(L, index):
+    """Cholesky of K without the row and column index, given the cholesky L of K, in O(n^2)"""
+    R = np.delete(np.delete(L, index, axis=0), index, axis=1)
+    R[index:, index:] = cholesky_update(R[index:, index:], L[index + 1:, index])
+    return R
+
+
+class OnlineCholesky:
+    """
+    Cholesky of a growing (and expiring) kernel matrix at fixed hyperparameters: new rows are appended and old
+    ones deleted with O(n^2) updates, instead of refactorizing in O(n^3).
+    """
+    def __init__(self, L, window=None):
+        self.L = np.asarray(L, dtype=np.float64)
+        self.window = window
+
+    def __len__(self):
+        return len(self.L)
+
+    def append(self, K12, K22):
+        self.L = cholesky_append(self.L, np.asarray(K12, dtype=np.float64), np.asarray(K22, dtype=np.float64))
+
+    def delete(self, indexs):
+        for index in sorted(np.atleast_1d(indexs), reverse=True):
+            self.L = cholesky_delete(self.L, int(index))
+
+    def expire(self):
+        """Deletes the oldest rows beyond the window, returning how many were deleted"""
+        if self.window is None or len(self) <= self.window:
+            return 0
+        n = len(self) - self.window
+        self.delete(np.arange(n))
+        return n
+
+    def solve_lower(self, b):
+        return sp.linalg.solve_triangular(self.L, b, lower=True)
+
+
+def vecchia_neighbours(x, k):
+    """
+    The k nearest previous neighbours of each row of x (in the order of x), for the Vecchia approximation.
+    :return: the (n x k) indexs, padded with 0, and the (n x k) mask of the valid ones
+    """
+    from scipy.spatial import cKDTree
+    n = len(x)
+    index = np.zeros((n, k), dtype=np.int64)
+    mask = np.zeros((n, k))
+    if n < 2 or k < 1:
+        return index, mask
+    _, candidates = cKDTree(x).query(x, k=min(n, 4 * k + 1))
+    candidates = candidates.reshape(n, -1)
+    for i in range(1, n):
+        previous = candidates[i][candidates[i] < i][:k]
+        if len(previous) < min(i, k):
+            d = np.sum((x[:i] - x[i]) ** 2, axis=1)
+            previous = np.argsort(d, kind='mergesort')[:k]
+        index[i, :len(previous)] = previous
+        mask[i, :len(previous)] = 1
+    return index, mask
+
+
+def batched_solve(A, b, threads=None):
+    """Solve A[i] x[i] = b[i] for a batch of small systems, splitting the batch over a pool of threads"""
+    if threads is None:
+        threads = os.cpu_count() or 1
+    if threads <= 1 or len(A) < 2 * threads:
+        return np.linalg.solve(A, b[..., None])[..., 0]
+    from concurrent.futures import ThreadPoolExecutor
+    chunks = np.array_split(np.arange(len(A)), threads)
+    with ThreadPoolExecutor(threads) as pool:
+        r = pool.map(lambda c: np.linalg.solve(A[c], b[c][..., None])[..., 0], chunks)
+    return np.concatenate(list(r))
+
+
+def experts_partition(x, k, method='kmeans', seed=0):
+    """
+    Split the rows of x into k blocks, by k-means on x or in contiguous chunks. With fewer rows than blocks,
+    the rows are repeated so every block is non-empty.
+    :return: the list of the k (sorted) index arrays
+    """
+    n = len(x)
+    if n < k:
+        return [np.array([i % n]) for i in range(k)]
+    if method == 'chunks':
+        return np.array_split(np.arange(n), k)
+    from scipy.cluster.vq import kmeans2
+    # kmeans2 draws its initial centroids (rows of x) from the global generator, which is restored afterwards
+    state = np.random.get_state()
+    np.random.seed(seed)
+    try:
+        _, labels = kmeans2(np.asarray(x, dtype=np.float64).reshape(n, -1), k, minit='points')
+    finally:
+        np.random.set_state(state)
+    blocks = [np.where(labels == i)[0] for i in range(k)]
+    blocks = [b for b in blocks if len(b) > 0]
+    while len(blocks) < k:
+        blocks.sort(key=len)
+        largest = blocks.pop()
+        blocks += [largest[:len(largest) // 2], largest[len(largest) // 2:]]
+    return sorted(blocks, key=lambda b: b[0])
+
+
+def _pool_map(f, items, threads=None):
+    if threads is None:
+        threads = os.cpu_count() or 1
+    if threads <= 1 or len(items) < 2:
+        return [f(i) for i in items]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(min(threads, len(items))) as pool:
+        return list(pool.map(f, items))
+
+
+def experts_logp(covs, deltas, threads=None):
+    """
+    Sum over the blocks of -0.5 (delta^T K^-1 delta + log|K|), each block factorized in a pool of threads.
+    :return: the sum, or nan if some block is not positive-definite
+    """
+    def block(i):
+        try:
+            cho = sp.linalg.cho_factor(covs[i], lower=True)
+        except np.linalg.LinAlgError:
+            return np.nan
+        alpha = sp.linalg.cho_solve(cho, deltas[i])
+        return -0.5 * (deltas[i].dot(alpha) + 2 * np.sum(np.log(np.diag(cho[0]))))
+    return np.sum(_pool_map(block, list(range(len(covs))), threads))
+
+
+def experts_dlogp(covs, deltas, threads=None):
+    """
+    The gradients of experts_logp, 0.5 (alpha alpha^T - K^-1) for each K and -alpha for each delta, with
+    alpha = K^-1 delta.
+    """
+    def block(i):
+        try:
+            cho = sp.linalg.cho_factor(covs[i], lower=True)
+        except np.linalg.LinAlgError:
+            return np.full_like(covs[i], np.nan), np.full_like(deltas[i], np.nan)
+        alpha = sp.linalg.cho_solve(cho, deltas[i])
+        inv = sp.linalg.cho_solve(cho, np.eye(len(alpha)))
+        return 0.5 * (np.outer(alpha, alpha) - inv), -alpha
+    r = _pool_map(block, list(range(len(covs))), threads)
+    return [c for c, _ in r], [d for _, d in r]
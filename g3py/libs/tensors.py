@@ -1,3 +1,9 @@
+import io
+import os
+import math
+import hashlib
+import tempfile
+import threading
 import numpy as np
 import scipy as sp
 import pymc3 as pm
@@ -5,7 +11,9 @@ import theano as th
 import theano.tensor as tt
 import theano.tensor.slinalg as tsl
 from IPython.display import Image
-from . import clone
+from . import clone, save_pkl, load_pkl
+from . import linalg
+from .. import config
 
 
 def gradient1(f, v):
@@ -22,6 +30,15 @@ def gradient(f, wrt=None):
         return tt.zeros(0.0, dtype='float32')
 
 
+def hessian(f, wrt=None):
+    """flat Hessian of f wrt the (flattened and concatenated) variables wrt"""
+    if wrt is None:
+        wrt = pm.inputvars(pm.cont_inputs(f))
+    g = gradient(f, wrt)
+    return tt.concatenate([tt.jacobian(g, v, disconnected_inputs='warn').reshape((g.shape[0], -1)) for v in wrt],
+                          axis=1)
+
+
 def debug(x, name='', force=False):
     if th.config.mode in ['NanGuardMode', 'DebugMode'] or force:
         try:
@@ -32,26 +49,155 @@ def debug(x, name='', force=False):
     else:
         return x
 
+def graph_key(th_vars, fn, givens=None, key=None):
+    """
+    Structural hash of a function: its inputs, its (unoptimized) graph, the data of its constants (which the
+    debugprint abbreviates), the givens and the configuration
+    """
+    graph = io.StringIO()
+    outputs = list(fn) if isinstance(fn, (list, tuple)) else [fn]
+    outputs += [v for _, v in givens or []]
+    th.printing.debugprint(outputs, file=graph, print_type=True)
+    constants = hashlib.sha1()
+    for v in th.gof.graph.ancestors(outputs):
+        if isinstance(v, th.gof.Constant):
+            data = np.asarray(v.data)
+            constants.update((str(data.dtype) + str(data.shape)).encode())
+            constants.update(data.tobytes())
+    signature = [key, th.__version__, th.config.floatX, th.config.mode, [(str(v), str(v.type)) for v in th_vars],
+                 [(str(k), str(v)) for k, v in givens or []], graph.getvalue(), constants.hexdigest()]
+    return hashlib.sha1(repr(signature).encode()).hexdigest()
+
+
+# the functions of the cache compiled or loaded in this session, by their path, shared by the makefns of a graph
+compiled_functions = dict()
+
+
+def compile_function(th_vars, fn, givens=None, key=None, cache=None):
+    """
+    Compiles th.function(th_vars, fn), reusing the one stored in the cache directory by a previous session.
+    The functions with implicit (shared) inputs are never stored, since they would be unlinked from the process.
+    A function of the cache is loaded once per session: the next makefns of its graph share it, since unpickling
+    links its C thunks again.
+    """
+    if cache is None:
+        cache = config.compile_cache
+    if cache is None:
+        return th.function(th_vars, fn, givens=givens, allow_input_downcast=True, on_unused_input='ignore')
+    path = os.path.join(cache, graph_key(th_vars, fn, givens, key) + '.pkl')
+    if path in compiled_functions:
+        return compiled_functions[path]
+    if os.path.isfile(path):
+        try:
+            compiled_functions[path] = load_pkl(path)
+            return compiled_functions[path]
+        except Exception as m:
+            print('Error loading compiled function ' + path, m)
+    compiled = th.function(th_vars, fn, givens=givens, allow_input_downcast=True, on_unused_input='ignore')
+    if any(i.implicit for i in compiled.maker.inputs):
+        return compiled
+    try:
+        os.makedirs(cache, exist_ok=True)
+        # written to a temporal file and renamed, so concurrent sessions never read a partial file
+        fd, tmp = tempfile.mkstemp(dir=cache, suffix='.tmp')
+        os.close(fd)
+        save_pkl(compiled, tmp)
+        os.replace(tmp, path)
+    except Exception as m:
+        print('Error saving compiled function ' + path, m)
+    compiled_functions[path] = compiled
+    return compiled
+
+
+_cmodule_key_ = th.gof.cc.CLinker.cmodule_key_
+
+
+def cmodule_key_(self, fgraph, *args, **kwargs):
+    """
+    The key of a C module in the compiledir of theano, versioned when only the empty __props__ of an op (Shape,
+    Alloc, Dot22, DeepCopyOp...) made it unversioned, as in later theano releases. Theano 1.0 compiles the
+    unversioned modules again in every session (about 1 s each), both for the test values of the graphs and when the
+    functions of the cache are unpickled, which took most of the construction of a process with a warm cache.
+    """
+    key = _cmodule_key_(self, fgraph, *args, **kwargs)
+    if key is None or key[0]:
+        return key
+    version = []
+    for node in self.schedule(fgraph):
+        if hasattr(node.op, 'c_code_cache_version_apply'):
+            version.append(node.op.c_code_cache_version_apply(node))
+        if getattr(node.op, '__props__', None):
+            version.append(node.op.__props__)
+        version += [v.type.c_code_cache_version() for v in node.inputs + node.outputs]
+    if all(version):
+        return tuple(version), key[1]
+    return key
+
+
+th.gof.cc.CLinker.cmodule_key_ = cmodule_key_
+
+
+# theano compilations are serialized (th.function is not thread-safe), both the background ones and the ones of
+# the first call of a method, so a single background thread overlaps them with the rest of the session
+compile_lock = threading.RLock()
+compile_pool = None
+
+
+def compile_background(f):
+    """Runs f in the background thread of the compilations, returning its future"""
+    global compile_pool
+    if compile_pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+        compile_pool = ThreadPoolExecutor(1)
+    return compile_pool.submit(f)
+
+
 class makefn:
-    def __init__(self, th_vars, fn, givens=None, bijection=None, precompile=False):
+    def __init__(self, th_vars, fn, givens=None, bijection=None, precompile=False, key=None, flat=False):
         self.th_vars = th_vars
         self.fn = fn
         self.givens = givens
         self.bijection = bijection
+        self.key = key
+        # the parameters are given as the last (flat array) input instead of keyword arguments
+        self.flat = flat
+        self.parent = None
+        self.future = None
+        self.compiled = None
         if precompile:
             #print(self.th_vars, self.fn)
-            self.compiled = th.function(self.th_vars, self.fn, givens=self.givens, allow_input_downcast=True,
-                                        on_unused_input='ignore')
-        else:
-            self.compiled = None
+            self.compile()
         self.executed = 0
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['future'] = None
+        return state
+
+    def compile(self):
+        """Compiles the function once, blocking while it is compiled by another thread"""
+        if self.compiled is None:
+            with compile_lock:
+                if self.compiled is None:
+                    if getattr(self, 'parent', None) is not None:
+                        self.compiled = self.parent.compile()
+                    else:
+                        self.compiled = compile_function(self.th_vars, self.fn, givens=self.givens, key=self.key)
+        return self.compiled
+
+    def compile_async(self):
+        """Compiles the function in the background, returning the future of the compiled function"""
+        if getattr(self, 'future', None) is None:
+            self.future = compile_background(self.compile)
+        return self.future
+
     def __call__(self, params, space=None, inputs=None, outputs=None, vector=[]):
         self.executed += 1
         if self.compiled is None:
             #print(self.th_vars, self.fn)
-            self.compiled = th.function(self.th_vars, self.fn, givens=self.givens, allow_input_downcast=True,
-                                        on_unused_input='ignore')
+            self.compile()
+        if getattr(self, 'flat', False):
+            return self.compiled(space, inputs, outputs, vector, params)
         if self.givens is None:
             if self.bijection is None:
                 return self.compiled( **params)
@@ -71,6 +217,10 @@ class makefn:
     def clone(self, bijection=None):
         r = clone(self)
         r.bijection = bijection
+        r.future = None
+        if r.compiled is None:
+            # the clone shares the compilation of the original
+            r.parent = self
         return r
 
 
@@ -267,4 +417,409 @@ try:
     solve_upper_triangular = tsl.solve_upper_triangular
 except:
     solve_lower_triangular = tsl.Solve(A_structure='lower_triangular', lower=True)
-    solve_upper_triangular = tsl.Solve(A_structure='upper_triangular', lower=False)
\ No newline at end of file
+    solve_upper_triangular = tsl.Solve(A_structure='upper_triangular', lower=False)
+
+class SolveToeplitz(th.gof.Op):
+    """
+    Solve T(c) x = b for the symmetric Toeplitz matrix T(c) with first column c, with the Levinson
+    recursion in O(N^2) time and O(N) memory (and a dense fallback if it breaks down). b can be a vector or a matrix.
+    """
+
+    __props__ = ()
+
+    def make_node(self, c, b):
+        c = tt.as_tensor_variable(c)
+        b = tt.as_tensor_variable(b)
+        assert c.ndim == 1
+        return th.gof.Apply(self, [c, b], [b.type()])
+
+    def infer_shape(self, node, shapes):
+        return [shapes[1]]
+
+    def perform(self, node, inputs, outputs):
+        c, b = inputs
+        try:
+            x = linalg.toeplitz_solve(c, b)
+        except (np.linalg.LinAlgError, ValueError):
+            # as the dense path, an invalid kernel gives a nan log p instead of stopping the caller
+            x = np.full(b.shape, np.nan)
+        outputs[0][0] = x.astype(b.dtype)
+
+    def grad(self, inputs, gradients):
+        c, b = inputs
+        x = self(c, b)
+        db = self(c, gradients[0])
+        return [-toeplitz_outer_diagsums(db, x), db]
+
+
+class LogdetToeplitz(th.gof.Op):
+    """
+    Log-determinant of the symmetric Toeplitz matrix T(c) with the Durbin recursion. Its gradient,
+    d log|T| / dc_k, are the diagonal sums of T^-1 (Gohberg-Semencul), so T^-1 is never formed.
+    """
+
+    __props__ = ()
+
+    def make_node(self, c):
+        c = tt.as_tensor_variable(c)
+        assert c.ndim == 1
+        return th.gof.Apply(self, [c], [tt.scalar(dtype=c.dtype)])
+
+    def infer_shape(self, node, shapes):
+        return [()]
+
+    def perform(self, node, inputs, outputs):
+        c, = inputs
+        outputs[0][0] = np.array(linalg.toeplitz_logdet(c), dtype=c.dtype)
+
+    def grad(self, inputs, gradients):
+        c, = inputs
+        s = toeplitz_inverse_diagsums(c)
+        return [gradients[0] * tt.set_subtensor(s[1:], np.float32(2) * s[1:])]
+
+
+class ToeplitzInverseDiagsums(th.gof.Op):
+
+    __props__ = ()
+
+    def make_node(self, c):
+        c = tt.as_tensor_variable(c)
+        return th.gof.Apply(self, [c], [c.type()])
+
+    def infer_shape(self, node, shapes):
+        return [shapes[0]]
+
+    def perform(self, node, inputs, outputs):
+        c, = inputs
+        outputs[0][0] = linalg.toeplitz_inverse_diagsums(c).astype(c.dtype)
+
+
+class ToeplitzOuterDiagsums(th.gof.Op):
+
+    __props__ = ()
+
+    def make_node(self, u, v):
+        u = tt.as_tensor_variable(u)
+        v = tt.as_tensor_variable(v)
+        return th.gof.Apply(self, [u, v], [tt.vector(dtype=u.dtype)])
+
+    def perform(self, node, inputs, outputs):
+        u, v = inputs
+        outputs[0][0] = linalg.toeplitz_outer_diagsums(u, v).astype(u.dtype)
+
+
+solve_toeplitz = SolveToeplitz()
+logdet_toeplitz = LogdetToeplitz()
+toeplitz_inverse_diagsums = ToeplitzInverseDiagsums()
+toeplitz_outer_diagsums = ToeplitzOuterDiagsums()
+
+
+def kron_mv(factors, v):
+    """
+    Product kron(A_1, ..., A_D).dot(v) without forming the Kronecker matrix, O(N sum n_d) instead of O(N^2).
+    v is ordered with the last factor changing fastest (the order of numpy.kron and of grid2d).
+    """
+    if len(factors) == 1:
+        return factors[0].dot(v)
+    x = v.reshape([a.shape[1] for a in factors], ndim=len(factors))
+    for a in factors:
+        x = tt.tensordot(x, a.T, axes=[[0], [0]])
+    return x.flatten()
+
+
+def kron_diag(vectors):
+    """Diagonal of kron(diag(v_1), ..., diag(v_D)), i.e. the Kronecker product of the vectors v_d"""
+    r = vectors[0]
+    for v in vectors[1:]:
+        r = (r[:, None] * v[None, :]).flatten()
+    return r
+
+
+def kron_matrix(factors):
+    """Dense Kronecker product of the factors, only for small grids"""
+    r = factors[0]
+    for a in factors[1:]:
+        r = tsl.kron(r, a)
+    return r
+
+
+def statespace_stationary_cov(order, lam, var):
+    """Stationary covariance of the state (f, f', ...) of a Matern kernel with nu = order - 1/2"""
+    if order == 1:
+        return var * tt.ones((1, 1))
+    lam2 = lam ** 2
+    if order == 2:
+        return var * tt.stack([tt.stack([tt.ones_like(lam), tt.zeros_like(lam)]),
+                               tt.stack([tt.zeros_like(lam), lam2])])
+    if order == 3:
+        lam23 = lam2 / np.float32(3)
+        return var * tt.stack([tt.stack([tt.ones_like(lam), tt.zeros_like(lam), -lam23]),
+                               tt.stack([tt.zeros_like(lam), lam23, tt.zeros_like(lam)]),
+                               tt.stack([-lam23, tt.zeros_like(lam), lam2 ** 2])])
+    raise ValueError('state-space order not supported: ' + str(order))
+
+
+def statespace_model(components, deltas):
+    """
+    Linear time-invariant model of a sum of Matern kernels, with one block of the state per component.
+    The feedback matrix F of a component of order m has the single eigenvalue -lam with multiplicity m, so
+    N = F + lam I is nilpotent and the transition is expm(F d) = exp(-lam d) sum_{k<m} (d N)^k / k!.
+    :param components: list of (order, lam, var)
+    :param deltas: the distances between consecutive (sorted) inputs
+    :return: the observation vector H, the stationary covariance P0 and the transitions A and noises Q (n x S x S)
+    """
+    size = sum([c[0] for c in components])
+    n = deltas.shape[0]
+    H = np.zeros(size, dtype=th.config.floatX)
+    P0 = tt.zeros((size, size))
+    As = tt.zeros((n, size, size))
+    Qs = tt.zeros((n, size, size))
+    i = 0
+    for order, lam, var in components:
+        nil = tt.zeros((order, order))
+        for k in range(order - 1):
+            nil = tt.set_subtensor(nil[k, k + 1], np.float32(1))
+        for k in range(order):
+            coeff = np.float32(math.factorial(order) // (math.factorial(k) * math.factorial(order - k)))
+            nil = tt.set_subtensor(nil[order - 1, k], -coeff * lam ** (order - k))
+        nil = nil + lam * tt.eye(order)
+        A = tt.zeros((n, order, order))
+        power = tt.eye(order)
+        for k in range(order):
+            A = A + (deltas ** k / np.float32(math.factorial(k)))[:, None, None] * power[None, :, :]
+            power = power.dot(nil)
+        A = tt.exp(-lam * deltas)[:, None, None] * A
+        P = statespace_stationary_cov(order, lam, var)
+        Q = P[None, :, :] - tt.batched_dot(tt.tensordot(A, P, axes=[[2], [0]]), A.dimshuffle(0, 2, 1))
+        H[i] = 1
+        P0 = tt.set_subtensor(P0[i:i + order, i:i + order], P)
+        As = tt.set_subtensor(As[:, i:i + order, i:i + order], A)
+        Qs = tt.set_subtensor(Qs[:, i:i + order, i:i + order], Q)
+        i += order
+    return tt.as_tensor_variable(H), P0, As, Qs
+
+
+def kalman_filter(y, observed, As, Qs, H, P0, noise):
+    """
+    Kalman filter of y_k = H s_k + e_k, with e_k ~ N(0, noise), in O(N S^3) time. The steps where observed is
+    zero are only predicted, which gives the filter at unobserved locations.
+    :return: the filtered means and covariances, the predicted means and covariances and the log p of each step
+    """
+    def step(y_k, o_k, A, Q, m, P):
+        mp = A.dot(m)
+        Pp = A.dot(P).dot(A.T) + Q
+        v = y_k - H.dot(mp)
+        s = H.dot(Pp).dot(H) + noise
+        K = Pp.dot(H) / s
+        m_new = mp + o_k * K * v
+        P_new = Pp - o_k * tt.outer(K, K) * s
+        ll = o_k * np.float32(-0.5) * (tt.log(np.float32(2.0 * np.pi) * s) + v ** 2 / s)
+        return m_new, P_new, mp, Pp, ll
+    (ms, Ps, mps, Pps, lls), _ = th.scan(step, sequences=[y, observed, As, Qs],
+                                         outputs_info=[tt.zeros_like(H), P0, None, None, None])
+    return ms, Ps, mps, Pps, lls
+
+
+def rts_smoother(ms, Ps, mps, Pps, As):
+    """Rauch-Tung-Striebel smoother over the outputs of kalman_filter, in O(N S^3) time"""
+    def step(m, P, mp_next, Pp_next, A_next, ms_next, Ps_next):
+        G = tsl.solve(Pp_next, A_next.dot(P)).T
+        return m + G.dot(ms_next - mp_next), P + G.dot(Ps_next - Pp_next).dot(G.T)
+    (sms, sPs), _ = th.scan(step, sequences=[ms[:-1], Ps[:-1], mps[1:], Pps[1:], As[1:]],
+                            outputs_info=[ms[-1], Ps[-1]], go_backwards=True)
+    return tt.concatenate([sms[::-1], ms[-1:]], axis=0), tt.concatenate([sPs[::-1], Ps[-1:]], axis=0)
+
+
+class SolveCG(th.gof.Op):
+    """
+    Solve K x = b for a symmetric positive-definite K with preconditioned conjugate gradients, using only
+    products with K. b can be a vector or a matrix.
+    """
+
+    __props__ = ('tol', 'maxiter')
+
+    def __init__(self, tol=1e-4, maxiter=None):
+        self.tol = tol
+        self.maxiter = maxiter
+
+    def make_node(self, K, b):
+        K = tt.as_tensor_variable(K)
+        b = tt.as_tensor_variable(b)
+        assert K.ndim == 2
+        return th.gof.Apply(self, [K, b], [b.type()])
+
+    def infer_shape(self, node, shapes):
+        return [shapes[1]]
+
+    def perform(self, node, inputs, outputs):
+        K, b = inputs
+        outputs[0][0] = np.nan_to_num(linalg.cg_solve(K, b, self.tol, self.maxiter)).astype(b.dtype)
+
+    def grad(self, inputs, gradients):
+        K, b = inputs
+        x = self(K, b)
+        db = self(K, gradients[0])
+        if x.ndim == 1:
+            return [-tt.outer(db, x), db]
+        return [-db.dot(x.T), db]
+
+
+class LogdetSLQ(th.gof.Op):
+    """
+    Log-determinant of a symmetric positive-definite K with stochastic Lanczos quadrature. Its gradient K^-1 is
+    estimated with the Hutchinson estimator over the same probes, solved with conjugate gradients.
+    """
+
+    __props__ = ('tol', 'maxiter', 'probes', 'steps', 'seed')
+
+    def __init__(self, tol=1e-4, maxiter=None, probes=16, steps=32, seed=0):
+        self.tol = tol
+        self.maxiter = maxiter
+        self.probes = probes
+        self.steps = steps
+        self.seed = seed
+
+    def make_node(self, K):
+        K = tt.as_tensor_variable(K)
+        assert K.ndim == 2
+        return th.gof.Apply(self, [K], [tt.scalar(dtype=K.dtype)])
+
+    def infer_shape(self, node, shapes):
+        return [()]
+
+    def perform(self, node, inputs, outputs):
+        K, = inputs
+        outputs[0][0] = np.array(linalg.slq_logdet(K, self.probes, self.steps, self.seed), dtype=K.dtype)
+
+    def grad(self, inputs, gradients):
+        K, = inputs
+        return [gradients[0] * HutchinsonInverse(self.tol, self.maxiter, self.probes, self.seed)(K)]
+
+
+class HutchinsonInverse(th.gof.Op):
+
+    __props__ = ('tol', 'maxiter', 'probes', 'seed')
+
+    def __init__(self, tol=1e-4, maxiter=None, probes=16, seed=0):
+        self.tol = tol
+        self.maxiter = maxiter
+        self.probes = probes
+        self.seed = seed
+
+    def make_node(self, K):
+        K = tt.as_tensor_variable(K)
+        return th.gof.Apply(self, [K], [K.type()])
+
+    def infer_shape(self, node, shapes):
+        return [shapes[0]]
+
+    def perform(self, node, inputs, outputs):
+        K, = inputs
+        outputs[0][0] = linalg.hutchinson_inverse(K, self.probes, self.seed, self.tol, self.maxiter).astype(K.dtype)
+
+
+class VecchiaNeighbours(th.gof.Op):
+    """
+    The k nearest previous neighbours of each input and their mask. The index is built once per inputs array
+    and reused while the inputs do not change.
+    """
+
+    __props__ = ('k',)
+
+    def __init__(self, k=16):
+        self.k = k
+        self.cache = None
+
+    def make_node(self, x):
+        x = tt.as_tensor_variable(x)
+        return th.gof.Apply(self, [x], [tt.lmatrix(), tt.matrix(dtype=x.dtype)])
+
+    def perform(self, node, inputs, outputs):
+        x, = inputs
+        key = (x.shape, hash(x.tobytes()))
+        if self.cache is None or self.cache[0] != key:
+            index, mask = linalg.vecchia_neighbours(x, self.k)
+            self.cache = (key, index, mask.astype(x.dtype))
+        outputs[0][0] = self.cache[1]
+        outputs[1][0] = self.cache[2]
+
+    def grad(self, inputs, gradients):
+        return [th.gradient.grad_undefined(self, 0, inputs[0])]
+
+
+class BatchedSolve(th.gof.Op):
+    """Solve A[i] x[i] = b[i] for a batch (n x k x k) of small systems, in parallel over the batch"""
+
+    __props__ = ()
+
+    def make_node(self, A, b):
+        A = tt.as_tensor_variable(A)
+        b = tt.as_tensor_variable(b)
+        assert A.ndim == 3 and b.ndim == 2
+        return th.gof.Apply(self, [A, b], [b.type()])
+
+    def infer_shape(self, node, shapes):
+        return [shapes[1]]
+
+    def perform(self, node, inputs, outputs):
+        A, b = inputs
+        try:
+            outputs[0][0] = linalg.batched_solve(A, b).astype(b.dtype)
+        except np.linalg.LinAlgError:
+            outputs[0][0] = np.full_like(b, np.nan)
+
+    def grad(self, inputs, gradients):
+        A, b = inputs
+        x = self(A, b)
+        db = self(A.dimshuffle(0, 2, 1), gradients[0])
+        return [-db[:, :, None] * x[:, None, :], db]
+
+
+batched_solve = BatchedSolve()
+
+
+class ExpertsLogp(th.gof.Op):
+    """
+    Sum over independent gaussian blocks (the experts) of -0.5 (delta^T K^-1 delta + log|K|). The inputs are the
+    k covariance matrices followed by the k deltas, and the blocks are factorized in a pool of threads.
+    """
+
+    __props__ = ('threads',)
+
+    def __init__(self, threads=None):
+        self.threads = threads
+
+    def make_node(self, *inputs):
+        inputs = [tt.as_tensor_variable(i) for i in inputs]
+        return th.gof.Apply(self, inputs, [tt.scalar(dtype=inputs[0].dtype)])
+
+    def infer_shape(self, node, shapes):
+        return [()]
+
+    def perform(self, node, inputs, outputs):
+        k = len(inputs) // 2
+        outputs[0][0] = np.array(linalg.experts_logp(inputs[:k], inputs[k:], self.threads), dtype=node.outputs[0].dtype)
+
+    def grad(self, inputs, gradients):
+        return [gradients[0] * g for g in ExpertsDlogp(self.threads)(*inputs)]
+
+
+class ExpertsDlogp(th.gof.Op):
+
+    __props__ = ('threads',)
+
+    def __init__(self, threads=None):
+        self.threads = threads
+
+    def make_node(self, *inputs):
+        inputs = [tt.as_tensor_variable(i) for i in inputs]
+        return th.gof.Apply(self, inputs, [i.type() for i in inputs])
+
+    def infer_shape(self, node, shapes):
+        return shapes
+
+    def perform(self, node, inputs, outputs):
+        k = len(inputs) // 2
+        dcovs, ddeltas = linalg.experts_dlogp(inputs[:k], inputs[k:], self.threads)
+        for o, g, i in zip(outputs, dcovs + ddeltas, inputs):
+            o[0] = g.astype(i.dtype)
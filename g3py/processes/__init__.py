@@ -1,5 +1,10 @@
 from .stochastic import StochasticProcess
 from .gaussian import GaussianProcess, WarpedGaussianProcess
+from .sparse import SparseGaussianProcess
+from .kronecker import KroneckerGaussianProcess
+from .statespace import StateSpaceGaussianProcess
+from .fourier import FourierGaussianProcess
+from .experts import ExpertsGaussianProcess
 from .studentT import StudentTProcess, WarpedStudentTProcess
 from .marginal import *
 from .transport import TransportGaussianProcess
@@ -8,6 +13,11 @@ from .copula import CopulaGaussianProcess, CopulaStudentTProcess
 
 GP = GaussianProcess
 WGP = WarpedGaussianProcess
+SGP = SparseGaussianProcess
+KGP = KroneckerGaussianProcess
+SSGP = StateSpaceGaussianProcess
+FGP = FourierGaussianProcess
+EGP = ExpertsGaussianProcess
 
 TP = StudentTProcess
 WTP = WarpedStudentTProcess
@@ -11,7 +11,8 @@ from .hypers.kernels import Kernel, KernelSum, KernelNoise
 from .hypers.means import Mean
 from .hypers.mappings import Mapping, Identity
 from .stochastic import zero32, StochasticProcess
-from ..libs.tensors import tt_to_cov, cholesky_robust, tt_to_bounded, tt_to_num
+from ..libs.tensors import tt_to_cov, cholesky_robust, tt_to_bounded, tt_to_num, solve_lower_triangular, \
+    solve_upper_triangular
 from ..libs.plots import plot_text, show, grid2d, plot_2d
 
 
@@ -59,6 +60,11 @@ class EllipticalProcess(StochasticProcess):
 
     def th_define_process(self):
         #print('stochastic_define_process')
+        self.th_define_prior()
+        self.th_define_posterior()
+        self.th_define_marginals()
+
+    def th_define_prior(self):
         # Basic Tensors
         self.mapping_outputs = tt_to_num(self.f_mapping.inv(self.th_outputs))
         self.mapping_latent = tt_to_num(self.f_mapping(self.th_outputs))
@@ -70,6 +76,7 @@ class EllipticalProcess(StochasticProcess):
         self.prior_kernel_space = tt_to_cov(self.f_kernel_noise.cov(self.th_space))
         self.prior_kernel_inputs = tt_to_cov(self.f_kernel_noise.cov(self.th_inputs))
         self.prior_cholesky_space = cholesky_robust(self.prior_kernel_space)
+        self.prior_cholesky_inputs = cholesky_robust(self.prior_kernel_inputs)
 
         self.prior_kernel_f_space = self.f_kernel.cov(self.th_space)
         self.prior_kernel_f_inputs = self.f_kernel.cov(self.th_inputs)
@@ -78,23 +85,42 @@ class EllipticalProcess(StochasticProcess):
         self.cross_kernel_space_inputs = tt_to_num(self.f_kernel_noise.cov(self.th_space, self.th_inputs))
         self.cross_kernel_f_space_inputs = tt_to_num(self.f_kernel.cov(self.th_space, self.th_inputs))
 
-        self.posterior_location_space = self.prior_location_space + self.cross_kernel_space_inputs.dot(
-            tsl.solve(self.prior_kernel_inputs, self.mapping_outputs - self.prior_location_inputs))
-        self.posterior_location_f_space = self.prior_location_space + self.cross_kernel_f_space_inputs.dot(
-            tsl.solve(self.prior_kernel_inputs, self.mapping_outputs - self.prior_location_inputs))
-
-        self.posterior_kernel_space = self.prior_kernel_space - self.cross_kernel_space_inputs.dot(
-            tsl.solve(self.prior_kernel_inputs, self.cross_kernel_space_inputs.T))
+    def th_define_posterior(self):
+        """
+        Posterior engine: the input kernel is factorized once (prior_cholesky_inputs) and every posterior
+        location and kernel is obtained from that factor through triangular solves.
+        """
+        self.prior_delta_inputs = self.mapping_outputs - self.prior_location_inputs
+        self.prior_alpha_inputs = solve_upper_triangular(self.prior_cholesky_inputs.T,
+                                                         solve_lower_triangular(self.prior_cholesky_inputs,
+                                                                                self.prior_delta_inputs))
+        self.posterior_solve_space = solve_lower_triangular(self.prior_cholesky_inputs, self.cross_kernel_space_inputs.T)
+        self.posterior_solve_f_space = solve_lower_triangular(self.prior_cholesky_inputs, self.cross_kernel_f_space_inputs.T)
+
+        self.posterior_location_space = self.prior_location_space + self.cross_kernel_space_inputs.dot(self.prior_alpha_inputs)
+        self.posterior_location_f_space = self.prior_location_space + self.cross_kernel_f_space_inputs.dot(self.prior_alpha_inputs)
+
+        self.posterior_explained_space = tt.sum(self.posterior_solve_space ** 2, axis=0)
+        self.posterior_explained_f_space = tt.sum(self.posterior_solve_f_space ** 2, axis=0)
+
+        self.posterior_kernel_space = self.prior_kernel_space - self.posterior_solve_space.T.dot(self.posterior_solve_space)
         self.posterior_cholesky_space = cholesky_robust(self.posterior_kernel_space)
 
-        self.posterior_kernel_f_space = self.prior_kernel_f_space - self.cross_kernel_f_space_inputs.dot(
-            tsl.solve(self.prior_kernel_inputs, self.cross_kernel_f_space_inputs.T))
+        self.posterior_kernel_f_space = self.prior_kernel_f_space - self.posterior_solve_f_space.T.dot(self.posterior_solve_f_space)
         self.posterior_cholesky_f_space = cholesky_robust(self.posterior_kernel_f_space)
 
-        self.prior_kernel_diag_space = tt_to_bounded(tnl.extract_diag(self.prior_kernel_space), zero32)
-        self.prior_kernel_diag_f_space = tt_to_bounded(tnl.extract_diag(self.prior_kernel_f_space), zero32)
-        self.posterior_kernel_diag_space = tt_to_bounded(tnl.extract_diag(self.posterior_kernel_space), zero32)
-        self.posterior_kernel_diag_f_space = tt_to_bounded(tnl.extract_diag(self.posterior_kernel_f_space), zero32)
+    def th_define_marginals(self):
+        """
+        Diagonal-only graph: the marginal variances never build a dense space x space matrix. The posterior
+        variances are the prior ones minus the variance explained by the observations (posterior_explained_*),
+        i.e. the column sums of the squared solved cross-kernel.
+        """
+        self.prior_kernel_diag_space = tt_to_bounded(tt_to_num(self.f_kernel_noise.cov_diag(self.th_space)), zero32)
+        self.prior_kernel_diag_f_space = tt_to_bounded(tt_to_num(self.f_kernel.cov_diag(self.th_space)), zero32)
+        self.posterior_kernel_diag_space = tt_to_bounded(self.prior_kernel_diag_space -
+                                                         self.posterior_explained_space, zero32)
+        self.posterior_kernel_diag_f_space = tt_to_bounded(self.prior_kernel_diag_f_space -
+                                                           self.posterior_explained_f_space, zero32)
 
         self.prior_kernel_sd_space = tt.sqrt(self.prior_kernel_diag_space)
         self.prior_kernel_sd_f_space = tt.sqrt(self.prior_kernel_diag_f_space)
@@ -139,6 +165,12 @@ class EllipticalProcess(StochasticProcess):
             else:
                 return self.posterior_kernel_f_space
 
+    def th_cross_kernel(self, prior=False, noise=False):
+        if noise:
+            return self.cross_kernel_space_inputs
+        else:
+            return self.cross_kernel_f_space_inputs
+
     def th_cholesky(self, prior=False, noise=False):
         if prior:
             if noise:
@@ -210,6 +242,7 @@ class EllipticalProcess(StochasticProcess):
         self.mapping_inv = types.MethodType(self._method_name('th_mapping_inv'), self)
         self.location = types.MethodType(self._method_name('th_location'), self)
         self.kernel = types.MethodType(self._method_name('th_kernel'), self)
+        self.cross_kernel = types.MethodType(self._method_name('th_cross_kernel'), self)
         self.cholesky = types.MethodType(self._method_name('th_cholesky'), self)
         self.kernel_diag = types.MethodType(self._method_name('th_kernel_diag'), self)
         self.kernel_sd = types.MethodType(self._method_name('th_kernel_sd'), self)
@@ -0,0 +1,150 @@
+"""This module contains the product-of-experts / Bayesian committee machine approximation of a Gaussian Process.
+    """
+
+import numpy as np
+import theano as th
+import theano.tensor as tt
+import theano.tensor.nlinalg as tnl
+from .gaussian import GaussianProcess, ExpertsWarpedGaussianDistribution
+from .stochastic import zero32
+from ..libs.linalg import experts_partition
+from ..libs.tensors import cholesky_robust, tt_to_bounded, tt_to_cov, tt_to_num, solve_lower_triangular, \
+    solve_upper_triangular
+
+
+class ExpertsGaussianProcess(GaussianProcess):
+    """ Gaussian Process whose observations are split into blocks, each one modelled by an independent expert
+    with the shared hyperparameters. The log p is the sum of the log p of the experts, factorized in parallel
+    over a pool of threads, and the predictions of the experts are combined with the product of experts (poe),
+    the generalized product of experts (gpoe), the Bayesian committee machine (bcm) or the robust Bayesian
+    committee machine (rbcm). The cost is O(sum n_k^3) instead of O(N^3).
+
+    The predictions only give the marginal variances, so the posterior covariance is diagonal.
+
+    Attributes:
+        The atributes are inherited from the GaussianProcess class.
+        experts (int): the number of blocks (experts).
+        partition (str): 'kmeans' to cluster the inputs, or 'chunks' to split them in contiguous chunks.
+        combine (str): the rule that combines the predictions, 'poe', 'gpoe', 'bcm' or 'rbcm' (default).
+        threads (int): the number of threads among which the experts are evaluated (None for all the cores).
+        seed (int): the seed of the k-means partition.
+        jitter (float): the lower bound of the variances of the experts.
+    """
+    def __init__(self, *args, experts=8, partition='kmeans', combine='rbcm', threads=None, seed=0, jitter=1e-6,
+                 **kwargs):
+        if 'name' not in kwargs:
+            kwargs['name'] = 'EGP'
+        if partition not in ['kmeans', 'chunks']:
+            raise ValueError('partition must be kmeans or chunks: ' + str(partition))
+        if combine not in ['poe', 'gpoe', 'bcm', 'rbcm']:
+            raise ValueError('combine must be poe, gpoe, bcm or rbcm: ' + str(combine))
+        kwargs['toeplitz'] = False
+        self.nexperts = experts
+        self.partition = partition
+        self.combine = combine
+        self.threads = threads
+        self.seed = seed
+        self.jitter = np.float32(jitter)
+        self.th_experts = [th.shared(np.array([0], dtype=np.int64), name=kwargs['name'] + '_expert' + str(k),
+                                     borrow=False) for k in range(experts)]
+        super().__init__(*args, **kwargs)
+
+    def set_experts(self, inputs):
+        """Splits the inputs among the experts"""
+        for th_index, index in zip(self.th_experts, experts_partition(inputs, self.nexperts, self.partition,
+                                                                       self.seed)):
+            th_index.set_value(index.astype(np.int64))
+
+    def set_space(self, space=None, hidden=None, order=None, inputs=None, outputs=None, index=None):
+        super().set_space(space=space, hidden=hidden, order=order, inputs=inputs, outputs=outputs, index=index)
+        if inputs is not None:
+            self.set_experts(self.inputs)
+
+    def observed(self, inputs=None, *args, **kwargs):
+        if inputs is not None and len(inputs) < self.nexperts:
+            raise ValueError('there are less inputs than experts: ' + str(len(inputs)))
+        super().observed(inputs, *args, **kwargs)
+
+    def predict(self, params=None, space=None, inputs=None, *args, **kwargs):
+        if inputs is None:
+            return super().predict(params, space, inputs, *args, **kwargs)
+        reset = [i.get_value() for i in self.th_experts]
+        self.set_experts(inputs.reshape(len(inputs), -1))
+        try:
+            return super().predict(params, space, inputs, *args, **kwargs)
+        finally:
+            for th_index, index in zip(self.th_experts, reset):
+                th_index.set_value(index)
+
+    def th_experts_combine(self, crosses, prior_diag):
+        """
+        Combines the predictions of the experts given their cross kernels with the space.
+        :return: the location (minus the prior one) and the explained variance
+        """
+        solves = [solve_lower_triangular(cho, c.T) for cho, c in zip(self.experts_cholesky_inputs, crosses)]
+        means = [c.dot(alpha) for c, alpha in zip(crosses, self.experts_alpha_inputs)]
+        variances = [tt_to_bounded(prior_diag - tt.sum(s ** 2, axis=0), self.jitter) for s in solves]
+
+        if self.combine == 'rbcm':
+            betas = [np.float32(0.5) * (tt.log(prior_diag) - tt.log(v)) for v in variances]
+        elif self.combine == 'gpoe':
+            betas = [np.float32(1.0 / self.nexperts)] * self.nexperts
+        else:
+            betas = [np.float32(1)] * self.nexperts
+
+        precision = tt.add(*[b / v for b, v in zip(betas, variances)])
+        if self.combine in ['bcm', 'rbcm']:
+            precision = precision + (np.float32(1) - tt.add(*betas)) / prior_diag
+        precision = tt_to_bounded(precision, np.float32(1) / prior_diag)
+        location = tt.add(*[b * m / v for b, m, v in zip(betas, means, variances)]) / precision
+        return location, prior_diag - np.float32(1) / precision
+
+    def th_define_posterior(self):
+        """
+        Posterior engine: only the kernel of the inputs of each expert is factorized, and the location and
+        marginal variance of the experts are combined point by point.
+        """
+        super().th_define_posterior()
+        self.experts_inputs = [self.th_inputs[index] for index in self.th_experts]
+        self.experts_kernel_inputs = [tt_to_cov(self.f_kernel_noise.cov(x)) for x in self.experts_inputs]
+        self.experts_cholesky_inputs = [cholesky_robust(k) for k in self.experts_kernel_inputs]
+        self.experts_alpha_inputs = [solve_upper_triangular(
+            cho.T, solve_lower_triangular(cho, self.prior_delta_inputs[i]))
+            for cho, i in zip(self.experts_cholesky_inputs, self.th_experts)]
+
+        diag_space = tt_to_bounded(tt_to_num(self.f_kernel_noise.cov_diag(self.th_space)), self.jitter)
+        diag_f_space = tt_to_bounded(tt_to_num(self.f_kernel.cov_diag(self.th_space)), self.jitter)
+        location, self.posterior_explained_space = self.th_experts_combine(
+            [tt_to_num(self.f_kernel_noise.cov(self.th_space, x)) for x in self.experts_inputs], diag_space)
+        location_f, self.posterior_explained_f_space = self.th_experts_combine(
+            [tt_to_num(self.f_kernel.cov(self.th_space, x)) for x in self.experts_inputs], diag_f_space)
+        self.posterior_location_space = self.prior_location_space + location
+        self.posterior_location_f_space = self.prior_location_space + location_f
+
+        sd_space = tt.sqrt(tt_to_bounded(diag_space - self.posterior_explained_space, zero32))
+        sd_f_space = tt.sqrt(tt_to_bounded(diag_f_space - self.posterior_explained_f_space, zero32))
+        self.posterior_kernel_space = tnl.alloc_diag(sd_space ** 2)
+        self.posterior_cholesky_space = tnl.alloc_diag(sd_space)
+        self.posterior_kernel_f_space = tnl.alloc_diag(sd_f_space ** 2)
+        self.posterior_cholesky_f_space = tnl.alloc_diag(sd_f_space)
+
+    def th_define_process(self):
+        """
+        The distribution of the outputs is the product of the independent distributions of the experts.
+        """
+        super(GaussianProcess, self).th_define_process()
+        self.distribution = ExpertsWarpedGaussianDistribution(self.name, mu=self.prior_location_inputs,
+                                                              covs=self.experts_kernel_inputs, index=self.th_experts,
+                                                              threads=self.threads, mapping=self.f_mapping,
+                                                              observed=self.th_outputs, testval=self.outputs,
+                                                              dtype=th.config.floatX)
+
+    def th_cross_mean(self, prior=False, noise=False, cross_kernel=None):
+        if prior:
+            return self.prior_location_space
+        if cross_kernel is None:
+            return self.posterior_location_f_space
+        diag_space = tt_to_bounded(tt_to_num(cross_kernel.cov_diag(self.th_space_)), self.jitter)
+        location, _ = self.th_experts_combine([tt_to_num(cross_kernel.cov(self.th_space_, x))
+                                               for x in self.experts_inputs], diag_space)
+        return self.prior_location_space + location
@@ -0,0 +1,127 @@
+"""This module contains the random Fourier features approximation of a Gaussian Process.
+    """
+
+import types
+import numpy as np
+import theano as th
+import theano.tensor as tt
+from .gaussian import GaussianProcess, LowRankWarpedGaussianDistribution
+from ..libs.tensors import cholesky_robust, tt_to_bounded, tt_to_num, solve_lower_triangular, solve_upper_triangular
+
+
+class FourierGaussianProcess(GaussianProcess):
+    """ Gaussian Process whose kernel is replaced by a random Fourier features map, k(x, y) ~ phi(x)^T phi(y), with
+    the frequencies sampled from the spectral density of the stationary kernels (SE, MAT32, MAT52, RQ, SM and
+    their sums and scales). The process is a Bayesian linear regression over the features, so the log p and the
+    posterior cost O(N D^2) and the samples O(D) per point.
+
+    Attributes:
+        The atributes are inherited from the GaussianProcess class.
+        features (int): the number D of features (D/2 frequencies for each stationary kernel, with cos and sin).
+        seed (int): the seed of the random frequencies, fixed for the whole life of the process.
+        jitter (float): the lower bound of the diagonal noise.
+    """
+    def __init__(self, *args, features=256, seed=0, jitter=1e-6, **kwargs):
+        if 'name' not in kwargs:
+            kwargs['name'] = 'FGP'
+        kwargs['toeplitz'] = False
+        self.nfeatures = features
+        self.seed = seed
+        self.jitter = np.float32(jitter)
+        super().__init__(*args, **kwargs)
+
+    def _check_hypers(self):
+        super()._check_hypers()
+        self.fourier_frequencies = self.f_kernel.fourier(self.nfeatures // 2, np.random.RandomState(self.seed))
+        if not self.fourier_frequencies:
+            raise ValueError('the kernel has not random Fourier features: ' + str(self.f_kernel))
+
+    def th_features(self, x):
+        """Random Fourier features of x, a (len(x) x D) matrix"""
+        features = []
+        for var, omega, dims in self.fourier_frequencies:
+            proj = x[:, dims].dot(omega.T)
+            scale = tt.sqrt(var / np.float32(self.nfeatures // 2))
+            features += [scale * tt.cos(proj), scale * tt.sin(proj)]
+        return tt_to_num(tt.concatenate(features, axis=1))
+
+    def th_define_posterior(self):
+        """
+        Posterior engine: Bayesian linear regression over the features with a diagonal noise; only the D x D matrix
+        B = I + A^T A is factorized, with A the features of the inputs scaled by the noise.
+        """
+        super().th_define_posterior()
+        self.fourier_features_inputs = self.th_features(self.th_inputs)
+        self.fourier_features_space = self.th_features(self.th_space)
+
+        self.fourier_diag_inputs = tt_to_bounded(tt_to_num(self.f_kernel_noise.cov_diag(self.th_inputs)) -
+                                                 tt.sum(self.fourier_features_inputs ** 2, axis=1), self.jitter)
+        sqrt_diag = tt.sqrt(self.fourier_diag_inputs)
+        scaled = self.fourier_features_inputs / sqrt_diag[:, None]
+        beta = self.prior_delta_inputs / sqrt_diag
+        self.fourier_cholesky = cholesky_robust(tt.eye(scaled.shape[1]) + scaled.T.dot(scaled))
+        self.fourier_weights = solve_upper_triangular(self.fourier_cholesky.T,
+                                                      solve_lower_triangular(self.fourier_cholesky, scaled.T.dot(beta)))
+        self.prior_alpha_inputs = (beta - scaled.dot(self.fourier_weights)) / sqrt_diag
+
+        self.fourier_solve_space = solve_lower_triangular(self.fourier_cholesky, self.fourier_features_space.T)
+        self.fourier_factor_space = self.fourier_solve_space.T
+
+        self.posterior_location_f_space = self.prior_location_space + \
+                                          self.fourier_features_space.dot(self.fourier_weights)
+        self.posterior_location_space = self.posterior_location_f_space
+
+        self.posterior_explained_f_space = tt_to_num(self.f_kernel.cov_diag(self.th_space)) - \
+                                           tt.sum(self.fourier_solve_space ** 2, axis=0)
+        self.posterior_explained_space = self.posterior_explained_f_space
+
+        self.posterior_kernel_f_space = self.fourier_solve_space.T.dot(self.fourier_solve_space)
+        self.posterior_cholesky_f_space = cholesky_robust(self.posterior_kernel_f_space)
+        self.posterior_kernel_space = self.posterior_kernel_f_space + self.prior_kernel_space - self.prior_kernel_f_space
+        self.posterior_cholesky_space = cholesky_robust(self.posterior_kernel_space)
+
+    def th_define_process(self):
+        """
+        The distribution of the outputs is N(mu, Phi Phi^T + diag(noise)), evaluated with the Woodbury identity.
+        """
+        super(GaussianProcess, self).th_define_process()
+        self.distribution = LowRankWarpedGaussianDistribution(self.name, mu=self.prior_location_inputs,
+                                                              factor=self.fourier_features_inputs,
+                                                              diag=self.fourier_diag_inputs,
+                                                              mapping=self.f_mapping, observed=self.th_outputs,
+                                                              testval=self.outputs, dtype=th.config.floatX)
+
+    def th_fourier_factor(self, prior=False, noise=False):
+        """Factor F of the kernel of the latent process on the space, K = F F^T, with D columns"""
+        if prior:
+            return self.fourier_features_space
+        return self.fourier_factor_space
+
+    def th_fourier_noise(self, prior=False, noise=False):
+        return tt_to_num(self.f_kernel_noise.cov_diag(self.th_space) - self.f_kernel.cov_diag(self.th_space))
+
+    def th_cross_mean(self, prior=False, noise=False, cross_kernel=None):
+        if prior:
+            return self.prior_location_space
+        if cross_kernel is None:
+            return self.posterior_location_f_space
+        return super().th_cross_mean(prior=prior, noise=noise, cross_kernel=cross_kernel)
+
+    def _compile_methods(self, *args, **kwargs):
+        super()._compile_methods(*args, **kwargs)
+        self.fourier_factor = types.MethodType(self._method_name('th_fourier_factor'), self)
+        self.fourier_noise = types.MethodType(self._method_name('th_fourier_noise'), self)
+
+    def sampler(self, params=None, space=None, inputs=None, outputs=None, samples=1, prior=False, noise=False):
+        """
+        Samples through the D features, f = m + F w with w ~ N(0, I), without any factorization on the space.
+        """
+        if space is None:
+            space = self.space
+        factor = self.fourier_factor(params, space, inputs, outputs, prior=prior, noise=noise)
+        gp_samples = self.location(params, space, inputs, outputs, prior=prior, noise=noise)[:, None] + \
+                     factor.dot(np.random.randn(factor.shape[1], samples))
+        if noise:
+            gp_samples += np.sqrt(self.fourier_noise(params, space, inputs, outputs))[:, None] * \
+                          np.random.randn(len(space), samples)
+        return np.array([self.mapping(params, space, inputs, outputs=k.T) for k in gp_samples.T]).T
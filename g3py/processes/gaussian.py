@@ -11,8 +11,12 @@ import theano.tensor.nlinalg as tnl
 from scipy import stats
 from theano.ifelse import ifelse
 from .elliptical import EllipticalProcess, debug_p
+from ..libs import DictObj
+from ..libs.linalg import OnlineCholesky
 from .hypers.mappings import Identity
-from ..libs.tensors import cholesky_robust, debug, tt_to_bounded, tt_eval
+from ..libs.tensors import cholesky_robust, debug, tt_to_bounded, tt_to_num, tt_eval, solve_lower_triangular, \
+    solve_toeplitz, logdet_toeplitz, kron_mv, statespace_model, kalman_filter, SolveCG, LogdetSLQ, \
+    VecchiaNeighbours, batched_solve, ExpertsLogp
 
 
 class GaussianProcess(EllipticalProcess):
@@ -20,13 +24,105 @@ class GaussianProcess(EllipticalProcess):
 
     Attributes:
     The atributes are inherited from the EllipticalProcess class.
+    toeplitz (bool): use the Toeplitz (Levinson/Durbin) solvers instead of the cholesky decomposition of the
+        input kernel, O(N^2) instead of O(N^3), which pays off for large N. If None, they are used when the space
+        is 1-D, the kernel is stationary and the inputs are regularly spaced. By default (False), they are not used,
+        and the exact Hessian (th_d2logp) is only available without them.
+    solver (str): 'cholesky' (default) or 'iterative'. The iterative solver replaces the cholesky decomposition of
+        the input kernel by conjugate gradients for the solves and stochastic Lanczos quadrature for the
+        log-determinant, using only products with the kernel.
+    tol (float): the relative tolerance of the conjugate gradients.
+    probes (int): the number of random probes of the stochastic estimators of the log-determinant and its gradient.
+    lanczos (int): the number of Lanczos steps for each probe.
+    vecchia (int): if given, the log p is the Vecchia approximation that conditions each output only on the outputs
+        of its vecchia nearest previous inputs, O(N k^3) instead of O(N^3). The neighbours are searched once for
+        each inputs array.
 
     """
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, toeplitz=False, solver='cholesky', tol=1e-4, probes=16, lanczos=32, vecchia=None,
+                 **kwargs):
         if 'name' not in kwargs:
             kwargs['name'] = 'GP'
+        if solver not in ['cholesky', 'iterative']:
+            raise ValueError('solver must be cholesky or iterative: ' + str(solver))
+        self.toeplitz = toeplitz
+        self.solver = solver
+        self.online_state = None
+        self.iterative = None
+        self.vecchia = vecchia
+        if solver == 'iterative':
+            self.iterative = {'tol': tol, 'probes': probes, 'lanczos': lanczos}
         super().__init__(*args, **kwargs)
 
+    def th_toeplitz(self):
+        """
+        Condition of the Toeplitz fast path: None if it can not be used, True if it is forced, and otherwise
+        a symbolic condition checking that the inputs are regularly spaced.
+        """
+        if self.toeplitz is False or self.nspace != 1 or not self.f_kernel_noise.stationary:
+            return None
+        if self.toeplitz is True:
+            return True
+        step = tt.extra_ops.diff(self.th_inputs[:, 0])
+        return tt.all(tt.le(tt.abs_(step - tt.mean(step)), np.float32(1e-4) * tt.abs_(tt.mean(step))))
+
+    def th_define_posterior(self):
+        super().th_define_posterior()
+        if self.iterative is not None:
+            self.th_define_posterior_iterative()
+        self.prior_toeplitz_inputs = self.th_toeplitz()
+        self.prior_column_inputs = None
+        if self.prior_toeplitz_inputs is None:
+            return
+        cond = self.prior_toeplitz_inputs
+
+        def fast(toeplitz, dense):
+            if cond is True:
+                return toeplitz
+            return ifelse(cond, toeplitz, dense)
+
+        self.prior_column_inputs = tt_to_num(self.f_kernel_noise.cov_column(self.th_inputs))
+        weights_space = solve_toeplitz(self.prior_column_inputs, self.cross_kernel_space_inputs.T)
+        weights_f_space = solve_toeplitz(self.prior_column_inputs, self.cross_kernel_f_space_inputs.T)
+
+        self.prior_alpha_inputs = fast(solve_toeplitz(self.prior_column_inputs, self.prior_delta_inputs),
+                                       self.prior_alpha_inputs)
+        self.posterior_location_space = self.prior_location_space + self.cross_kernel_space_inputs.dot(self.prior_alpha_inputs)
+        self.posterior_location_f_space = self.prior_location_space + self.cross_kernel_f_space_inputs.dot(self.prior_alpha_inputs)
+
+        self.posterior_explained_space = fast(tt.sum(self.cross_kernel_space_inputs.T * weights_space, axis=0),
+                                              self.posterior_explained_space)
+        self.posterior_explained_f_space = fast(tt.sum(self.cross_kernel_f_space_inputs.T * weights_f_space, axis=0),
+                                                self.posterior_explained_f_space)
+
+        self.posterior_kernel_space = fast(self.prior_kernel_space - self.cross_kernel_space_inputs.dot(weights_space),
+                                           self.posterior_kernel_space)
+        self.posterior_cholesky_space = cholesky_robust(self.posterior_kernel_space)
+        self.posterior_kernel_f_space = fast(self.prior_kernel_f_space - self.cross_kernel_f_space_inputs.dot(weights_f_space),
+                                             self.posterior_kernel_f_space)
+        self.posterior_cholesky_f_space = cholesky_robust(self.posterior_kernel_f_space)
+
+    def th_define_posterior_iterative(self):
+        """
+        Posterior engine of the iterative solver: every solve with the input kernel is a (blocked) conjugate
+        gradients, so the input kernel is never factorized.
+        """
+        solve = SolveCG(tol=self.iterative['tol'])
+        weights_space = solve(self.prior_kernel_inputs, self.cross_kernel_space_inputs.T)
+        weights_f_space = solve(self.prior_kernel_inputs, self.cross_kernel_f_space_inputs.T)
+
+        self.prior_alpha_inputs = solve(self.prior_kernel_inputs, self.prior_delta_inputs)
+        self.posterior_location_space = self.prior_location_space + self.cross_kernel_space_inputs.dot(self.prior_alpha_inputs)
+        self.posterior_location_f_space = self.prior_location_space + self.cross_kernel_f_space_inputs.dot(self.prior_alpha_inputs)
+
+        self.posterior_explained_space = tt.sum(self.cross_kernel_space_inputs.T * weights_space, axis=0)
+        self.posterior_explained_f_space = tt.sum(self.cross_kernel_f_space_inputs.T * weights_f_space, axis=0)
+
+        self.posterior_kernel_space = self.prior_kernel_space - self.cross_kernel_space_inputs.dot(weights_space)
+        self.posterior_cholesky_space = cholesky_robust(self.posterior_kernel_space)
+        self.posterior_kernel_f_space = self.prior_kernel_f_space - self.cross_kernel_f_space_inputs.dot(weights_f_space)
+        self.posterior_cholesky_f_space = cholesky_robust(self.posterior_kernel_f_space)
+
     def th_define_process(self):
         """
         This function defines the process using the method .th_define_process() from
@@ -34,10 +130,103 @@ class GaussianProcess(EllipticalProcess):
         """
         #print('gaussian_define_process')
         super().th_define_process()
+        if self.vecchia is not None:
+            neighbours = VecchiaNeighbours(self.vecchia)(self.th_inputs)
+            self.distribution = VecchiaWarpedGaussianDistribution(self.name, mu=self.prior_location_inputs,
+                                                                  inputs=self.th_inputs, kernel=self.f_kernel_noise,
+                                                                  neighbours=neighbours, mapping=self.f_mapping,
+                                                                  observed=self.th_outputs, testval=self.outputs,
+                                                                  dtype=th.config.floatX)
+            return
         self.distribution = WarpedGaussianDistribution(self.name, mu=self.prior_location_inputs,
-                                                       cov=self.prior_kernel_inputs, mapping=self.f_mapping,
-                                                       observed=self.th_outputs, testval=self.outputs,
-                                                       dtype=th.config.floatX)
+                                                       cov=self.prior_kernel_inputs, cho=self.prior_cholesky_inputs,
+                                                       column=self.prior_column_inputs, iterative=self.iterative,
+                                                       toeplitz=self.prior_toeplitz_inputs, mapping=self.f_mapping, observed=self.th_outputs,
+                                                       testval=self.outputs, dtype=th.config.floatX)
+
+    def online(self, params=None, window=None):
+        """
+        Starts the online mode at fixed hyperparameters: the cholesky of the input kernel is computed once, and then
+        observed(..., append=True) appends the new observations (and expires the oldest ones beyond the window) with
+        O(N^2) updates, so the posterior location and variances of predict cost O(N^2) per new point.
+        :param params: the fixed hyperparameters, by default the current ones
+        :param window: the maximum number of observations kept, None for all of them
+        """
+        if params is None:
+            params = self.params
+        self.online_params = params
+        self.online_state = OnlineCholesky(self.cholesky(params, space=self.inputs, prior=True, noise=True),
+                                           window=window)
+        n = self.online_state.expire()
+        if n > 0:
+            super().observed(inputs=self.inputs[n:], outputs=self.outputs[n:])
+
+    def offline(self):
+        """Stops the online mode, so the cholesky is computed by the compiled functions again"""
+        self.online_state = None
+
+    def observed(self, inputs=None, outputs=None, order=None, index=None, hidden=None, append=False):
+        """
+        Asign the observations to the gp. In online mode, append=True adds them to the current observations and
+        updates the cholesky of the input kernel instead of recomputing it.
+        """
+        if not append or self.online_state is None or not self.is_observed:
+            super().observed(inputs=inputs, outputs=outputs, order=order, index=index, hidden=hidden)
+            if self.online_state is not None:
+                self.online(self.online_params, self.online_state.window)
+            return
+        if len(inputs.shape) < 2:
+            inputs = inputs.reshape(len(inputs), 1)
+        if len(outputs.shape) > 1:
+            outputs = outputs.reshape(len(outputs))
+        params = self.online_params
+        self.online_state.append(self.cross_kernel(params, space=self.inputs, inputs=inputs, noise=True),
+                                 self.kernel(params, space=inputs, prior=True, noise=True))
+        inputs = np.concatenate([self.inputs, inputs])
+        outputs = np.concatenate([self.outputs, outputs])
+        n = self.online_state.expire()
+        super().observed(inputs=inputs[n:], outputs=outputs[n:], order=order, hidden=hidden)
+
+    def online_predict(self, space=None, mean=True, std=True, var=False, median=False, noise=False):
+        """
+        Posterior location and marginal variances through the online cholesky, in O(N^2) per point of the space
+        """
+        if space is None:
+            space = self.space
+        if len(space.shape) < 2:
+            space = space.reshape(len(space), 1)
+        params = self.online_params
+        inputs, outputs = self.inputs, self.outputs
+        delta = self.mapping_inv(params, space, inputs, outputs) - \
+                self.location(params, inputs, inputs, outputs, prior=True)
+        solve_space = self.online_state.solve_lower(self.cross_kernel(params, space, inputs, outputs, noise=noise).T)
+        location = self.location(params, space, inputs, outputs, prior=True) + \
+                   solve_space.T.dot(self.online_state.solve_lower(delta))
+        variance = np.maximum(self.kernel_diag(params, space, inputs, outputs, prior=True, noise=noise) -
+                              np.sum(solve_space ** 2, axis=0), 0)
+        values = DictObj()
+        if mean:
+            values['mean'] = self.mapping(params, space, inputs, outputs=location)
+        if var:
+            values['variance'] = variance
+        if std:
+            values['std'] = np.sqrt(variance)
+        if median:
+            values['median'] = self.mapping(params, space, inputs, outputs=location)
+        return values
+
+    def predict(self, params=None, space=None, inputs=None, outputs=None, mean=True, std=True, var=False, cov=False,
+                median=False, quantiles=False, quantiles_noise=False, samples=0, distribution=False,
+                prior=False, noise=False, simulations=None):
+        online = self.online_state is not None and self.is_observed and not prior and params is None and \
+                 inputs is None and outputs is None and type(self).th_mean is EllipticalProcess.th_mean and \
+                 not (cov or quantiles or quantiles_noise or samples > 0 or distribution or simulations is not None)
+        if online:
+            return self.online_predict(space=space, mean=mean, std=std, var=var, median=median, noise=noise)
+        return super().predict(params=params, space=space, inputs=inputs, outputs=outputs, mean=mean, std=std,
+                               var=var, cov=cov, median=median, quantiles=quantiles, quantiles_noise=quantiles_noise,
+                               samples=samples, distribution=distribution, prior=prior, noise=noise,
+                               simulations=simulations)
 
     def th_logpredictive(self, prior=False, noise=False):
         """ Call a classmethod of class WarpedGaussianDistribution
@@ -53,6 +242,10 @@ class GaussianProcess(EllipticalProcess):
                                                    cho=self.th_cholesky_diag(prior=prior, noise=True),
                                                    mapping=self.f_mapping)
 
+    def th_quantiler(self, q=0.975, prior=False, noise=False):
+        return self.f_mapping(self.th_location(prior=prior, noise=noise) +
+                              np.float32(stats.norm.ppf(q)) * self.th_kernel_sd(prior=prior, noise=noise))
+
     def quantiler(self, params=None, space=None, inputs=None, outputs=None, q=0.975, prior=False, noise=False, simulations=None):
         """
         This method set the supper attribute mapping.
@@ -108,8 +301,7 @@ class GaussianProcess(EllipticalProcess):
             return self.prior_location_space
         if cross_kernel is None:
             cross_kernel = self.f_kernel
-        return self.prior_location_space + cross_kernel.cov(self.th_space_, self.th_inputs_).dot(
-            tsl.solve(self.prior_kernel_inputs, self.mapping_outputs - self.prior_location_inputs))
+        return self.prior_location_space + cross_kernel.cov(self.th_space_, self.th_inputs_).dot(self.prior_alpha_inputs)
 
 
 class WarpedGaussianProcess(GaussianProcess):
@@ -181,12 +373,20 @@ class WarpedGaussianDistribution(pm.Continuous):
         It inherits the atributes from the supper class pm.Continuous
         mu: the location of the distribution
         cov: the scale of the distribution (dispersion matrix)
+        cho: the cholesky decomposition of cov, if it was already computed by the process
+        column: the first column of cov, when it is a symmetric Toeplitz matrix
+        toeplitz: the condition (True or symbolic) under which cov is Toeplitz and column is used
+        iterative: the options (tol, probes, lanczos) of the iterative solver, or None to use the cholesky
         mapping: the mapping of the warped. Default is Identity
     """
-    def __init__(self, mu, cov, mapping=Identity(), *args, **kwargs):
+    def __init__(self, mu, cov, cho=None, column=None, toeplitz=None, iterative=None, mapping=Identity(), *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.mean = self.median = self.mode = self.mu = mu
         self.cov = cov
+        self.cov_cho = cho
+        self.column = column
+        self.toeplitz = toeplitz
+        self.iterative = iterative
         self.mapping = mapping
 
     @classmethod
@@ -240,21 +440,418 @@ class WarpedGaussianDistribution(pm.Continuous):
                              ifelse(cond3, np.float32(-1e30),
                                     ifelse(cond4, np.float32(-1e30), r))))
 
+    @classmethod
+    def logp_toeplitz(cls, value, mu, column, mapping):
+        """
+        Calculates the log p of the parameters given the data, when the dispersion matrix is Toeplitz
+        :param value: the data
+        :param mu: the location (obtained from the hiperparameters)
+        :param column: the first column of the dispersion matrix
+        :param mapping: the mapping of the warped.
+        :return: it returns the value of the log p of the parameters given the data (values)
+        """
+        delta = mapping.inv(value) - mu
+        alpha = solve_toeplitz(column, delta)
+
+        npi = np.float32(-0.5) * column.shape[0].astype(th.config.floatX) * tt.log(np.float32(2.0 * np.pi))
+        dot2 = np.float32(-0.5) * delta.dot(alpha)
+        det_k = np.float32(-0.5) * logdet_toeplitz(column)
+        det_m = mapping.logdet_dinv(value)
+
+        r = npi + dot2 + det_k + det_m
+
+        cond1 = tt.or_(tt.any(tt.isinf_(delta)), tt.any(tt.isnan_(delta)))
+        cond2 = tt.or_(tt.any(tt.isinf_(det_m)), tt.any(tt.isnan_(det_m)))
+        cond3 = tt.or_(tt.isinf_(det_k), tt.isnan_(det_k))
+        cond4 = tt.or_(tt.any(tt.isinf_(alpha)), tt.any(tt.isnan_(alpha)))
+        return ifelse(cond1, np.float32(-1e30),
+                      ifelse(cond2, np.float32(-1e30),
+                             ifelse(cond3, np.float32(-1e30),
+                                    ifelse(cond4, np.float32(-1e30), r))))
+
+    @classmethod
+    def logp_iterative(cls, value, mu, cov, mapping, tol=1e-4, probes=16, lanczos=32):
+        """
+        Calculates the log p of the parameters given the data, with conjugate gradients for the quadratic term and
+        stochastic Lanczos quadrature for the log-determinant
+        :param value: the data
+        :param mu: the location (obtained from the hiperparameters)
+        :param cov: the dispersion matrix, only used through products
+        :param mapping: the mapping of the warped.
+        :param tol: the relative tolerance of the conjugate gradients
+        :param probes: the number of probes of the stochastic estimators
+        :param lanczos: the number of Lanczos steps for each probe
+        :return: it returns the value of the log p of the parameters given the data (values)
+        """
+        delta = mapping.inv(value) - mu
+        alpha = SolveCG(tol=tol)(cov, delta)
+
+        npi = np.float32(-0.5) * cov.shape[0].astype(th.config.floatX) * tt.log(np.float32(2.0 * np.pi))
+        dot2 = np.float32(-0.5) * delta.dot(alpha)
+        det_k = np.float32(-0.5) * LogdetSLQ(tol=tol, probes=probes, steps=lanczos)(cov)
+        det_m = mapping.logdet_dinv(value)
+
+        r = npi + dot2 + det_k + det_m
+
+        cond1 = tt.or_(tt.any(tt.isinf_(delta)), tt.any(tt.isnan_(delta)))
+        cond2 = tt.or_(tt.any(tt.isinf_(det_m)), tt.any(tt.isnan_(det_m)))
+        cond3 = tt.or_(tt.isinf_(det_k), tt.isnan_(det_k))
+        cond4 = tt.or_(tt.any(tt.isinf_(alpha)), tt.any(tt.isnan_(alpha)))
+        return ifelse(cond1, np.float32(-1e30),
+                      ifelse(cond2, np.float32(-1e30),
+                             ifelse(cond3, np.float32(-1e30),
+                                    ifelse(cond4, np.float32(-1e30), r))))
+
+    def logp_dense(self, value):
+        """
+        The log p for a general dispersion matrix, with the cholesky or with the iterative solver
+        :param value: the data
+        :return: evaluates the staticmethod logp_cho or logp_iterative
+        """
+        if self.iterative is None:
+            return self.logp_cho(value, self.mu, self.cho, self.mapping)
+        return self.logp_iterative(value, self.mu, self.cov, self.mapping, **self.iterative)
+
     def logp(self, value):
         """
-        It is a rapper of the fuction logp_cho
+        It is a rapper of the fuction logp_dense, or of logp_toeplitz when the dispersion matrix is Toeplitz
         :param value: the data
         :return: evaluates the staticmethod logp_cho
         """
-        return self.logp_cho(value, self.mu, self.cho, self.mapping)
+        if self.column is None or self.toeplitz is None:
+            return self.logp_dense(value)
+        if self.toeplitz is True:
+            return self.logp_toeplitz(value, self.mu, self.column, self.mapping)
+        return ifelse(self.toeplitz, self.logp_toeplitz(value, self.mu, self.column, self.mapping),
+                      self.logp_dense(value))
 
     @property
     def cho(self):
         """
-        Calculates the cholesky decomposition
+        Calculates the cholesky decomposition, reusing the one given at construction
         :return: the cholesky decomposition
         """
+        if self.cov_cho is not None:
+            return self.cov_cho
         try:
             return cholesky_robust(self.cov) #tt_to_num
         except:
-            raise sp.linalg.LinAlgError("not cholesky")
\ No newline at end of file
+            raise sp.linalg.LinAlgError("not cholesky")
+
+
+class LowRankWarpedGaussianDistribution(pm.Continuous):
+    """
+    Class used to define a warped gaussian distribution whose dispersion matrix is low rank plus diagonal,
+    cov = factor.dot(factor.T) + diag(diag). The log p is computed with the Woodbury identity in O(N*M^2).
+    Atributes:
+        It inherits the atributes from the supper class pm.Continuous
+        mu: the location of the distribution
+        factor: the N x M factor of the low rank part
+        diag: the N diagonal elements
+        trace: extra term substracted to the log p (e.g. the trace term of the variational bound)
+        mapping: the mapping of the warped. Default is Identity
+    """
+    def __init__(self, mu, factor, diag, trace=None, mapping=Identity(), *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mean = self.median = self.mode = self.mu = mu
+        self.factor = factor
+        self.diag = diag
+        self.trace = trace
+        self.mapping = mapping
+
+    @classmethod
+    def logp_lowrank(cls, value, mu, factor, diag, mapping, trace=None):
+        """
+        Calculates the log p of the parameters given the data
+        :param value: the data
+        :param mu: the location (obtained from the hiperparameters)
+        :param factor: the N x M factor of the low rank part of the dispersion matrix
+        :param diag: the diagonal part of the dispersion matrix
+        :param mapping: the mapping of the warped.
+        :param trace: extra term substracted to the log p
+        :return: it returns the value of the log p of the parameters given the data (values)
+        """
+        delta = mapping.inv(value) - mu
+        sqrt_diag = tt.sqrt(diag)
+        scaled = factor / sqrt_diag[:, None]
+        beta = delta / sqrt_diag
+        cho = cholesky_robust(tt.eye(factor.shape[1]) + scaled.T.dot(scaled))
+        lcho = solve_lower_triangular(cho, scaled.T.dot(beta))
+
+        npi = np.float32(-0.5) * factor.shape[0].astype(th.config.floatX) * tt.log(np.float32(2.0 * np.pi))
+        dot2 = np.float32(-0.5) * (beta.dot(beta) - lcho.dot(lcho))
+        det_k = - tt.sum(tt.log(tnl.diag(cho))) - np.float32(0.5) * tt.sum(tt.log(diag))
+        det_m = mapping.logdet_dinv(value)
+
+        r = npi + dot2 + det_k + det_m
+        if trace is not None:
+            r = r - trace
+
+        cond1 = tt.or_(tt.any(tt.isinf_(delta)), tt.any(tt.isnan_(delta)))
+        cond2 = tt.or_(tt.any(tt.isinf_(det_m)), tt.any(tt.isnan_(det_m)))
+        cond3 = tt.or_(tt.any(tt.isinf_(cho)), tt.any(tt.isnan_(cho)))
+        cond4 = tt.or_(tt.any(tt.isinf_(lcho)), tt.any(tt.isnan_(lcho)))
+        return ifelse(cond1, np.float32(-1e30),
+                      ifelse(cond2, np.float32(-1e30),
+                             ifelse(cond3, np.float32(-1e30),
+                                    ifelse(cond4, np.float32(-1e30), r))))
+
+    def logp(self, value):
+        """
+        It is a rapper of the fuction logp_lowrank
+        :param value: the data
+        :return: evaluates the staticmethod logp_lowrank
+        """
+        return self.logp_lowrank(value, self.mu, self.factor, self.diag, self.mapping, self.trace)
+
+
+class KroneckerWarpedGaussianDistribution(pm.Continuous):
+    """
+    Class used to define a warped gaussian distribution whose dispersion matrix has the eigendecomposition
+    cov = Q diag(eigenvalues) Q^T with Q = kron(Q_1, ..., Q_D), as the Gram matrix of a separable kernel on a grid
+    plus white noise. The log p costs O(N sum n_d) and the N x N matrix is never formed.
+    Atributes:
+        It inherits the atributes from the supper class pm.Continuous
+        mu: the location of the distribution
+        eigenvectors: the list of the per-axis eigenvectors Q_d
+        eigenvalues: the N eigenvalues of cov, already including the noise
+        mapping: the mapping of the warped. Default is Identity
+    """
+    def __init__(self, mu, eigenvectors, eigenvalues, mapping=Identity(), *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mean = self.median = self.mode = self.mu = mu
+        self.eigenvectors = eigenvectors
+        self.eigenvalues = eigenvalues
+        self.mapping = mapping
+
+    @classmethod
+    def logp_kronecker(cls, value, mu, eigenvectors, eigenvalues, mapping):
+        """
+        Calculates the log p of the parameters given the data
+        :param value: the data
+        :param mu: the location (obtained from the hiperparameters)
+        :param eigenvectors: the list of the per-axis eigenvectors of the dispersion matrix
+        :param eigenvalues: the eigenvalues of the dispersion matrix
+        :param mapping: the mapping of the warped.
+        :return: it returns the value of the log p of the parameters given the data (values)
+        """
+        delta = mapping.inv(value) - mu
+        rot = kron_mv([q.T for q in eigenvectors], delta)
+
+        npi = np.float32(-0.5) * eigenvalues.shape[0].astype(th.config.floatX) * tt.log(np.float32(2.0 * np.pi))
+        dot2 = np.float32(-0.5) * tt.sum(rot ** 2 / eigenvalues)
+        det_k = np.float32(-0.5) * tt.sum(tt.log(eigenvalues))
+        det_m = mapping.logdet_dinv(value)
+
+        r = npi + dot2 + det_k + det_m
+
+        cond1 = tt.or_(tt.any(tt.isinf_(delta)), tt.any(tt.isnan_(delta)))
+        cond2 = tt.or_(tt.any(tt.isinf_(det_m)), tt.any(tt.isnan_(det_m)))
+        cond3 = tt.or_(tt.isinf_(det_k), tt.isnan_(det_k))
+        cond4 = tt.or_(tt.any(tt.isinf_(rot)), tt.any(tt.isnan_(rot)))
+        return ifelse(cond1, np.float32(-1e30),
+                      ifelse(cond2, np.float32(-1e30),
+                             ifelse(cond3, np.float32(-1e30),
+                                    ifelse(cond4, np.float32(-1e30), r))))
+
+    def logp(self, value):
+        """
+        It is a rapper of the fuction logp_kronecker
+        :param value: the data
+        :return: evaluates the staticmethod logp_kronecker
+        """
+        return self.logp_kronecker(value, self.mu, self.eigenvectors, self.eigenvalues, self.mapping)
+
+
+class StateSpaceWarpedGaussianDistribution(pm.Continuous):
+    """
+    Class used to define a warped gaussian distribution over 1-D inputs whose dispersion matrix is the Gram matrix
+    of a sum of Matern kernels (OU, MAT32, MAT52) plus white noise. The log p is computed with a Kalman filter
+    over the sorted inputs, in O(N) time and memory.
+    Atributes:
+        It inherits the atributes from the supper class pm.Continuous
+        mu: the location of the distribution
+        inputs: the (N x 1) inputs where the process is observed
+        components: the list of Matern components (order, lam, var) of the kernel
+        noise: the variance of the white noise
+        mapping: the mapping of the warped. Default is Identity
+    """
+    def __init__(self, mu, inputs, components, noise, mapping=Identity(), *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mean = self.median = self.mode = self.mu = mu
+        self.inputs = inputs
+        self.components = components
+        self.noise = noise
+        self.mapping = mapping
+
+    @classmethod
+    def logp_statespace(cls, value, mu, inputs, components, noise, mapping):
+        """
+        Calculates the log p of the parameters given the data
+        :param value: the data
+        :param mu: the location (obtained from the hiperparameters)
+        :param inputs: the inputs where the process is observed
+        :param components: the list of Matern components (order, lam, var) of the kernel
+        :param noise: the variance of the white noise
+        :param mapping: the mapping of the warped.
+        :return: it returns the value of the log p of the parameters given the data (values)
+        """
+        delta = mapping.inv(value) - mu
+        order = tt.argsort(inputs[:, 0])
+        x = inputs[order, 0]
+        deltas = tt.concatenate([tt.zeros((1,)), x[1:] - x[:-1]])
+        H, P0, As, Qs = statespace_model(components, deltas)
+        _, _, _, _, lls = kalman_filter(delta[order], tt.ones_like(x), As, Qs, H, P0, noise)
+
+        dot2 = tt.sum(lls)
+        det_m = mapping.logdet_dinv(value)
+
+        r = dot2 + det_m
+
+        cond1 = tt.or_(tt.any(tt.isinf_(delta)), tt.any(tt.isnan_(delta)))
+        cond2 = tt.or_(tt.any(tt.isinf_(det_m)), tt.any(tt.isnan_(det_m)))
+        cond3 = tt.or_(tt.isinf_(dot2), tt.isnan_(dot2))
+        return ifelse(cond1, np.float32(-1e30),
+                      ifelse(cond2, np.float32(-1e30),
+                             ifelse(cond3, np.float32(-1e30), r)))
+
+    def logp(self, value):
+        """
+        It is a rapper of the fuction logp_statespace
+        :param value: the data
+        :return: evaluates the staticmethod logp_statespace
+        """
+        return self.logp_statespace(value, self.mu, self.inputs, self.components, self.noise, self.mapping)
+
+
+class VecchiaWarpedGaussianDistribution(pm.Continuous):
+    """
+    Class used to define the Vecchia approximation of a warped gaussian distribution: each output is conditioned
+    only on the outputs of its k nearest previous inputs, so the log p is a sum of N univariate gaussians whose
+    conditional moments need N small (k x k) solves, computed in batch.
+    Atributes:
+        It inherits the atributes from the supper class pm.Continuous
+        mu: the location of the distribution
+        inputs: the (N x D) inputs where the process is observed
+        kernel: the kernel (with noise) of the dispersion matrix
+        neighbours: the (N x k) indexs of the previous neighbours and their (N x k) mask
+        mapping: the mapping of the warped. Default is Identity
+    """
+    def __init__(self, mu, inputs, kernel, neighbours, mapping=Identity(), *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mean = self.median = self.mode = self.mu = mu
+        self.inputs = inputs
+        self.kernel = kernel
+        self.neighbours = neighbours
+        self.mapping = mapping
+
+    @classmethod
+    def logp_vecchia(cls, value, mu, inputs, kernel, neighbours, mapping):
+        """
+        Calculates the log p of the parameters given the data
+        :param value: the data
+        :param mu: the location (obtained from the hiperparameters)
+        :param inputs: the inputs where the process is observed
+        :param kernel: the kernel (with noise) of the dispersion matrix
+        :param neighbours: the indexs of the previous neighbours and their mask
+        :param mapping: the mapping of the warped.
+        :return: it returns the value of the log p of the parameters given the data (values)
+        """
+        delta = mapping.inv(value) - mu
+        index, mask = neighbours
+        n, k, d = index.shape[0], index.shape[1], inputs.shape[1]
+
+        x = inputs[index]
+        x1 = tt.tile(x[:, :, None, :], (1, 1, k, 1)).reshape((n * k * k, d))
+        x2 = tt.tile(x[:, None, :, :], (1, k, 1, 1)).reshape((n * k * k, d))
+        eye = tt.eye(k)[None, :, :]
+        pairs = mask[:, :, None] * mask[:, None, :]
+        cov_nn = tt_to_num(kernel.cov_pairs(x1, x2)).reshape((n, k, k)) * (np.float32(1) - eye) + \
+                 eye * tt_to_num(kernel.cov_diag(x.reshape((n * k, d)))).reshape((n, k))[:, :, None]
+        cov_nn = cov_nn * pairs + eye * (np.float32(1) - mask)[:, :, None]
+        cov_in = tt_to_num(kernel.cov_pairs(tt.tile(inputs[:, None, :], (1, k, 1)).reshape((n * k, d)),
+                                            x.reshape((n * k, d)))).reshape((n, k)) * mask
+
+        weights = batched_solve(cov_nn, cov_in)
+        location = tt.sum(weights * delta[index] * mask, axis=1)
+        var = tt_to_bounded(tt_to_num(kernel.cov_diag(inputs)) - tt.sum(weights * cov_in, axis=1), np.float32(1e-10))
+
+        npi = np.float32(-0.5) * n.astype(th.config.floatX) * tt.log(np.float32(2.0 * np.pi))
+        dot2 = np.float32(-0.5) * tt.sum((delta - location) ** 2 / var)
+        det_k = np.float32(-0.5) * tt.sum(tt.log(var))
+        det_m = mapping.logdet_dinv(value)
+
+        r = npi + dot2 + det_k + det_m
+
+        cond1 = tt.or_(tt.any(tt.isinf_(delta)), tt.any(tt.isnan_(delta)))
+        cond2 = tt.or_(tt.any(tt.isinf_(det_m)), tt.any(tt.isnan_(det_m)))
+        cond3 = tt.or_(tt.any(tt.isinf_(weights)), tt.any(tt.isnan_(weights)))
+        cond4 = tt.or_(tt.isinf_(dot2), tt.isnan_(dot2))
+        return ifelse(cond1, np.float32(-1e30),
+                      ifelse(cond2, np.float32(-1e30),
+                             ifelse(cond3, np.float32(-1e30),
+                                    ifelse(cond4, np.float32(-1e30), r))))
+
+    def logp(self, value):
+        """
+        It is a rapper of the fuction logp_vecchia
+        :param value: the data
+        :return: evaluates the staticmethod logp_vecchia
+        """
+        return self.logp_vecchia(value, self.mu, self.inputs, self.kernel, self.neighbours, self.mapping)
+
+
+class ExpertsWarpedGaussianDistribution(pm.Continuous):
+    """
+    Class used to define a warped gaussian distribution whose dispersion matrix is approximated by independent
+    blocks (the experts), so the log p is the sum of the log p of each block, O(sum n_k^3).
+    Atributes:
+        It inherits the atributes from the supper class pm.Continuous
+        mu: the location of the distribution
+        covs: the dispersion matrix of each block
+        index: the indexs of the outputs of each block
+        threads: the number of threads among which the blocks are split (None for all the cores)
+        mapping: the mapping of the warped. Default is Identity
+    """
+    def __init__(self, mu, covs, index, threads=None, mapping=Identity(), *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.mean = self.median = self.mode = self.mu = mu
+        self.covs = covs
+        self.index = index
+        self.threads = threads
+        self.mapping = mapping
+
+    @classmethod
+    def logp_experts(cls, value, mu, covs, index, mapping, threads=None):
+        """
+        Calculates the log p of the parameters given the data
+        :param value: the data
+        :param mu: the location (obtained from the hiperparameters)
+        :param covs: the dispersion matrix of each block
+        :param index: the indexs of the outputs of each block
+        :param mapping: the mapping of the warped.
+        :param threads: the number of threads
+        :return: it returns the value of the log p of the parameters given the data (values)
+        """
+        delta = mapping.inv(value) - mu
+
+        npi = np.float32(-0.5) * delta.shape[0].astype(th.config.floatX) * tt.log(np.float32(2.0 * np.pi))
+        dot2 = ExpertsLogp(threads)(*(covs + [delta[i] for i in index]))
+        det_m = mapping.logdet_dinv(value)
+
+        r = npi + dot2 + det_m
+
+        cond1 = tt.or_(tt.any(tt.isinf_(delta)), tt.any(tt.isnan_(delta)))
+        cond2 = tt.or_(tt.any(tt.isinf_(det_m)), tt.any(tt.isnan_(det_m)))
+        cond3 = tt.or_(tt.isinf_(dot2), tt.isnan_(dot2))
+        return ifelse(cond1, np.float32(-1e30),
+                      ifelse(cond2, np.float32(-1e30),
+                             ifelse(cond3, np.float32(-1e30), r)))
+
+    def logp(self, value):
+        """
+        It is a rapper of the fuction logp_experts
+        :param value: the data
+        :return: evaluates the staticmethod logp_experts
+        """
+        return self.logp_experts(value, self.mu, self.covs, self.index, self.mapping, self.threads)
@@ -1,6 +1,7 @@
 import numpy as np
 import theano as th
 import theano.tensor as tt
+import theano.tensor.nlinalg as tnl
 from . import Hypers
 from .metrics import Delta, Minimum, Difference, One, ARD_Dot, ARD_DotBias, ARD_L1, ARD_L2, DeltaEq, DeltaEq2
 from ...libs.tensors import debug
@@ -11,6 +12,8 @@ pi2 = np.pi**2
 zero = np.float32(0.0)
 
 class Kernel(Hypers):
+    stationary = False
+
     def __init__(self, x=None, name=None, metric=Delta, var=None):
         if type(metric) is type:
             self.metric = metric(x)
@@ -48,6 +51,44 @@ class Kernel(Hypers):
     def cov(self, x1, x2=None):
         pass
 
+    def cov_diag(self, x1):
+        """Diagonal of cov(x1), without building the full matrix when the kernel allows it"""
+        return tnl.extract_diag(self.cov(x1))
+
+    def cov_pairs(self, x1, x2):
+        """k(x1[i], x2[i]) for each row i, without building the full matrix when the kernel allows it"""
+        # by default, a scan of the 1 x 1 covariances of the pairs, linear in the number of rows
+        pairs, _ = th.scan(lambda r1, r2: self.cov(r1[None, :], r2[None, :])[0, 0], sequences=[x1, x2])
+        return pairs
+
+    def cov_column(self, x1):
+        """First column of cov(x1), which defines the whole matrix when it is Toeplitz"""
+        return self.cov(x1[:1], x1)[0]
+
+    def separable(self):
+        """
+        Whether k(x, y) = prod_d k_d(x_d, y_d) with stationary factors, so the Gram matrix of a grid is the
+        Kronecker product of the per-axis Gram matrices. By default, only the stationary kernels of one dimension.
+        """
+        dims = getattr(getattr(self, 'metric', None), 'dims', None)
+        if isinstance(dims, slice):
+            dims = range(dims.start or 0, dims.stop, dims.step or 1)
+        return self.stationary and dims is not None and np.size(dims) == 1
+
+    def state_space(self):
+        """
+        Exact state-space form of a 1-D kernel, as a list of Matern components (order, lam, var) and the variance
+        of the white noise, or None if the kernel does not have one
+        """
+        return None
+
+    def fourier(self, n, rng):
+        """
+        Random Fourier frequencies of the kernel, as a list of (var, omega, dims) with omega the (n x len(dims))
+        frequencies sampled from its spectral density, or None if the kernel does not have them
+        """
+        return None
+
     def __mul__(self, other):
         if issubclass(type(other), Kernel):
             return KernelProd(self, other)
@@ -92,8 +133,16 @@ class KernelDot(Kernel):
         else:
             return self.var * self.metric.gram(x1, x2)
 
+    def cov_diag(self, x1):
+        return self.var * self.metric.gram_diag(x1)[:, 0]
+
+    def cov_pairs(self, x1, x2):
+        return self.var * self.metric.gram_pairs(x1, x2)[:, 0]
+
 
 class KernelStationary(Kernel):
+    stationary = True
+
     def __init__(self, x=None, name=None, metric=ARD_L2, var=None):
         super().__init__(x, name, metric, var)
 
@@ -109,6 +158,27 @@ class KernelStationary(Kernel):
         else:
             return self.var * self.k(self.metric.gram(x1, x2))
 
+    def cov_diag(self, x1):
+        # the (zero) distances are disconnected from the hyperparameters of the metric, since the gradient of some k
+        # at zero is not defined (e.g. sqrt(d) in MAT32) and would be nan
+        return self.var * self.k(th.gradient.disconnected_grad(self.metric.gram_diag(x1)))[:, 0]
+
+    def cov_pairs(self, x1, x2):
+        return self.var * self.k(self.metric.gram_pairs(x1, x2))[:, 0]
+
+    def spectral(self, n, rng):
+        """n frequencies sampled from the normalized spectral density, with the randomness fixed by rng"""
+        return None
+
+    def fourier(self, n, rng):
+        omega = self.spectral(n, rng)
+        if omega is None:
+            return None
+        return [(self.var, omega, self.metric.dims)]
+
+    def spectral_normal(self, n, rng):
+        return rng.randn(n, int(np.prod(self.metric.shape))).astype(th.config.floatX)
+
 
 class KernelOperation(Kernel):
     def __init__(self, _k: Kernel, _element):
@@ -122,6 +192,10 @@ class KernelOperation(Kernel):
         self.k.check_hypers(parent=parent)
         self.hypers = self.k.hypers
 
+    @property
+    def stationary(self):
+        return self.k.stationary
+
     def check_dims(self, x=None):
         self.k.check_dims(x)
 
@@ -154,6 +228,10 @@ class KernelComposition(Kernel):
         self.k2.check_hypers(parent=parent)
         self.hypers = self.k1.hypers + self.k2.hypers
 
+    @property
+    def stationary(self):
+        return self.k1.stationary and self.k2.stationary
+
     def check_dims(self, x=None):
         self.k1.check_dims(x)
         self.k2.check_dims(x)
@@ -196,6 +274,31 @@ class KernelScale(KernelOperation):
     def cov(self, x1, x2=None):
         return self.element * self.k.cov(x1, x2)
 
+    def cov_diag(self, x1):
+        return self.element * self.k.cov_diag(x1)
+
+    def cov_pairs(self, x1, x2):
+        return self.element * self.k.cov_pairs(x1, x2)
+
+    def separable(self):
+        return self.k.separable()
+
+    def cov_column(self, x1):
+        return self.element * self.k.cov_column(x1)
+
+    def state_space(self):
+        ss = self.k.state_space()
+        if ss is None:
+            return None
+        components, noise = ss
+        return [(order, lam, self.element * var) for order, lam, var in components], self.element * noise
+
+    def fourier(self, n, rng):
+        features = self.k.fourier(n, rng)
+        if features is None:
+            return None
+        return [(self.element * var, omega, dims) for var, omega, dims in features]
+
     def __str__(self):
         return str(self.element) + " * " + str(self.k)
 
@@ -207,6 +310,15 @@ class KernelShift(KernelOperation):
     def cov(self, x1, x2=None):
         return self.element + self.k.cov(x1, x2)
 
+    def cov_diag(self, x1):
+        return self.element + self.k.cov_diag(x1)
+
+    def cov_pairs(self, x1, x2):
+        return self.element + self.k.cov_pairs(x1, x2)
+
+    def cov_column(self, x1):
+        return self.element + self.k.cov_column(x1)
+
     def __str__(self):
         return str(self.element) + " + " + str(self.k)
 
@@ -225,6 +337,18 @@ class KernelProd(KernelComposition):
     def cov(self, x1, x2=None):
         return self.k1.cov(x1, x2) * self.k2.cov(x1, x2)
 
+    def cov_diag(self, x1):
+        return self.k1.cov_diag(x1) * self.k2.cov_diag(x1)
+
+    def cov_pairs(self, x1, x2):
+        return self.k1.cov_pairs(x1, x2) * self.k2.cov_pairs(x1, x2)
+
+    def cov_column(self, x1):
+        return self.k1.cov_column(x1) * self.k2.cov_column(x1)
+
+    def separable(self):
+        return self.k1.separable() and self.k2.separable()
+
     def __str__(self):
         return str(self.k1) + " * " + str(self.k2)
 
@@ -240,6 +364,29 @@ class KernelSum(KernelComposition):
     def cov(self, x1, x2=None):
         return self.k1.cov(x1, x2) + self.k2.cov(x1, x2)
 
+    def cov_diag(self, x1):
+        return self.k1.cov_diag(x1) + self.k2.cov_diag(x1)
+
+    def cov_pairs(self, x1, x2):
+        return self.k1.cov_pairs(x1, x2) + self.k2.cov_pairs(x1, x2)
+
+    def cov_column(self, x1):
+        return self.k1.cov_column(x1) + self.k2.cov_column(x1)
+
+    def state_space(self):
+        ss1 = self.k1.state_space()
+        ss2 = self.k2.state_space()
+        if ss1 is None or ss2 is None:
+            return None
+        return ss1[0] + ss2[0], ss1[1] + ss2[1]
+
+    def fourier(self, n, rng):
+        features1 = self.k1.fourier(n, rng)
+        features2 = self.k2.fourier(n, rng)
+        if features1 is None or features2 is None:
+            return None
+        return features1 + features2
+
     def __str__(self):
         return str(self.k1) + " + " + str(self.k2)
 
@@ -255,6 +402,15 @@ class KernelMax(KernelComposition):
     def cov(self, x1, x2=None):
         return tt.maximum(self.k1.cov(x1, x2), self.k2.cov(x1, x2))
 
+    def cov_diag(self, x1):
+        return tt.maximum(self.k1.cov_diag(x1), self.k2.cov_diag(x1))
+
+    def cov_pairs(self, x1, x2):
+        return tt.maximum(self.k1.cov_pairs(x1, x2), self.k2.cov_pairs(x1, x2))
+
+    def cov_column(self, x1):
+        return tt.maximum(self.k1.cov_column(x1), self.k2.cov_column(x1))
+
     def __str__(self):
         return "max("+str(self.k1)+" , "+str(self.k2)+")"
 
@@ -307,6 +463,12 @@ class VAR(KernelDot):
             x2 = x1
         return self.var*tt.ones([x1.shape[0], x2.shape[0]])
 
+    def cov_diag(self, x1):
+        return self.var*tt.ones([x1.shape[0]])
+
+    def cov_pairs(self, x1, x2):
+        return self.var*tt.ones([x1.shape[0]])
+
 
 class NIL(KernelDot):
     def __init__(self, x=None, name=None, metric=One, var=1):
@@ -320,6 +482,12 @@ class NIL(KernelDot):
             x2 = x1
         return tt.zeros([x1.shape[0], x2.shape[0]])
 
+    def cov_diag(self, x1):
+        return tt.zeros([x1.shape[0]])
+
+    def cov_pairs(self, x1, x2):
+        return tt.zeros([x1.shape[0]])
+
 
 class LIN(KernelDot):
     def __init__(self, x=None, name=None, metric=ARD_DotBias, var=1):
@@ -340,6 +508,12 @@ class POL(KernelDot):
         else:
             return self.var * self.metric.gram(x1, x2) ** self.p
 
+    def cov_diag(self, x1):
+        return self.var * self.metric.gram_diag(x1)[:, 0] ** self.p
+
+    def cov_pairs(self, x1, x2):
+        return self.var * self.metric.gram_pairs(x1, x2)[:, 0] ** self.p
+
 
 class NN(KernelDot):
     def __init__(self, x=None, name=None, metric=ARD_DotBias, var=None):
@@ -356,6 +530,10 @@ class NN(KernelDot):
         else:
             return self.var * tt.arcsin(2*self.metric.gram(x1, x2)/((1 + 2*self.metric.gram(x1, x1))*(1 + 2*self.metric.gram(x2, x2))))
 
+    def cov_diag(self, x1):
+        xx = self.metric.gram_diag(x1)[:, 0]
+        return self.var * tt.arcsin(2*xx/((1 + 2*xx)**2))
+
 
 class KernelNoise(KernelStationary):
     def __init__(self, x=None, name=None, metric=Delta, var=None):
@@ -370,6 +548,21 @@ class KernelNoise(KernelStationary):
         else:
             return tt.zeros((x1.shape[0], x2.shape[0]))
 
+    def cov_diag(self, x1):
+        return self.var * tt.ones([x1.shape[0]])
+
+    def cov_pairs(self, x1, x2):
+        return tt.zeros([x1.shape[0]])
+
+    def cov_column(self, x1):
+        return self.var * tt.eq(tt.arange(x1.shape[0]), 0)
+
+    def state_space(self):
+        return [], self.var
+
+    def fourier(self, n, rng):
+        return []
+
 
 class WN(KernelStationary):
     def __init__(self, x=None, name=None, metric=Delta, var=None):
@@ -384,6 +577,18 @@ class WN(KernelStationary):
         else:
             return self.var * self.metric.gram(x1, x2)
 
+    def cov_diag(self, x1):
+        return self.var * tt.ones([x1.shape[0]])
+
+    def cov_column(self, x1):
+        return self.var * tt.eq(tt.arange(x1.shape[0]), 0)
+
+    def state_space(self):
+        return [], self.var
+
+    def fourier(self, n, rng):
+        return []
+
 
 class RQ(KernelStationary):
     def __init__(self, x=None, name=None, metric=ARD_L2, var=None, alpha=None):
@@ -402,6 +607,15 @@ class RQ(KernelStationary):
     def k(self, d):
         return tt.pow(1 + d / self.alpha, -self.alpha)
 
+    def spectral(self, n, rng):
+        # scale mixture of SE with gamma ~ Gamma(alpha, alpha), sampled with the Wilson-Hilferty transform
+        if not isinstance(self.metric, ARD_L2):
+            return None
+        g = rng.randn(n).astype(th.config.floatX)
+        # sqrt(gamma) = h^(3/2) with h the clamped Wilson-Hilferty normal, so its gradient is 0 (not nan) at h = 0
+        h = tt.maximum(1 - 1 / (9 * self.alpha) + g / (3 * tt.sqrt(self.alpha)), zero)
+        return (h ** np.float32(1.5))[:, None] * self.spectral_normal(n, rng) * self.metric.rate
+
 
 class MAT32(KernelStationary):
     def __init__(self, x=None, name=None, metric=ARD_L2, var=None):
@@ -411,6 +625,17 @@ class MAT32(KernelStationary):
         d3 = tt.sqrt(3*d)
         return (1 + d3)*tt.exp(-d3)
 
+    def spectral(self, n, rng):
+        if not isinstance(self.metric, ARD_L2):
+            return None
+        t = np.sqrt(3 / rng.chisquare(3, n)).astype(th.config.floatX)
+        return t[:, None] * self.spectral_normal(n, rng) * self.metric.rate / np.float32(np.sqrt(2))
+
+    def state_space(self):
+        if not isinstance(self.metric, ARD_L2):
+            return None
+        return [(2, np.float32(np.sqrt(1.5)) * tt.sum(self.metric.rate), self.var)], zero
+
 
 class MAT52(KernelStationary):
     def __init__(self, x=None, name=None, metric=ARD_L2, var=None):
@@ -420,16 +645,42 @@ class MAT52(KernelStationary):
         d5 = tt.sqrt(5*d)
         return (1 + d5 + 5*d/3)*tt.exp(-d5)
 
+    def spectral(self, n, rng):
+        if not isinstance(self.metric, ARD_L2):
+            return None
+        t = np.sqrt(5 / rng.chisquare(5, n)).astype(th.config.floatX)
+        return t[:, None] * self.spectral_normal(n, rng) * self.metric.rate / np.float32(np.sqrt(2))
+
+    def state_space(self):
+        if not isinstance(self.metric, ARD_L2):
+            return None
+        return [(3, np.float32(np.sqrt(2.5)) * tt.sum(self.metric.rate), self.var)], zero
+
 
 class KernelStationaryExponential(KernelStationary):
     def k(self, d):
         return tt.exp(-d)
 
+    def separable(self):
+        # the exponential of an ARD sum over the dimensions is the product of the per-dimension exponentials
+        return isinstance(self.metric, (ARD_L1, ARD_L2)) or super().separable()
+
+    def spectral(self, n, rng):
+        # the Cauchy frequencies of ARD_L1 (OU) are heavy-tailed, so the gradients of their features are only noise
+        if isinstance(self.metric, ARD_L2):
+            return self.spectral_normal(n, rng) * self.metric.rate
+        return None
+
 
 class OU(KernelStationaryExponential):
     def __init__(self, x=None, name=None, metric=ARD_L1, var=None):
         super().__init__(x, name, metric, var)
 
+    def state_space(self):
+        if not isinstance(self.metric, ARD_L1):
+            return None
+        return [(1, tt.sum(self.metric.rate), self.var)], zero
+
 
 class SE(KernelStationaryExponential):
     def __init__(self, x=None, name=None, metric=ARD_L2, var=None):
@@ -486,4 +737,12 @@ class SM(KernelPeriodic):
     def k(self, d):
         return tt.exp(-2*pi2*tt.dot(d ** 2, self.rate ** 2)) * tt.prod(tt.cos(2 * pi * d * self.freq), axis=2, dtype=th.config.floatX)
 
+    def spectral(self, n, rng):
+        # the product of cosines is the mean of cos(sum +-2 pi freq d) over random signs
+        if not isinstance(self.metric, Difference):
+            return None
+        z = self.spectral_normal(n, rng)
+        signs = rng.choice([-1, 1], size=z.shape).astype(th.config.floatX)
+        return np.float32(2 * pi) * (z * self.rate + signs * self.freq)
+
 
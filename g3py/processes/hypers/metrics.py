@@ -14,6 +14,14 @@ class Metric(Hypers):
         #except ValueError:
         #    return tt_to_num(self(x1[:, self.dims].dimshuffle([0, 'x']), x2[:, self.dims].dimshuffle(['x', 0])))
 
+    def gram_diag(self, x1):
+        # Same broadcasting as gram but pairing each point with itself, so the result has shape (n, 1, ...)
+        return self(x1[:, self.dims].dimshuffle([0, 'x', 1]), x1[:, self.dims].dimshuffle([0, 'x', 1]))
+
+    def gram_pairs(self, x1, x2):
+        # Pairs each point of x1 with the point of x2 in the same row, with shape (n, 1, ...)
+        return self(x1[:, self.dims].dimshuffle([0, 'x', 1]), x2[:, self.dims].dimshuffle([0, 'x', 1]))
+
     def input_sensitivity(self):
         return np.ones(self.shape)
 
@@ -34,6 +42,12 @@ class Delta(Metric):
     def gram(self, x1, x2):
         return tt_to_num(self(x1[:, self.dims].dimshuffle([0, 'x', 1]), x2[:, self.dims].dimshuffle(['x', 0, 1])))
 
+    def gram_diag(self, x1):
+        return tt_to_num(super().gram_diag(x1))
+
+    def gram_pairs(self, x1, x2):
+        return tt_to_num(super().gram_pairs(x1, x2))
+
 
 class DeltaEq(Metric):
     def __call__(self, x1, x2, eq=0):
@@ -0,0 +1,146 @@
+"""This module contains the Kronecker (grid) structured Gaussian Process.
+    """
+
+import itertools
+import numpy as np
+import theano as th
+import theano.tensor as tt
+import theano.tensor.nlinalg as tnl
+from .gaussian import GaussianProcess, KroneckerWarpedGaussianDistribution
+from .stochastic import zero32
+from ..libs.tensors import cholesky_robust, tt_to_bounded, tt_to_num, kron_mv, kron_diag, kron_matrix
+
+
+class KroneckerGaussianProcess(GaussianProcess):
+    """ Gaussian Process on a Cartesian grid with a separable kernel, k(x, y) = prod_d k_d(x_d, y_d), e.g. a
+    KernelProd of per-dimension stationary kernels or an ARD_L2 SE. The Gram matrix of the inputs is the
+    Kronecker product of the per-axis Gram matrices, so the log p, the posterior locations and the marginal
+    variances are computed from per-axis eigendecompositions in O(N sum n_d), never forming the N x N matrix.
+
+    The inputs (and the space) must be the Cartesian product of their per-axis coordinates, sorted with the last
+    dimension changing fastest, as returned by grid2d or numpy.meshgrid(indexing='ij').
+
+    Attributes:
+        The atributes are inherited from the GaussianProcess class.
+        jitter (float): the lower bound of the eigenvalues of the input kernel plus noise.
+    """
+    def __init__(self, *args, jitter=1e-6, **kwargs):
+        if 'name' not in kwargs:
+            kwargs['name'] = 'KGP'
+        kwargs['toeplitz'] = False
+        self.jitter = np.float32(jitter)
+        super().__init__(*args, **kwargs)
+
+    def _check_hypers(self):
+        super()._check_hypers()
+        if self.nspace > 1 and not self.f_kernel.separable():
+            raise ValueError('the kernel of a KroneckerGaussianProcess must be a product of per-dimension kernels: '
+                             + str(self.f_kernel))
+        # the graph is defined (and its test values computed) next, so the default space and inputs must be a grid
+        self._grid_test_values()
+        self.th_space.set_value(self.th_space_.tag.test_value)
+        self.th_inputs.set_value(self.th_inputs_.tag.test_value)
+        self.th_outputs.set_value(self.th_outputs_.tag.test_value)
+
+    def _grid_test_values(self):
+        """The test values of the space, inputs and outputs at the corners of the unit cube, a grid for any nspace"""
+        corners = np.array(list(itertools.product([0.0, 1.0], repeat=self.nspace)), dtype=th.config.floatX)
+        self.th_space_.tag.test_value = corners
+        self.th_inputs_.tag.test_value = corners
+        self.th_outputs_.tag.test_value = np.zeros(len(corners), dtype=th.config.floatX)
+        self.th_vector.tag.test_value = np.zeros(len(corners), dtype=th.config.floatX)
+
+    @staticmethod
+    def check_grid(x, name='inputs'):
+        if len(x.shape) < 2:
+            x = x.reshape(len(x), 1)
+        axes = [np.unique(x[:, d]) for d in range(x.shape[1])]
+        if len(x) != np.prod([len(a) for a in axes]) or \
+                np.any(x != np.array(list(itertools.product(*axes)), dtype=x.dtype)):
+            raise ValueError('the ' + name + ' of a KroneckerGaussianProcess must be a sorted Cartesian grid')
+
+    def observed(self, inputs=None, *args, **kwargs):
+        if inputs is not None:
+            self.check_grid(inputs, 'inputs')
+        super().observed(inputs, *args, **kwargs)
+
+    def predict(self, params=None, space=None, *args, **kwargs):
+        if space is not None:
+            self.check_grid(space, 'space')
+        return super().predict(params, space, *args, **kwargs)
+
+    def th_grid_axes(self, x):
+        """Per-axis coordinates of the grid x"""
+        return [tt.extra_ops.Unique()(x[:, d]) for d in range(self.nspace)]
+
+    def th_grid_probes(self, axes):
+        """Points of each axis with the other coordinates at zero, where the separable kernel gives k_d"""
+        return [tt.set_subtensor(tt.zeros((a.shape[0], self.nspace))[:, d], a) for d, a in enumerate(axes)]
+
+    def th_define_posterior(self):
+        """
+        Posterior engine: K = scale * kron(K_1, ..., K_D), with K_d the kernel on the probes of axis d and
+        scale = k(0, 0)^(1-D). Only the per-axis Gram matrices K_d = Q_d diag(l_d) Q_d^T are factorized.
+        """
+        self.prior_delta_inputs = self.mapping_outputs - self.prior_location_inputs
+
+        self.kronecker_axes_inputs = self.th_grid_axes(self.th_inputs)
+        self.kronecker_axes_space = self.th_grid_axes(self.th_space)
+        probes_inputs = self.th_grid_probes(self.kronecker_axes_inputs)
+        probes_space = self.th_grid_probes(self.kronecker_axes_space)
+
+        origin = tt.zeros((1, self.nspace))
+        self.kronecker_scale = tt_to_num(self.f_kernel.cov_diag(origin)[0] ** np.float32(1 - self.nspace))
+        self.kronecker_noise = tt_to_bounded(tt_to_num(self.f_kernel_noise.cov_diag(origin)[0] -
+                                                       self.f_kernel.cov_diag(origin)[0]), self.jitter)
+
+        eighs = [tnl.eigh(tt_to_num(self.f_kernel.cov(p))) for p in probes_inputs]
+        self.kronecker_eigenvectors_inputs = [q for _, q in eighs]
+        self.kronecker_eigenvalues_f_inputs = tt_to_bounded(self.kronecker_scale * kron_diag([l for l, _ in eighs]),
+                                                            zero32)
+        self.kronecker_eigenvalues_inputs = self.kronecker_eigenvalues_f_inputs + self.kronecker_noise
+
+        rot = kron_mv([q.T for q in self.kronecker_eigenvectors_inputs], self.prior_delta_inputs)
+        self.prior_alpha_inputs = kron_mv(self.kronecker_eigenvectors_inputs, rot / self.kronecker_eigenvalues_inputs)
+
+        cross = [tt_to_num(self.f_kernel.cov(ps, pi)) for ps, pi in zip(probes_space, probes_inputs)]
+        self.kronecker_solve_space = [c.dot(q) for c, q in zip(cross, self.kronecker_eigenvectors_inputs)]
+
+        self.posterior_location_f_space = self.prior_location_space + \
+                                          self.kronecker_scale * kron_mv(cross, self.prior_alpha_inputs)
+        self.posterior_location_space = self.posterior_location_f_space
+
+        self.posterior_explained_f_space = self.kronecker_scale ** 2 * \
+                                           kron_mv([w ** 2 for w in self.kronecker_solve_space],
+                                                   np.float32(1) / self.kronecker_eigenvalues_inputs)
+        self.posterior_explained_space = self.posterior_explained_f_space
+
+        solve = self.kronecker_scale * kron_matrix(self.kronecker_solve_space)
+        explained = (solve / self.kronecker_eigenvalues_inputs[None, :]).dot(solve.T)
+        self.posterior_kernel_space = self.prior_kernel_space - explained
+        self.posterior_cholesky_space = cholesky_robust(self.posterior_kernel_space)
+        self.posterior_kernel_f_space = self.prior_kernel_f_space - explained
+        self.posterior_cholesky_f_space = cholesky_robust(self.posterior_kernel_f_space)
+
+    def th_define_process(self):
+        """
+        The distribution of the outputs is N(mu, Q diag(eigenvalues) Q^T) with Q = kron(Q_1, ..., Q_D).
+        """
+        super(GaussianProcess, self).th_define_process()
+        self.distribution = KroneckerWarpedGaussianDistribution(self.name, mu=self.prior_location_inputs,
+                                                                eigenvectors=self.kronecker_eigenvectors_inputs,
+                                                                eigenvalues=self.kronecker_eigenvalues_inputs,
+                                                                mapping=self.f_mapping, observed=self.th_outputs,
+                                                                testval=self.outputs, dtype=th.config.floatX)
+
+    def th_cross_mean(self, prior=False, noise=False, cross_kernel=None):
+        if prior:
+            return self.prior_location_space
+        if cross_kernel is None:
+            return self.posterior_location_f_space
+        return super().th_cross_mean(prior=prior, noise=noise, cross_kernel=cross_kernel)
+
+    def _compile_methods(self, *args, **kwargs):
+        # the default test values (two points) are not a grid for nspace > 1, so the corners of the unit cube are used
+        self._grid_test_values()
+        super()._compile_methods(*args, **kwargs)
@@ -0,0 +1,157 @@
+"""This module contains the sparse (inducing points) approximation of a Gaussian Process.
+    """
+
+import numpy as np
+import theano as th
+import theano.tensor as tt
+from .gaussian import GaussianProcess, LowRankWarpedGaussianDistribution
+from .hypers import Hypers
+from .stochastic import zero32
+from ..libs.tensors import cholesky_robust, tt_to_bounded, tt_to_num, solve_lower_triangular, solve_upper_triangular
+
+
+class SparseGaussianProcess(GaussianProcess):
+    """ Gaussian Process with M inducing inputs, where the input kernel is replaced by its Nystrom
+    approximation Q = K_xu K_uu^-1 K_ux. The log p, the posterior locations and the marginal variances cost
+    O(N M^2) instead of O(N^3).
+
+    Attributes:
+        The atributes are inherited from the GaussianProcess class.
+        inducing (int or numpy.ndarray): number of inducing inputs, or their initial (M x nspace) locations.
+        learn_inducing (bool): if True the inducing inputs are hyperparameters, otherwise they are fixed.
+        approximation (str): 'vfe' (variational free energy, Titsias 2009) or 'fitc' (Snelson 2006).
+        jitter (float): the diagonal added to K_uu before its factorization.
+    """
+    def __init__(self, *args, inducing=64, learn_inducing=True, approximation='vfe', jitter=1e-6, **kwargs):
+        if 'name' not in kwargs:
+            kwargs['name'] = 'SGP'
+        if approximation not in ['vfe', 'fitc']:
+            raise ValueError('approximation must be vfe or fitc: ' + str(approximation))
+        if type(inducing) is int:
+            self.np_inducing = None
+            self.ninducing = inducing
+        else:
+            self.np_inducing = np.array(inducing, dtype=th.config.floatX)
+            if len(self.np_inducing.shape) < 2:
+                self.np_inducing = self.np_inducing.reshape(len(self.np_inducing), 1)
+            self.ninducing = len(self.np_inducing)
+        self.learn_inducing = learn_inducing
+        self.approximation = approximation
+        self.jitter = np.float32(jitter)
+        self.th_inducing = None
+        super().__init__(*args, **kwargs)
+
+    def _check_hypers(self):
+        super()._check_hypers()
+        if self.learn_inducing:
+            self.th_inducing = Hypers.Flat(self.name + '_inducing', shape=(self.ninducing, self.nspace),
+                                           testval=lambda shape: self.test_inducing())
+        else:
+            self.th_inducing = th.shared(self.test_inducing(), name=self.name + '_inducing', borrow=False,
+                                         allow_downcast=True)
+
+    def test_inducing(self):
+        """The inducing inputs of the test values of the graph, distinct so K_uu is not singular"""
+        if self.np_inducing is not None:
+            return self.np_inducing
+        x = self.th_inputs_.tag.test_value
+        steps = np.linspace(0, 1, self.ninducing)[:, None]
+        return (x.min(axis=0) + steps * (x.max(axis=0) - x.min(axis=0))).astype(th.config.floatX)
+
+    def default_inducing(self):
+        if self.np_inducing is not None:
+            return self.np_inducing
+        x = self.inputs
+        return x[np.linspace(0, len(x) - 1, self.ninducing).astype(np.int32)]
+
+    def default_hypers(self):
+        hypers = super().default_hypers()
+        if self.learn_inducing:
+            hypers[self.th_inducing] = self.default_inducing()
+        return hypers
+
+    def set_space(self, *args, **kwargs):
+        super().set_space(*args, **kwargs)
+        if self.th_inducing is not None and not self.learn_inducing:
+            self.th_inducing.set_value(self.default_inducing(), borrow=False)
+
+    @property
+    def inducing(self):
+        if self.learn_inducing:
+            return self.params[self.th_inducing.name]
+        return self.th_inducing.get_value(borrow=False)
+
+    def th_define_posterior(self):
+        """
+        Posterior engine: only K_uu (M x M) and B = I + A^T A (M x M) are factorized, with A the cross kernel
+        K_xu whitened by L_uu and scaled by the diagonal residual lam of the approximation.
+        """
+        self.prior_delta_inputs = self.mapping_outputs - self.prior_location_inputs
+
+        self.inducing_kernel = tt_to_num(self.f_kernel.cov(self.th_inducing)) + \
+                               self.jitter * tt.eye(self.th_inducing.shape[0])
+        self.inducing_cholesky = cholesky_robust(self.inducing_kernel)
+        self.inducing_solve_inputs = solve_lower_triangular(self.inducing_cholesky,
+                                                            tt_to_num(self.f_kernel.cov(self.th_inducing, self.th_inputs)))
+
+        self.prior_kernel_diag_f_inputs = tt_to_num(self.f_kernel.cov_diag(self.th_inputs))
+        self.prior_noise_diag_inputs = tt_to_bounded(tt_to_num(self.f_kernel_noise.cov_diag(self.th_inputs)) -
+                                                     self.prior_kernel_diag_f_inputs, self.jitter)
+        self.inducing_residual_inputs = tt_to_bounded(self.prior_kernel_diag_f_inputs -
+                                                      tt.sum(self.inducing_solve_inputs ** 2, axis=0), zero32)
+        if self.approximation == 'fitc':
+            self.sparse_diag_inputs = self.prior_noise_diag_inputs + self.inducing_residual_inputs
+            self.sparse_trace_inputs = None
+        else:
+            self.sparse_diag_inputs = self.prior_noise_diag_inputs
+            self.sparse_trace_inputs = np.float32(0.5) * tt.sum(self.inducing_residual_inputs /
+                                                                 self.prior_noise_diag_inputs)
+        self.sparse_factor_inputs = self.inducing_solve_inputs.T
+
+        sqrt_diag = tt.sqrt(self.sparse_diag_inputs)
+        scaled = self.sparse_factor_inputs / sqrt_diag[:, None]
+        beta = self.prior_delta_inputs / sqrt_diag
+        self.sparse_cholesky = cholesky_robust(tt.eye(self.th_inducing.shape[0]) + scaled.T.dot(scaled))
+        self.sparse_alpha = solve_upper_triangular(self.sparse_cholesky.T,
+                                                   solve_lower_triangular(self.sparse_cholesky, scaled.T.dot(beta)))
+        self.prior_alpha_inputs = (beta - scaled.dot(self.sparse_alpha)) / sqrt_diag
+
+        self.posterior_solve_f_space = solve_lower_triangular(self.inducing_cholesky,
+                                                              tt_to_num(self.f_kernel.cov(self.th_inducing, self.th_space)))
+        self.posterior_correct_f_space = solve_lower_triangular(self.sparse_cholesky, self.posterior_solve_f_space)
+        self.posterior_solve_space = self.posterior_solve_f_space
+
+        self.posterior_location_f_space = self.prior_location_space + \
+                                          self.posterior_solve_f_space.T.dot(self.sparse_alpha)
+        self.posterior_location_space = self.posterior_location_f_space
+
+        self.posterior_explained_f_space = tt.sum(self.posterior_solve_f_space ** 2, axis=0) - \
+                                           tt.sum(self.posterior_correct_f_space ** 2, axis=0)
+        self.posterior_explained_space = self.posterior_explained_f_space
+
+        explained = self.posterior_solve_f_space.T.dot(self.posterior_solve_f_space) - \
+                    self.posterior_correct_f_space.T.dot(self.posterior_correct_f_space)
+        self.posterior_kernel_space = self.prior_kernel_space - explained
+        self.posterior_cholesky_space = cholesky_robust(self.posterior_kernel_space)
+        self.posterior_kernel_f_space = self.prior_kernel_f_space - explained
+        self.posterior_cholesky_f_space = cholesky_robust(self.posterior_kernel_f_space)
+
+    def th_define_process(self):
+        """
+        The distribution of the outputs is N(mu, Q + diag(lam)), with the extra trace term of the
+        variational bound when approximation='vfe'.
+        """
+        super(GaussianProcess, self).th_define_process()
+        self.distribution = LowRankWarpedGaussianDistribution(self.name, mu=self.prior_location_inputs,
+                                                              factor=self.sparse_factor_inputs,
+                                                              diag=self.sparse_diag_inputs,
+                                                              trace=self.sparse_trace_inputs,
+                                                              mapping=self.f_mapping, observed=self.th_outputs,
+                                                              testval=self.outputs, dtype=th.config.floatX)
+
+    def th_cross_mean(self, prior=False, noise=False, cross_kernel=None):
+        if prior:
+            return self.prior_location_space
+        if cross_kernel is None:
+            return self.posterior_location_f_space
+        return super().th_cross_mean(prior=prior, noise=noise, cross_kernel=cross_kernel)
@@ -0,0 +1,79 @@
+"""This module contains the state-space (Kalman filter) representation of a 1-D Gaussian Process.
+    """
+
+import theano as th
+import theano.tensor as tt
+from .gaussian import GaussianProcess, StateSpaceWarpedGaussianDistribution
+from ..libs.tensors import statespace_model, kalman_filter, rts_smoother
+
+
+class StateSpaceGaussianProcess(GaussianProcess):
+    """ Gaussian Process over a 1-D space whose kernel is a sum of OU, MAT32 and MAT52 kernels (each one a block
+    of the state) plus white noise (KernelNoise, WN). The log p is computed with a Kalman filter and the posterior
+    locations and marginal variances with a Rauch-Tung-Striebel smoother, in O(N) time and memory, so no N x N
+    matrix is factorized.
+
+    Attributes:
+        The atributes are inherited from the GaussianProcess class.
+    """
+    def __init__(self, *args, **kwargs):
+        if 'name' not in kwargs:
+            kwargs['name'] = 'SSGP'
+        kwargs['toeplitz'] = False
+        super().__init__(*args, **kwargs)
+
+    def _check_hypers(self):
+        super()._check_hypers()
+        if self.nspace != 1:
+            raise ValueError('a StateSpaceGaussianProcess must have a 1-D space: ' + str(self.nspace))
+        ss = self.f_kernel_noise.state_space()
+        if ss is None:
+            raise ValueError('the kernel has not a state-space form: ' + str(self.f_kernel_noise))
+        self.statespace_components, self.statespace_noise = ss
+
+    def th_define_posterior(self):
+        """
+        Posterior engine: the space is merged with the inputs as unobserved steps, so the smoother gives the
+        posterior of the latent state at every point of the space. The dense posterior kernel is only kept for
+        covariance and sampling.
+        """
+        super().th_define_posterior()
+        n = self.th_inputs.shape[0]
+        x = tt.concatenate([self.th_inputs[:, 0], self.th_space[:, 0]])
+        y = tt.concatenate([self.prior_delta_inputs, tt.zeros_like(self.th_space[:, 0])])
+        observed = tt.concatenate([tt.ones_like(self.th_inputs[:, 0]), tt.zeros_like(self.th_space[:, 0])])
+        order = tt.argsort(x)
+        xs = x[order]
+        deltas = tt.concatenate([tt.zeros((1,)), xs[1:] - xs[:-1]])
+
+        H, P0, As, Qs = statespace_model(self.statespace_components, deltas)
+        ms, Ps, mps, Pps, _ = kalman_filter(y[order], observed[order], As, Qs, H, P0, self.statespace_noise)
+        sms, sPs = rts_smoother(ms, Ps, mps, Pps, As)
+
+        back = tt.argsort(order)[n:]
+        self.statespace_mean_space = sms.dot(H)[back]
+        self.statespace_var_space = tt.sum(sPs * H[None, :, None] * H[None, None, :], axis=(1, 2))[back]
+
+        self.posterior_location_f_space = self.prior_location_space + self.statespace_mean_space
+        self.posterior_location_space = self.posterior_location_f_space
+        self.posterior_explained_f_space = H.dot(P0).dot(H) - self.statespace_var_space
+        self.posterior_explained_space = self.posterior_explained_f_space
+
+    def th_define_process(self):
+        """
+        The distribution of the outputs is evaluated with the Kalman filter over the sorted inputs.
+        """
+        super(GaussianProcess, self).th_define_process()
+        self.distribution = StateSpaceWarpedGaussianDistribution(self.name, mu=self.prior_location_inputs,
+                                                                 inputs=self.th_inputs,
+                                                                 components=self.statespace_components,
+                                                                 noise=self.statespace_noise,
+                                                                 mapping=self.f_mapping, observed=self.th_outputs,
+                                                                 testval=self.outputs, dtype=th.config.floatX)
+
+    def th_cross_mean(self, prior=False, noise=False, cross_kernel=None):
+        if prior:
+            return self.prior_location_space
+        if cross_kernel is None:
+            return self.posterior_location_f_space
+        return super().th_cross_mean(prior=prior, noise=noise, cross_kernel=cross_kernel)
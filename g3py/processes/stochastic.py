@@ -1,31 +1,55 @@
 import os
 import types
+import _pickle as pickle
 
 import matplotlib.pyplot as plt
 import numpy as np
 import theano as th
 import theano.tensor as tt
 
-from ..bayesian.average import mcmc_ensemble, chains_to_datatrace, plot_datatrace
+from ..bayesian.average import mcmc_ensemble, mcmc_nuts, mcmc_smc, chains_to_datatrace, plot_datatrace, effective_sample_min
 from ..bayesian.models import GraphicalModel, PlotModel
 from ..bayesian.selection import optimize
 from ..libs import DictObj, save_pkl, load_pkl, load_datatrace, save_datatrace
-from ..libs.tensors import tt_to_num, makefn, gradient
+from ..libs.tensors import tt_to_num, makefn, gradient, hessian
 from multiprocessing import Pool
 # from ..bayesian.models import TheanoBlackBox
 
 zero32 = np.float32(0.0)
 
+# compiled batch function of the last pool of StochasticProcess.batch, inherited by its forked workers
+_batch_worker = None
+
+
+def _batch_call(job):
+    chain, space, inputs, outputs = job
+    return _batch_worker(chain, space, inputs, outputs)
+
+
+# environment variables of the BLAS threads, pinned in the workers of the parallel chains
+_blas_threads = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+
+def _sample_hypers_worker(job):
+    spec, seed, kwargs = job
+    np.random.seed(seed)
+    process = pickle.loads(spec)
+    process.active.activate()
+    process._compile_methods(compile_logp=False)
+    return process.sample_hypers(raw=True, parallel=False, threads=1, file=None, plot=False, **kwargs)
+
 
 class StochasticProcess(PlotModel):#TheanoBlackBox
 
     def __init__(self, space=None, order=None, inputs=None, outputs=None, hidden=None, index=None,
                  name='SP', distribution=None, active=False, precompile=False, file=None, load=True, compile_logp=True,
-                 *args, **kwargs):
+                 background=False, *args, **kwargs):
+        self.background = background
         if file is not None and load:
             try:
                 load = load_pkl(file)
                 self.__dict__.update(load.__dict__)
+                self.background = background
                 self._compile_methods(compile_logp)
                 print('Loaded model ' + file)
                 self.set_space(space=space, hidden=hidden, order=order, inputs=inputs, outputs=outputs, index=index)
@@ -69,6 +93,7 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
         self.th_vector.tag.test_value = np.array([0.0, 1.0], dtype=th.config.floatX)
         self.th_matrix = tt.matrix(self.name + '_matrix_th', dtype=th.config.floatX)
         self.th_matrix.tag.test_value = np.array([[0.0, 1.0]]*self.nspace, dtype=th.config.floatX).T
+        self.th_params = tt.vector(self.name + '_params_th', dtype=th.config.floatX)
 
         self.distribution = distribution
         if active is True:
@@ -118,6 +143,15 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
         except Exception as details:
             print('Error saving model '+path, details)
 
+    def __getstate__(self):
+        # the compiled methods are bound closures of _method_name, rebuilt by _compile_methods after unpickling
+        state = self.__dict__.copy()
+        for k, v in list(state.items()):
+            if isinstance(v, types.MethodType) and v.__self__ is self:
+                del state[k]
+        state['batch_pools'] = None
+        return state
+
     def set_params(self, *args, **kwargs):
         return self.active.set_params(*args, **kwargs)
 
@@ -291,6 +325,62 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
     def th_cross_mean(self, prior=False, noise=False, cross_kernel=None):
         pass
 
+    def th_quantiler(self, q=0.975, prior=False, noise=False):
+        pass
+
+    def th_predict(self, prior=False, noise=False, mean=True, std=True, var=False, cov=False, median=False,
+                   quantiles=False, quantiles_noise=False):
+        """
+        The requested statistics in a single graph, so the kernels and factorizations are built once and shared.
+        Returns None if some of them has not a symbolic form.
+        """
+        statistics = DictObj()
+        if quantiles:
+            statistics['quantile_up'] = lambda: self.th_quantiler(q=0.975, prior=prior, noise=noise)
+            statistics['quantile_down'] = lambda: self.th_quantiler(q=0.025, prior=prior, noise=noise)
+        if quantiles_noise:
+            statistics['noise_up'] = lambda: self.th_quantiler(q=0.975, prior=prior, noise=True)
+            statistics['noise_down'] = lambda: self.th_quantiler(q=0.025, prior=prior, noise=True)
+            statistics['noise_std'] = lambda: self.th_std(prior=prior, noise=True)
+        if mean:
+            statistics['mean'] = lambda: self.th_mean(prior=prior, noise=noise)
+        if var:
+            statistics['variance'] = lambda: self.th_variance(prior=prior, noise=noise)
+        if std:
+            statistics['std'] = lambda: self.th_std(prior=prior, noise=noise)
+        if cov:
+            statistics['covariance'] = lambda: self.th_covariance(prior=prior, noise=noise)
+        if median:
+            statistics['median'] = lambda: self.th_median(prior=prior, noise=noise)
+        if len(statistics) == 0:
+            return None
+        # the quantiles go first since they are the ones that may not have a symbolic form
+        for k, f in statistics.items():
+            statistics[k] = f()
+            if statistics[k] is None:
+                return None
+        return [statistics[k] for k in self._predict_keys(mean, std, var, cov, median, quantiles, quantiles_noise)]
+
+    @staticmethod
+    def _predict_keys(mean=True, std=True, var=False, cov=False, median=False, quantiles=False,
+                      quantiles_noise=False):
+        keys = []
+        if mean:
+            keys.append('mean')
+        if var:
+            keys.append('variance')
+        if std:
+            keys.append('std')
+        if cov:
+            keys.append('covariance')
+        if median:
+            keys.append('median')
+        if quantiles:
+            keys += ['quantile_up', 'quantile_down']
+        if quantiles_noise:
+            keys += ['noise_std', 'noise_up', 'noise_down']
+        return keys
+
     def th_std(self, *args, **kwargs):
         if self.th_variance(*args, **kwargs) is not None:
             return tt.sqrt(self.th_variance(*args, **kwargs))
@@ -308,6 +398,23 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
     def th_dlogp(self, dvars=None, *args, **kwargs):
         return tt_to_num(gradient(self.th_logp(*args, **kwargs), dvars))
 
+    def th_logp_dlogp(self, prior=False, noise=False):
+        """The logp and its gradient in one graph, so both are evaluated with a single forward pass"""
+        logp = self.th_logp(prior=prior, noise=noise)
+        return [logp, tt_to_num(gradient(logp))]
+
+    def th_d2logp(self, prior=False, noise=False):
+        """The Hessian of the logp with respect to the flat parameters, in the order of the bijection"""
+        return tt_to_num(hessian(self.th_logp(prior=prior, noise=noise), self.th_flat_vars()))
+
+    def th_flat_vars(self):
+        """The free variables of the model in the order of the flat parameters (the bijection)"""
+        return [self.model.named_vars[v.var] for v in self.active.bijection.ordering.vmap]
+
+    def th_flat_gradient(self, prior=False, noise=False, of='th_logp'):
+        """The gradient of a method (th_logp by default) with respect to the flat parameters, in their order"""
+        return tt_to_num(gradient(getattr(self, of)(prior=prior, noise=noise), self.th_flat_vars()))
+
     def th_loglike(self, prior=False, noise=False):
         factors = [var.logpt for var in self.model.observed_RVs]
         return tt.add(*map(tt.sum, factors))
@@ -362,12 +469,17 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
         #self.quantiler = types.MethodType(self._method_name('_quantiler'), self)
         #self.sampler = types.MethodType(self._method_name('_sampler'), self)
 
+        self.fused = types.MethodType(self._method_name('th_predict'), self)
+
         self.logp = types.MethodType(self._method_name('th_logp'), self)
         self.dlogp = types.MethodType(self._method_name('th_dlogp'), self)
+        self.logp_dlogp = types.MethodType(self._method_name('th_logp_dlogp'), self)
         self.loglike = types.MethodType(self._method_name('th_loglike'), self)
 
         self.is_observed = True
-        if compile_logp:
+        if compile_logp and self.background:
+            self.prewarm()
+        elif compile_logp:
             _ = self.logp(array=True)
             _ = self.logp(array=True, prior=True)
             # _ = self.loglike(array=True)
@@ -382,6 +494,99 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
     def lambda_method(self, *args, **kwargs):
         pass
 
+    def _compiled(self, method, prior=False, noise=False, array=False, *args, **kwargs):
+        """The makefn of a method, built (but not compiled) the first time it is requested"""
+        name = ''
+        if prior:
+            name += 'prior'
+        else:
+            name += 'posterior'
+        name += method.replace('th', '') # delete th
+        if noise:
+            name += '_noise'
+        if len(args) > 0:
+            name += str(args)
+        if len(kwargs) > 0:
+            name += str(kwargs)
+        if not hasattr(self.compiles, name):
+            #print(method)
+            #if method in ['th_logpredictive', 'th_error_l1', 'th_error_l2']:
+            #    th_vars = [self.th_space_, self.th_inputs_, self.th_outputs_, self.th_vector] + self.model.vars
+            #else:
+            th_vars = [self.th_space_, self.th_inputs_, self.th_outputs_, self.th_vector] + self.model.vars
+            fn = getattr(self, method)(prior=prior, noise=noise, *args, **kwargs)
+            if fn is None:
+                # the method has not a symbolic form, which is remembered to not build its graph again
+                self.compiles[name] = None
+                return None
+            self.compiles[name] = self.makefn(th_vars, fn,
+                                         givens = [(self.th_space, self.th_space_), (self.th_inputs, self.th_inputs_), (self.th_outputs, self.th_outputs_)],
+                                         bijection=None, precompile=self.precompile,
+                                         key=type(self).__module__ + '.' + type(self).__name__ + '.' + name)
+        if self.compiles[name] is None:
+            return None
+        if array:
+            if not hasattr(self.compiles, 'array_' + name):
+                self.compiles['array_' + name] = self._compiled_array(self.compiles[name])
+            name = 'array_' + name
+        return self.compiles[name]
+
+    def _compiled_array(self, source):
+        """
+        The makefn of source taking the flat array of parameters, which is sliced inside the graph, so the calls
+        skip the bijection to a dictionary and the keyword arguments.
+        """
+        slices = self._flat_slices()
+        if slices is None:
+            return source.clone(self.active.bijection.rmap)
+        self.th_params.tag.test_value = self.active.dict_to_array(self.params).astype(th.config.floatX)
+        givens = list(source.givens)
+        for v in self.model.vars:
+            givens.append((v, self.th_params[slices[v.name].slc].reshape(slices[v.name].shp).astype(v.dtype)))
+        key = getattr(source, 'key', None)
+        return self.makefn([self.th_space_, self.th_inputs_, self.th_outputs_, self.th_vector, self.th_params],
+                           source.fn, givens=givens, bijection=None, precompile=self.precompile,
+                           key=None if key is None else key + '.array', flat=True)
+
+    def _flat_slices(self):
+        """The slice of each variable in the flat array of parameters, or None if some variable is not in it"""
+        slices = {v.var: v for v in self.active.bijection.ordering.vmap}
+        if getattr(self, 'th_params', None) is None or any(v.name not in slices for v in self.model.vars):
+            return None
+        return slices
+
+    def prewarm(self, names=None, wait=False):
+        """
+        Compiles a set of methods, one after another, in the background thread of the compilations, so the constructor
+        and the callers only block when they first use a method that is still compiling.
+        Args:
+            names (list): the names of the compiled methods, as in .compiles, e.g. 'posterior_mean',
+                'posterior_std_noise' or 'array_posterior_dlogp'. By default, the logp, prior logp and dlogp.
+            wait (bool): whether to block until all of them are compiled
+        Returns:
+            A dictionary with the future of each compilation.
+        """
+        if names is None:
+            names = ['array_posterior_logp', 'array_prior_logp', 'array_posterior_dlogp']
+        futures = DictObj()
+        for name in names:
+            array = name.startswith('array_')
+            method = name.replace('array_', '', 1)
+            prior = method.startswith('prior_')
+            noise = method.endswith('_noise')
+            method = 'th_' + method.split('_', 1)[1]
+            if noise:
+                method = method[:-len('_noise')]
+            compiled = self._compiled(method, prior=prior, noise=noise, array=array) \
+                if callable(getattr(self, method, None)) else None
+            if compiled is None:
+                raise ValueError('the process has not the method ' + name)
+            futures[name] = compiled.compile_async()
+        if wait:
+            for future in futures.values():
+                future.result()
+        return futures
+
     @staticmethod
     def _method_name(method=None):
         def lambda_method(self, params=None, space=None, inputs=None, outputs=None, vector=[], prior=False, noise=False, array=False, *args, **kwargs):
@@ -401,37 +606,15 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
             if outputs is None:
                 outputs = self.outputs
             #return self._jit_compile(method, prior=prior, noise=noise, array=array, *args, **kwargs)(self.space, self.inputs, self.outputs, params)
-            name = ''
-            if prior:
-                name += 'prior'
-            else:
-                name += 'posterior'
-            name += method.replace('th', '') # delete th
-            if noise:
-                name += '_noise'
-            if len(args) > 0:
-                name += str(args)
-            if len(kwargs) > 0:
-                name += str(kwargs)
-            if not hasattr(self.compiles, name):
-                #print(method)
-                #if method in ['th_logpredictive', 'th_error_l1', 'th_error_l2']:
-                #    th_vars = [self.th_space_, self.th_inputs_, self.th_outputs_, self.th_vector] + self.model.vars
-                #else:
-                th_vars = [self.th_space_, self.th_inputs_, self.th_outputs_, self.th_vector] + self.model.vars
-                self.compiles[name] = self.makefn(th_vars, getattr(self, method)(prior=prior, noise=noise, *args, **kwargs),
-                                             givens = [(self.th_space, self.th_space_), (self.th_inputs, self.th_inputs_), (self.th_outputs, self.th_outputs_)],
-                                             bijection=None, precompile=self.precompile)
-            if array:
-                if not hasattr(self.compiles, 'array_' + name):
-                    self.compiles['array_' + name] = self.compiles[name].clone(self.active.bijection.rmap)
-                name = 'array_' + name
-            return self.compiles[name](params, space, inputs, outputs, vector)
+            compiled = self._compiled(method, prior, noise, array, *args, **kwargs)
+            if compiled is None:
+                return None
+            return compiled(params, space, inputs, outputs, vector)
         return lambda_method
 
     @property
     def executed(self):
-        return {k: v.executed for k, v in self.compiles.items()}
+        return {k: v.executed for k, v in self.compiles.items() if v is not None}
 
     @property
     def transformations(self):
@@ -481,11 +664,21 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
         if outputs is None:
             outputs = self.outputs
 
+        values = DictObj()
+        if simulations is None:
+            # all the statistics in one compiled function, when all of them have a symbolic form
+            statistics = self.fused(params, space, inputs, outputs, prior=prior, noise=noise, mean=mean, std=std,
+                                    var=var, cov=cov, median=median, quantiles=quantiles,
+                                    quantiles_noise=quantiles_noise)
+            if statistics is not None:
+                values.update(zip(self._predict_keys(mean, std, var, cov, median, quantiles, quantiles_noise),
+                                  statistics))
+                mean = std = var = cov = median = quantiles = quantiles_noise = False
+
         n_simulations = 1
         if type(simulations) is int:
             n_simulations = simulations
             simulations = self.sampler(params, space, inputs, outputs, prior=prior, noise=noise, samples=simulations)
-        values = DictObj()
         if mean:
             values['mean'] = self.mean(params, space, inputs, outputs, prior=prior, noise=noise, simulations=simulations)
         if var:
@@ -512,19 +705,110 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
             values['logpredictive'] = lambda x: self.logpredictive(params, space, inputs, outputs, vector=x, prior=prior, noise=True)
         return values
 
-    #TODO: Vectorized
-    def logp_chain(self, chain, prior=False):
-        out = np.empty(len(chain))
-        for i in range(len(out)):
-            out[i] = self.logp(chain[i], array=True, prior=prior)
-        return out
+    def th_batch(self, method='th_logp', prior=False, noise=False, grad=False):
+        """
+        The method evaluated on each row of th_batch, a (B x ndim) matrix of flat parameters, with a scan over the
+        rows, so a whole batch is evaluated by a single compiled call. None if some variable is not in the flat array.
+        """
+        slices = self._flat_slices()
+        if slices is None:
+            return None
+        outputs = [getattr(self, method)(prior=prior, noise=noise)]
+        if grad:
+            outputs.append(tt_to_num(gradient(outputs[0], self.th_flat_vars())))
+
+        def step(p):
+            return th.clone(outputs, replace={v: p[slices[v.name].slc].reshape(slices[v.name].shp).astype(v.dtype)
+                                              for v in self.model.vars})
+        batch, _ = th.scan(step, sequences=[self.th_batch_params])
+        return batch
+
+    def _compiled_batch(self, method='th_logp', prior=False, noise=False, grad=False):
+        name = 'batch_' + ('prior' if prior else 'posterior') + method.replace('th', '')
+        if noise:
+            name += '_noise'
+        if grad:
+            name += '_grad'
+        if not hasattr(self.compiles, name):
+            if getattr(self, 'th_batch_params', None) is None:
+                self.th_batch_params = tt.matrix(self.name + '_batch_params_th', dtype=th.config.floatX)
+            self.th_batch_params.tag.test_value = self.active.dict_to_array(self.params)[None, :].astype(th.config.floatX)
+            fn = self.th_batch(method, prior=prior, noise=noise, grad=grad)
+            if fn is None:
+                self.compiles[name] = None
+                return None
+            self.compiles[name] = self.makefn([self.th_space_, self.th_inputs_, self.th_outputs_, self.th_vector,
+                                               self.th_batch_params], fn,
+                                              givens=[(self.th_space, self.th_space_), (self.th_inputs, self.th_inputs_),
+                                                      (self.th_outputs, self.th_outputs_)],
+                                              bijection=None, precompile=self.precompile,
+                                              key=type(self).__module__ + '.' + type(self).__name__ + '.' + name,
+                                              flat=True)
+        return self.compiles[name]
+
+    def batch(self, chain, method='th_logp', prior=False, grad=False, processes=None):
+        """
+        Evaluates a method (th_logp by default) on each row of chain, a (B x ndim) array of parameters.
+        Args:
+            chain (numpy.ndarray): the B flat parameter vectors, in the order of the bijection
+            method (str): the symbolic method, th_logp or th_loglike
+            prior (bool): whether the prior logp is evaluated
+            grad (bool): whether the B gradients are also returned
+            processes (int): the number of forked processes among which the batch is split. Their pool is kept
+                for the next calls of the same method, until close_batch.
+        Returns:
+            The B values, and the (B x ndim) gradients if grad.
+        """
+        chain = np.atleast_2d(np.asarray(chain, dtype=th.config.floatX))
+        compiled = self._compiled_batch(method, prior=prior, grad=grad)
+        if compiled is None:
+            # some variable is not in the flat array, so the rows are evaluated one by one through the bijection
+            values = self._compiled(method, prior=prior, array=True)
+            r = np.array([values(p, self.space, self.inputs, self.outputs) for p in chain])
+            if grad:
+                grads = self._compiled('th_flat_gradient', prior=prior, array=True, of=method)
+                r = [r, np.array([grads(p, self.space, self.inputs, self.outputs) for p in chain])]
+        elif processes in [None, 0, 1] or len(chain) < 2 * processes:
+            r = compiled(chain, self.space, self.inputs, self.outputs)
+        else:
+            pool = self._batch_pool(compiled, processes)
+            parts = pool.map(_batch_call, [(part, self.space, self.inputs, self.outputs)
+                                           for part in np.array_split(chain, processes)])
+            if grad:
+                r = [np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts])]
+            else:
+                r = np.concatenate(parts)
+        if grad:
+            return r[0], r[1]
+        return r
+
+    def _batch_pool(self, compiled, processes):
+        """The pool of forked processes of a compiled batch function, created on its first use"""
+        if getattr(self, 'batch_pools', None) is None:
+            self.batch_pools = dict()
+        key = (id(compiled), processes)
+        if key not in self.batch_pools:
+            import multiprocessing as mp
+            global _batch_worker
+            compiled.compile()
+            _batch_worker = compiled
+            self.batch_pools[key] = mp.get_context('fork').Pool(processes)
+        return self.batch_pools[key]
+
+    def close_batch(self):
+        """Closes the pools of forked processes kept by batch"""
+        for pool in (getattr(self, 'batch_pools', None) or dict()).values():
+            pool.close()
+            pool.join()
+        self.batch_pools = None
+
+    def logp_chain(self, chain, prior=False, grad=False, processes=None):
+        return self.batch(chain, 'th_logp', prior=prior, grad=grad, processes=processes)
 
     #@jit
     def fixed_logp(self, sampling_params, return_array=False):
         self.active.fixed_chain[:, self.active.sampling_dims] = sampling_params
-        r = np.zeros(len(self.active.fixed_chain))
-        for i, p in enumerate(self.active.fixed_chain):
-            r[i] = self.compiles.array_posterior_logp(p, self.space, self.inputs, self.outputs)
+        r = self.batch(self.active.fixed_chain, 'th_logp')
         if return_array:
             return r
         else:
@@ -533,20 +817,17 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
     #@jit
     def fixed_dlogp(self, sampling_params, return_array=False):
         self.active.fixed_chain[:, self.active.sampling_dims] = sampling_params
-        r = list()
-        for i, p in enumerate(self.active.fixed_chain):
-            r.append(self.compiles.array_posterior_dlogp(p, self.space, self.inputs, self.outputs)[self.active.sampling_dims])
+        _, r = self.batch(self.active.fixed_chain, 'th_logp', grad=True)
+        r = r[:, self.active.sampling_dims]
         if return_array:
-            return np.array(r)
+            return r
         else:
-            return np.mean(np.array(r), axis=0)
+            return np.mean(r, axis=0)
 
     #@jit
     def fixed_loglike(self, sampling_params, return_array=False):
         self.active.fixed_chain[:, self.active.sampling_dims] = sampling_params
-        r = np.zeros(len(self.active.fixed_chain))
-        for i, p in enumerate(self.active.fixed_chain):
-            r[i] = self.compiles.array_posterior_loglike(p, self.space, self.inputs, self.outputs)
+        r = self.batch(self.active.fixed_chain, 'th_loglike')
         if return_array:
             return r
         else:
@@ -555,16 +836,14 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
     #@jit
     def fixed_logprior(self, sampling_params, return_array=False):
         self.active.fixed_chain[:, self.active.sampling_dims] = sampling_params
-        r = np.zeros(len(self.active.fixed_chain))
-        for i, p in enumerate(self.active.fixed_chain):
-            r[i] = self.compiles.array_prior_logp(p, self.space, self.inputs, self.outputs)
+        r = self.batch(self.active.fixed_chain, 'th_logp', prior=True)
         if return_array:
             return r
         else:
             return np.mean(r)
 
     def find_MAP(self, start=None, points=1, return_points=False, plot=False, display=True,
-                 powell=True, bfgs=True, init='bfgs', max_time=None):
+                 powell=True, bfgs=True, init='bfgs', max_time=None, laplace=False):
         """
         This function calculates the Maximun A Posteriori alternating the bfgs and powell algorithms,
 
@@ -581,6 +860,8 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
             bfgs (bool): Whether the bfgs algotithm it is used
             init (str): The algorith with which it starts in the first iteration.
             max_time (int): the maximum number of seconds for every step in the optimization
+            laplace (int): if given, the number of draws of the Laplace approximation around the optimum
+                (see .laplace), whose datatrace is also returned (True for 1000)
 
         Returns:
             This function returns the optimal parameters of the loglikelihood function.
@@ -591,14 +872,18 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
         if self.active.fixed_datatrace is None:
             logp = lambda p: self.compiles.array_posterior_logp(p, self.space, self.inputs, self.outputs)
             dlogp = lambda p: self.compiles.array_posterior_dlogp(p, self.space, self.inputs, self.outputs)
+            logp_dlogp = lambda p: self._compiled('th_logp_dlogp', array=True)(p, self.space, self.inputs,
+                                                                               self.outputs)
         else:
             logp = self.fixed_logp
             dlogp = self.fixed_dlogp
+            logp_dlogp = None
         try:
             dlogp(self.active.sampling_params(start))
         except Exception as m:
             print(m)
             dlogp = None
+            logp_dlogp = None
 
         if type(start) is list:
             i = 0
@@ -640,7 +925,7 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
                     if display:
                         print(name)
                     new = optimize(logp=logp, start=self.active.sampling_params(start), dlogp=dlogp, fmin='bfgs',
-                                   max_time=max_time, disp=display)
+                                   max_time=max_time, logp_dlogp=logp_dlogp, disp=display)
                 else:
                     if name.endswith('_powell'):
                         if i > n_starts:
@@ -668,17 +953,90 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
         params = DictObj(params)
         if display:
             print('find_MAP', params)
+        if laplace:
+            datatrace = self.laplace(params, samples=1000 if laplace is True else laplace)
+            if return_points is False:
+                return params, datatrace
+            return params, points_list, datatrace
         if return_points is False:
             return params
         else:
             return params, points_list
 
+    def laplace(self, params=None, samples=1000, prior=False, hessian='auto', step=1e-3, processes=None):
+        """
+        Laplace approximation of the posterior of the hyperparameters: a Gaussian around the mode params (the
+        find_MAP), with the inverse of the negative Hessian of the logp as covariance.
+        Args:
+            params (g3py.libs.DictObj): the mode, by default the current parameters
+            samples (int): the number of draws of the approximation
+            prior (bool): whether the approximation is of the prior
+            hessian (str): 'exact' for the compiled second derivatives (th_d2logp), 'fd' for the central finite
+                differences of the dlogp, evaluated in one batch (.batch), or 'auto' for the exact one unless the
+                graph has no second derivatives (e.g. the Toeplitz and iterative solvers), then 'fd'
+            step (float): the relative step of the finite differences
+            processes (int): the number of forked processes among which the finite differences are split
+        Returns:
+            A datatrace with the draws in the format of sample_hypers, and their logp, which PlotModel.average
+            can consume.
+        """
+        if params is None:
+            params = self.params
+        full = self.active.dict_to_array(params)
+        dims = self.active.sampling_dims
+        x = full[dims]
+        if self.active.fixed_datatrace is not None:
+            hessian = 'fd'
+        if hessian not in ['auto', 'exact', 'fd']:
+            raise ValueError('hessian must be auto, exact or fd: ' + str(hessian))
+        if hessian in ['auto', 'exact']:
+            try:
+                H = self._compiled('th_d2logp', prior=prior, array=True)(full, self.space, self.inputs, self.outputs)
+                H = np.asarray(H, dtype=np.float64)[np.ix_(dims, dims)]
+            except Exception as m:
+                if hessian == 'exact':
+                    raise
+                print('The exact Hessian is not available, using finite differences:', m)
+                hessian = 'fd'
+        if hessian == 'fd':
+            h = step * np.maximum(1, np.abs(x))
+            points = np.repeat(full[None, :], 2 * len(dims), axis=0)
+            points[np.arange(len(dims)), dims] += h
+            points[len(dims) + np.arange(len(dims)), dims] -= h
+            if self.active.fixed_datatrace is None:
+                _, grads = self.batch(points, 'th_logp', prior=prior, grad=True, processes=processes)
+                self.close_batch()
+                grads = np.asarray(grads, dtype=np.float64)[:, dims]
+            else:
+                grads = np.array([self.fixed_dlogp(p[dims]) for p in points], dtype=np.float64)
+            H = (grads[:len(dims)] - grads[len(dims):]).T / (2 * h[None, :])
+
+        # the precision is the negative Hessian, projected to the positive definite matrices if it is not
+        eigenvalues, eigenvectors = np.linalg.eigh(-(H + H.T) / 2)
+        if np.any(eigenvalues <= 0):
+            print('The Hessian is not negative definite at the mode, its eigenvalues are clipped')
+            eigenvalues = np.maximum(eigenvalues, 1e-6 * max(np.max(np.abs(eigenvalues)), 1))
+        draws = x + (np.random.randn(samples, len(dims)) / np.sqrt(eigenvalues)).dot(eigenvectors.T)
+        chain = np.repeat(full[None, :], samples, axis=0)
+        chain[:, dims] = draws
+        if self.active.fixed_datatrace is None:
+            ll = self.logp_chain(chain, prior=prior)
+        elif prior:
+            ll = np.array([self.fixed_logprior(d) for d in draws])
+        else:
+            ll = np.array([self.fixed_logp(d) for d in draws])
+        datatrace = chains_to_datatrace(self, chain, ll=ll, burnin_tol=None)
+        datatrace.insert(datatrace.columns.get_loc('_niter') + 1, '_burnin', True)
+        return datatrace
+
     def sample_hypers(self, start=None, samples=1000, chains=None, ntemps=None, raw=False, noise_mult=0.1, noise_sum=0.01,
                       burnin_tol=0.001, burnin_method='multi-sum', outlayer_percentile=0.0005, clusters=None, prior=False, parallel=False, threads=1,
-                      plot=False, file=None, load=True):
+                      plot=False, file=None, load=True, vectorize=False, checkpoint=None, checkpoint_every=100,
+                      monitor_every=None, ess_min=None, rhat_tol=None, callback=None, method='ensemble', warmup=None,
+                      target_accept=0.8, mass='diag', adapt_temps=None, return_stats=False):
         """
         This function find the optimal hyperparameters of the logpredictive function using the
-        'Ensemble MCMC' algorithm.
+        'Ensemble MCMC' algorithm, or the No-U-Turn Sampler driven by the compiled logp and dlogp.
         Args:
             start (g3py.libs.DictObj): The initial parameters for the optimization. If start is None,
                 it starts with the parameters obtained using find_MAP algorithm.
@@ -695,11 +1053,32 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
                 of the percentile to let out as outlayers.
             clusters (int): the number of clusters in which the sample is divided
             prior (bool): Whether the prior its considered
-            parallel (bool): Whether the algorithm works in paralell or not.
+            parallel (int): the number of spawned processes among which the chains are split (False for none).
+                Each one samples its share of walkers with its BLAS pinned to its share of the cores.
             threads (int): the number of process to paralelize the algorithm
             plot (bool): whether the information of the datatrace are plotted or not.
             file (str): a path for save the datatrace
             load (bool): if load is True, a datatrace will be searched in the path given by file
+            vectorize (bool): whether all the walkers of a half-step are scored with one batched call (.batch),
+                split among a persistent pool of threads forked processes, instead of one call per walker (the
+                default, as emcee)
+            checkpoint (str): a directory where the chains are appended every checkpoint_every iterations, with
+                the state of the sampler, so an interrupted run is resumed where it stopped
+            checkpoint_every (int): the number of iterations of each block of the checkpoint
+            monitor_every (int): the number of iterations between the online convergence diagnostics (R-hat,
+                multivariate ESS and acceptance fraction), passed to callback or printed
+            ess_min (float): the target ESS to stop early ('auto' for effective_sample_min)
+            rhat_tol (float): the tolerance of abs(R-hat - 1) to stop early
+            callback (callable): a function called with the dict of diagnostics (picklable if parallel)
+            method (str): 'ensemble' for emcee (ensemble or parallel tempering), or 'nuts' for the No-U-Turn
+                Sampler, whose chains are split among parallel forked processes
+            warmup (int): the number of adaptation iterations of NUTS, discarded (samples by default)
+            target_accept (float): the target acceptance probability of the step size of NUTS
+            mass (str): the mass matrix of NUTS, 'diag', 'dense' or None for the identity
+            adapt_temps (int): the number of discarded iterations tuning the temperatures of the parallel
+                tempering towards uniform swap acceptance
+            return_stats (bool): whether the statistics of the run are also returned; with ntemps, the ladder,
+                the swap acceptance of each pair of temperatures and the thermodynamic integration log evidence
 
         Returns:
             This function returns the information given by the Ensemble Markov Chain Monte Carlo Algorithm
@@ -711,8 +1090,12 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
             belong, the iteration number, and the 'burnin' and the 'outlayer' booleans.
         """
         ndim = len(self.active.sampling_dims)
+        if method not in ['ensemble', 'nuts']:
+            raise ValueError('method must be ensemble or nuts: ' + str(method))
         if chains is None:
-            chains = 2*ndim
+            chains = 4 if method == 'nuts' else 2*ndim
+        if ess_min == 'auto':
+            ess_min = effective_sample_min(self, p=ndim)
         if file is not None and load:
             try:
                 datatrace = load_datatrace(file)
@@ -720,13 +1103,19 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
                     if (datatrace._niter.max() == samples-1) and (datatrace._nchain.max() == chains-1):
                         if plot:
                             plot_datatrace(datatrace)
+                        if return_stats:
+                            return datatrace, None
                         return datatrace
             except Exception as m:
                 pass
-        if start is None:
+        if start is None and checkpoint is not None and os.path.isdir(checkpoint):
+            # the walkers are resumed from the checkpoint, so the start only fixes the shape
+            start = self.params
+        elif start is None:
             start = self.find_MAP(display=False)
         if isinstance(start, dict):
             start = self.active.dict_to_array(start)
+        full_start = start
 
         if len(start.shape) == 1:
             start = start[self.active.sampling_dims]
@@ -736,17 +1125,17 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
             start = start[:, :, self.active.sampling_dims]
         if self.active.fixed_datatrace is None:
             if ntemps is None:
-                if prior is False:
-                    logp = lambda p: self.compiles.array_posterior_logp(p, self.space, self.inputs, self.outputs)
-                else:
-                    logp = lambda p: self.compiles.array_prior_logp(p, self.space, self.inputs, self.outputs)
+                compiled_logp = self._compiled('th_logp', prior=prior, array=True)
+                logp = lambda p: compiled_logp(p, self.space, self.inputs, self.outputs)
                 loglike = None
                 logprior = None
             else:
                 logp = None
-                logprior = lambda p: self.compiles.array_prior_logp(p, self.space, self.inputs, self.outputs)
+                compiled_logprior = self._compiled('th_logp', prior=True, array=True)
+                logprior = lambda p: compiled_logprior(p, self.space, self.inputs, self.outputs)
                 if prior is False:
-                    loglike = lambda p: self.compiles.array_posterior_loglike(p, self.space, self.inputs, self.outputs)
+                    compiled_loglike = self._compiled('th_loglike', array=True)
+                    loglike = lambda p: compiled_loglike(p, self.space, self.inputs, self.outputs)
                 else:
                     loglike = lambda p: zero32
         else:
@@ -765,22 +1154,45 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
                     loglike = lambda p: zero32
                 logprior = self.fixed_logprior
 
+        logp_batch, loglike_batch, logprior_batch = None, None, None
+        if vectorize and self.active.fixed_datatrace is None:
+            # compiled before the BatchPool forks its workers (threads), so they inherit them
+            if ntemps is None:
+                self._compiled_batch('th_logp', prior=prior).compile()
+                logp_batch = lambda ps: self.batch(ps, 'th_logp', prior=prior)
+            else:
+                self._compiled_batch('th_logp', prior=True).compile()
+                logprior_batch = lambda ps: self.batch(ps, 'th_logp', prior=True)
+                if prior is False:
+                    self._compiled_batch('th_loglike').compile()
+                    loglike_batch = lambda ps: self.batch(ps, 'th_loglike')
+                else:
+                    loglike_batch = lambda ps: np.zeros(len(ps), dtype=th.config.floatX)
+
         def parallel_mcmc(nchains):
             return mcmc_ensemble(ndim, samples=samples, chains=nchains, ntemps=ntemps, start=start,
                                            logp=logp, loglike=loglike, logprior=logprior,
-                                           noise_mult=noise_mult, noise_sum=noise_sum, threads=threads)
-
-        if parallel in [None, 0, 1]:
-            lnprob, echain = parallel_mcmc(nchains=chains)
+                                           noise_mult=noise_mult, noise_sum=noise_sum, threads=threads,
+                                           logp_batch=logp_batch, loglike_batch=loglike_batch,
+                                           logprior_batch=logprior_batch, checkpoint=checkpoint,
+                                           checkpoint_every=checkpoint_every, monitor_every=monitor_every,
+                                           ess_min=ess_min, rhat_tol=rhat_tol, callback=callback,
+                                           adapt_temps=adapt_temps, return_stats=True)
+
+        stats = None
+        if method == 'nuts':
+            lnprob, echain = self._nuts_chains(start, samples=samples, chains=chains, prior=prior, warmup=warmup,
+                                               target_accept=target_accept, mass=mass, noise_mult=noise_mult,
+                                               noise_sum=noise_sum, processes=parallel)
+        elif parallel in [None, False, 0, 1]:
+            lnprob, echain, stats = parallel_mcmc(nchains=chains)
         else:
-            import multiprocessing as mp
-            p = mp.Pool(parallel)
-            r = p.map(parallel_mcmc, list([chains/parallel]*parallel))
-            lnprob, echain = [], []
-            for k in r:
-                lk, le = k
-                lnprob = np.concatenate([lnprob, lk])
-                echain = np.concatenate([echain, le])
+            lnprob, echain = self._parallel_chains(parallel, full_start, samples=samples, chains=chains, ntemps=ntemps,
+                                                   noise_mult=noise_mult, noise_sum=noise_sum, prior=prior,
+                                                   vectorize=vectorize, checkpoint=checkpoint,
+                                                   checkpoint_every=checkpoint_every, monitor_every=monitor_every,
+                                                   ess_min=ess_min, rhat_tol=rhat_tol, callback=callback,
+                                                   adapt_temps=adapt_temps)
 
         complete_chain = np.empty((echain.shape[0], echain.shape[1], self.ndim))
         complete_chain[:, :, self.active.sampling_dims] = echain
@@ -788,6 +1200,8 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
             print("TODO: Check THIS complete_chain with MEAN")
             complete_chain[:, :, self.active.fixed_dims] = self.active.fixed_chain[:, self.active.fixed_dims].mean(axis=0)
         if raw:
+            if return_stats:
+                return complete_chain, lnprob, stats
             return complete_chain, lnprob
         else:
             datatrace = chains_to_datatrace(self, complete_chain, ll=lnprob, burnin_tol=burnin_tol,
@@ -797,8 +1211,144 @@ class StochasticProcess(PlotModel):#TheanoBlackBox
                 save_datatrace(datatrace, file)
             if plot:
                 plot_datatrace(datatrace)
+            if return_stats:
+                return datatrace, stats
             return datatrace
 
+    def sample_smc(self, start=None, particles=1000, reference='gaussian', ess=0.5, max_steps=25, noise_mult=0.1,
+                   noise_sum=0.01, processes=None, raw=False, outlayer_percentile=0.0005, plot=False, file=None):
+        """
+        Sequential Monte Carlo with adaptive tempering of the hyperparameters (see mcmc_smc), whose particles are
+        scored with the batched prior logp and loglike (.batch), split among forked processes.
+        Args:
+            start (g3py.libs.DictObj): the center of the initial particles (by default the find_MAP), or an array
+                with the initial particles (particles x ndim)
+            particles (int): the number of particles
+            reference (str): 'prior' if start are draws of the prior, so only the likelihood is tempered, or
+                'gaussian' to temper from a Gaussian fitted to the initial particles
+            ess (float): the fraction of effective sample size kept by each step of temperature
+            max_steps (int): the maximum number of Metropolis steps of each rejuvenation
+            noise_mult (float): the variance of the multiplicative noise of the initial particles
+            noise_sum (float): the variance of the aditive noise of the initial particles
+            processes (int): the number of forked processes among which the particles are scored
+            raw (bool): whether the particles and their logp are returned instead of a datatrace
+            outlayer_percentile (float): the percentile of outlayers of the datatrace
+            plot (bool): whether the datatrace is plotted
+            file (str): a path for save the datatrace
+        Returns:
+            The datatrace of the particles (or the particles and their logp if raw) and the estimate of the log
+            marginal likelihood (the evidence), comparable among models.
+        """
+        ndim = len(self.active.sampling_dims)
+        if start is None:
+            start = self.find_MAP(display=False)
+        if isinstance(start, dict):
+            start = self.active.dict_to_array(start)
+        if len(start.shape) == 2:
+            start = start[:, self.active.sampling_dims]
+        else:
+            start = start[self.active.sampling_dims]
+        if self.active.fixed_datatrace is None:
+            def complete(ps):
+                chain = np.repeat(self.active.dict_to_array(self.params)[None, :], len(ps), axis=0)
+                chain[:, self.active.sampling_dims] = ps
+                return chain
+            logprior_batch = lambda ps: self.batch(complete(ps), 'th_logp', prior=True, processes=processes)
+            loglike_batch = lambda ps: self.batch(complete(ps), 'th_loglike', processes=processes)
+        else:
+            logprior_batch = lambda ps: np.array([self.fixed_logprior(p) for p in ps])
+            loglike_batch = lambda ps: np.array([self.fixed_loglike(p) for p in ps])
+        lnprob, echain, logz, _ = mcmc_smc(ndim, particles=particles, start=start, loglike_batch=loglike_batch,
+                                           logprior_batch=logprior_batch, reference=reference, ess=ess,
+                                           max_steps=max_steps, noise_mult=noise_mult, noise_sum=noise_sum)
+        self.close_batch()
+        complete_chain = np.repeat(self.active.dict_to_array(self.params)[None, :], len(echain), axis=0)
+        complete_chain[:, self.active.sampling_dims] = echain
+        if raw:
+            return (complete_chain, lnprob), logz
+        datatrace = chains_to_datatrace(self, complete_chain, ll=lnprob, burnin_tol=None,
+                                        outlayer_percentile=outlayer_percentile)
+        datatrace.insert(datatrace.columns.get_loc('_niter') + 1, '_burnin', True)
+        if file is not None:
+            save_datatrace(datatrace, file)
+        if plot:
+            plot_datatrace(datatrace)
+        return datatrace, logz
+
+    def _nuts_chains(self, start, samples=1000, chains=4, prior=False, processes=None, **kwargs):
+        """
+        Runs the chains of the No-U-Turn Sampler over the sampling dimensions, with the logp and dlogp evaluated in
+        one call of the compiled array function (or averaged over the fixed datatrace).
+        """
+        if self.active.fixed_datatrace is None:
+            compiled = self._compiled('th_logp_dlogp', prior=prior, array=True)
+            compiled.compile()
+            logp_dlogp = lambda p: compiled(p, self.space, self.inputs, self.outputs)
+        elif prior:
+            raise ValueError('NUTS over the prior needs the compiled dlogp, without a fixed datatrace')
+        else:
+            logp_dlogp = lambda p: (self.fixed_logp(p), self.fixed_dlogp(p))
+        if processes in [None, False, 0, 1]:
+            processes = None
+        return mcmc_nuts(len(self.active.sampling_dims), samples=samples, chains=chains, start=start,
+                         logp_dlogp=logp_dlogp, processes=processes, **kwargs)
+
+    def _parallel_chains(self, parallel, start, samples=1000, chains=None, ntemps=None, checkpoint=None, ess_min=None,
+                         **kwargs):
+        """
+        Runs the walkers of sample_hypers split among parallel spawned processes. Each worker rebuilds the process
+        from its pickle (reusing the compile cache, config.compile_cache), with its BLAS pinned to its share of the
+        cores, and samples its subset of walkers (at every temperature), checkpointed in its own subdirectory.
+        Each worker targets its share of ess_min, and the chains are cut to the shortest one if some stop early.
+        :return: the merged log p and chains of the sampling dimensions
+        """
+        import multiprocessing as mp
+        ndim = len(self.active.sampling_dims)
+        if chains is None:
+            chains = 2 * ndim
+        if chains % 2 == 1:
+            raise ValueError('chains must be even to be split among parallel workers, got ' + str(chains))
+        # emcee needs an even number of walkers, at least twice the dimension, in every worker
+        if chains // parallel < 2 * ndim:
+            workers = max(1, chains // (2 * ndim))
+            print('parallel reduced from ' + str(parallel) + ' to ' + str(workers) + ' to keep at least '
+                  + str(2 * ndim) + ' walkers per worker')
+            parallel = workers
+        sizes = [2 * len(pairs) for pairs in np.array_split(np.arange(chains // 2), parallel)]
+        cuts = np.cumsum(sizes)[:-1]
+        if len(start.shape) == 2 and len(start) == chains:
+            starts = np.split(start, cuts)
+        elif len(start.shape) == 3 and start.shape[1] == chains:
+            starts = np.split(start, cuts, axis=1)
+        else:
+            starts = [start] * parallel
+        seeds = np.random.randint(2 ** 31 - 1, size=parallel)
+        with self.model:
+            spec = pickle.dumps(self, protocol=-1)
+        jobs = []
+        for k, (seed, worker_start, worker_chains) in enumerate(zip(seeds, starts, sizes)):
+            worker_checkpoint = None if checkpoint is None else os.path.join(checkpoint, 'worker_' + str(k))
+            jobs.append((spec, seed, dict(start=worker_start, samples=samples, chains=worker_chains, ntemps=ntemps,
+                                          checkpoint=worker_checkpoint,
+                                          ess_min=None if ess_min is None else ess_min / parallel, **kwargs)))
+
+        blas = str(max(1, (os.cpu_count() or 1) // parallel))
+        environ = {k: os.environ.get(k) for k in _blas_threads}
+        os.environ.update({k: blas for k in _blas_threads})
+        try:
+            with mp.get_context('spawn').Pool(parallel) as pool:
+                results = pool.map(_sample_hypers_worker, jobs)
+        finally:
+            for k, v in environ.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+        iterations = min(ll.shape[1] for _, ll in results)
+        lnprob = np.concatenate([ll[:, :iterations] for _, ll in results])
+        echain = np.concatenate([chain[:, :iterations, self.active.sampling_dims] for chain, _ in results])
+        return lnprob, echain
+
     @property
     def ndim(self):
         return self.active.ndim
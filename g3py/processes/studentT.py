@@ -27,6 +27,7 @@ class StudentTProcess(EllipticalProcess):
         self.distribution = WarpedStudentTDistribution(self.name,
                                                        mu=self.prior_location_inputs,
                                                        cov=self.prior_kernel_inputs,
+                                                       cho=self.prior_cholesky_inputs,
                                                        freedom=self.th_freedom(prior=True),
                                                        mapping=self.f_mapping,
                                                        observed=self.th_outputs,
@@ -37,7 +38,7 @@ class StudentTProcess(EllipticalProcess):
         if prior:
             return np.float32(1.0)
         np2 = np.float32(2.0)
-        alpha = tsl.solve_lower_triangular(cholesky_robust(self.prior_kernel_inputs), self.mapping_outputs - self.prior_location_inputs)
+        alpha = tsl.solve_lower_triangular(self.prior_cholesky_inputs, self.prior_delta_inputs)
         beta = alpha.T.dot(alpha)
         coeff = (self.th_freedom(prior=True) + beta - np2) / (self.th_freedom(prior=False) - np2)
         return coeff
@@ -104,10 +105,11 @@ class WarpedStudentTProcess(StudentTProcess):
 
 
 class WarpedStudentTDistribution(pm.Continuous):
-    def __init__(self, mu, cov, freedom, mapping, *args, **kwargs):
+    def __init__(self, mu, cov, freedom, mapping, cho=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.mean = self.median = self.mode = self.mu = mu
         self.cov = cov
+        self.cov_cho = cho
         self.freedom = freedom
         self.mapping = mapping
 
@@ -151,6 +153,8 @@ class WarpedStudentTDistribution(pm.Continuous):
 
     @property
     def cho(self):
+        if self.cov_cho is not None:
+            return self.cov_cho
         try:
             return cholesky_robust(self.cov)
         except:
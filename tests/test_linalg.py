@@ -0,0 +1,78 @@
+import numpy as np
+import scipy as sp
+import scipy.linalg
+import pytest
+from g3py.libs.linalg import toeplitz_solve, toeplitz_durbin, cholesky_append, cholesky_delete, cg_solve, \
+    slq_logdet, experts_partition
+
+
+def se_column(n, rate=0.3, noise=1e-2):
+    c = np.exp(-0.5 * (rate * np.arange(n)) ** 2)
+    c[0] += noise
+    return c
+
+
+def se_matrix(n, seed=0, noise=1e-2):
+    x = np.sort(np.random.RandomState(seed).uniform(0, 10, n))
+    return np.exp(-0.5 * (x[:, None] - x[None, :]) ** 2) + noise * np.eye(n)
+
+
+@pytest.mark.parametrize('columns', [None, 3])
+def test_toeplitz_solve(columns):
+    c = se_column(50)
+    b = np.random.RandomState(0).randn(50) if columns is None else np.random.RandomState(0).randn(50, columns)
+    assert np.allclose(toeplitz_solve(c, b), np.linalg.solve(sp.linalg.toeplitz(c), b))
+
+
+def test_toeplitz_solve_breakdown():
+    # the leading 2 x 2 block of T is singular, so the Levinson recursion breaks down
+    c = np.ones(5)
+    x = toeplitz_solve(c, np.ones(5))
+    assert np.all(np.isfinite(x))
+    assert np.allclose(sp.linalg.toeplitz(c).dot(x), np.ones(5), atol=1e-4)
+
+
+def test_toeplitz_durbin():
+    c = se_column(50)
+    T = sp.linalg.toeplitz(c)
+    first, logdet = toeplitz_durbin(c)
+    assert np.allclose(first, np.linalg.inv(T)[:, 0])
+    assert np.isclose(logdet, np.linalg.slogdet(T)[1])
+
+
+def test_cholesky_append_delete():
+    K = se_matrix(30)
+    L = np.linalg.cholesky(K[:25, :25])
+    assert np.allclose(cholesky_append(L, K[:25, 25:], K[25:, 25:]), np.linalg.cholesky(K))
+    index = np.delete(np.arange(30), 7)
+    assert np.allclose(cholesky_delete(np.linalg.cholesky(K), 7), np.linalg.cholesky(K[np.ix_(index, index)]))
+
+
+def test_cg_solve():
+    K = se_matrix(40, noise=1e-1)
+    B = np.random.RandomState(1).randn(40, 2)
+    assert np.allclose(cg_solve(K, B, tol=1e-10), np.linalg.solve(K, B), atol=1e-6)
+    assert np.allclose(cg_solve(K, B[:, 0], tol=1e-10), np.linalg.solve(K, B[:, 0]), atol=1e-6)
+
+
+def test_slq_logdet():
+    K = se_matrix(40, noise=1e-1)
+    logdet = np.linalg.slogdet(K)[1]
+    assert abs(slq_logdet(K, probes=64, steps=40) - logdet) < 0.1 * abs(logdet)
+
+
+def test_slq_logdet_eigenvectors():
+    # every probe is an eigenvector of a multiple of the identity, so Lanczos stops after one step
+    assert np.isclose(slq_logdet(2 * np.eye(60)), 60 * np.log(2))
+
+
+def test_experts_partition():
+    x = np.random.RandomState(0).uniform(0, 10, (100, 2))
+    np.random.seed(3)
+    state = np.random.get_state()
+    blocks = experts_partition(x, 6, seed=0)
+    assert len(blocks) == 6 and all(len(b) > 0 for b in blocks)
+    assert np.array_equal(np.sort(np.concatenate(blocks)), np.arange(100))
+    assert all(np.array_equal(b1, b2) for b1, b2 in zip(blocks, experts_partition(x, 6, seed=0)))
+    # the global generator of the samplers is not changed by the partition
+    assert np.array_equal(np.random.get_state()[1], state[1])
@@ -0,0 +1,151 @@
+import numpy as np
+import pytest
+import g3py as g3
+
+
+def grid_data(seed=0):
+    np.random.seed(seed)
+    x = np.array([[u, v] for u in np.linspace(0, 1, 7) for v in np.linspace(0, 1, 5)], dtype='float32')
+    y = (np.sin(3 * x[:, 0]) + np.cos(2 * x[:, 1]) + 0.1 * np.random.randn(len(x))).astype('float32')
+    return x, y
+
+
+def assert_same_process(process, gp, atol=1e-4):
+    params = gp.params_process(process)
+    assert np.allclose(process.logp(), gp.logp(params), atol=atol)
+    assert np.allclose(process.dlogp(), gp.dlogp(params), atol=atol)
+    predict, predict_gp = process.predict(), gp.predict(params)
+    for k in ['mean', 'std']:
+        assert np.allclose(predict[k], predict_gp[k], atol=atol)
+
+
+def test_kronecker_grid():
+    x, y = grid_data()
+    kgp = g3.KroneckerGaussianProcess(space=x, location=g3.Zero(), kernel=g3.SE(x), name='KGP')
+    kgp.observed(x, y)
+    gp = g3.GaussianProcess(space=x, location=g3.Zero(), kernel=g3.SE(x), name='GP')
+    gp.observed(x, y)
+    assert_same_process(kgp, gp)
+
+
+def line_data(n=40, seed=0):
+    # irregular inputs, so the dense GP does not take the Toeplitz path
+    np.random.seed(seed)
+    x = np.linspace(0, 1, n).astype('float32')[:, None]
+    x[::3] += 0.01
+    y = (np.sin(6 * x[:, 0]) + 0.1 * np.random.randn(n)).astype('float32')
+    return x, y
+
+
+def test_iterative_solver():
+    x, y = line_data()
+    iterative = g3.GaussianProcess(space=x, location=g3.Zero(), kernel=g3.SE(x), solver='iterative', probes=64,
+                                   name='IGP')
+    iterative.observed(x, y)
+    gp = g3.GaussianProcess(space=x, location=g3.Zero(), kernel=g3.SE(x), name='GP')
+    gp.observed(x, y)
+    params = gp.params_process(iterative)
+    # the log-determinant and its gradient are stochastic estimates, the solves are exact up to tol
+    assert np.allclose(iterative.logp(), gp.logp(params), rtol=0.02)
+    assert np.allclose(iterative.dlogp(), gp.dlogp(params), rtol=0.15)
+    assert np.allclose(iterative.predict()['mean'], gp.predict(params)['mean'], atol=1e-3)
+
+
+def test_toeplitz_solver():
+    np.random.seed(0)
+    x = np.linspace(0, 1, 40).astype('float32')[:, None]
+    y = (np.sin(6 * x[:, 0]) + 0.1 * np.random.randn(40)).astype('float32')
+    toeplitz = g3.GaussianProcess(space=x, location=g3.Zero(), kernel=g3.SE(x), toeplitz=True, name='TGP')
+    toeplitz.observed(x, y)
+    gp = g3.GaussianProcess(space=x, location=g3.Zero(), kernel=g3.SE(x), name='GP')
+    gp.observed(x, y)
+    assert_same_process(toeplitz, gp)
+    # a degenerate kernel, reached by the NUTS trajectories, gives an invalid log p instead of an error
+    params = np.array([-1.14, 47.8, -2.96], dtype='float32')
+    assert not np.isfinite(toeplitz.logp(params, array=True)) or toeplitz.logp(params, array=True) < -1e6
+    assert np.all(np.isfinite(toeplitz.dlogp(params, array=True)))
+
+
+@pytest.mark.parametrize('kernel', ['SE', 'RQ', 'MAT32', 'MAT52', 'SM'])
+def test_fourier_gradient(kernel):
+    x, y = line_data()
+    fgp = g3.FourierGaussianProcess(space=x, location=g3.Zero(), kernel=getattr(g3, kernel)(x), seed=1, name='FGP')
+    fgp.observed(x, y)
+    # length scales of the order of the inputs, where the features are a smooth function of the hyperparameters
+    params = fgp.params
+    params.update({k: np.zeros_like(v) for k, v in params.items() if k.endswith('_rate_log__')})
+    params.update({k: np.ones_like(v) for k, v in params.items() if k.endswith('_freq_log__')})
+    # a small alpha of RQ, where some draws of its Wilson-Hilferty gamma are clamped at zero
+    params.update({k: -np.ones_like(v) for k, v in params.items() if k.endswith('_alpha_log__')})
+    p = fgp.active.dict_to_array(params).astype(np.float64)
+    h = 1e-2
+    fd = [(fgp.logp((p + h * e).astype('float32'), array=True) -
+           fgp.logp((p - h * e).astype('float32'), array=True)) / (2 * h) for e in np.eye(len(p))]
+    assert np.allclose(fgp.dlogp(p.astype('float32'), array=True), fd, rtol=0.02, atol=0.05)
+
+
+def test_fourier_cauchy():
+    x, y = line_data()
+    with pytest.raises(ValueError):
+        g3.FourierGaussianProcess(space=x, location=g3.Zero(), kernel=g3.OU(x), name='FGP')
+
+
+def test_experts():
+    x, y = line_data()
+    # a single expert is the exact GP, combined without the prior correction of the committee machine
+    egp = g3.ExpertsGaussianProcess(space=x, location=g3.Zero(), kernel=g3.SE(x), experts=1, combine='bcm',
+                                    name='EGP')
+    egp.observed(x, y)
+    gp = g3.GaussianProcess(space=x, location=g3.Zero(), kernel=g3.SE(x), name='GP')
+    gp.observed(x, y)
+    assert_same_process(egp, gp)
+    experts = g3.ExpertsGaussianProcess(space=x, location=g3.Zero(), kernel=g3.SE(x), experts=4, name='EGP4')
+    experts.observed(x, y)
+    assert sorted(np.concatenate([e.get_value() for e in experts.th_experts])) == list(range(len(x)))
+    assert np.isfinite(experts.logp()) and np.all(np.isfinite(experts.dlogp()))
+
+
+@pytest.mark.parametrize('approximation', ['vfe', 'fitc'])
+def test_sparse_all_inducing(approximation):
+    # with all the inputs as inducing inputs, the Nystrom approximation is exact
+    x, y = line_data()
+    sgp = g3.SparseGaussianProcess(space=x, location=g3.Zero(), kernel=g3.SE(x) + g3.WN(x), inducing=x,
+                                   learn_inducing=False, approximation=approximation, name='SGP')
+    sgp.observed(x, y)
+    gp = g3.GaussianProcess(space=x, location=g3.Zero(), kernel=g3.SE(x) + g3.WN(x), name='GP')
+    gp.observed(x, y)
+    assert_same_process(sgp, gp)
+    learned = g3.SparseGaussianProcess(space=x, location=g3.Zero(), kernel=g3.SE(x) + g3.WN(x), inducing=8,
+                                       approximation=approximation, name='LGP')
+    learned.observed(x, y)
+    assert np.isfinite(learned.logp()) and np.all(np.isfinite(learned.dlogp()))
+
+
+def test_batch_fallback(monkeypatch):
+    x, y = line_data()
+    gp = g3.GaussianProcess(space=x, location=g3.Zero(), kernel=g3.SE(x), name='GP')
+    gp.observed(x, y)
+    p = gp.active.dict_to_array(gp.params)
+    chain = np.array([p, p + 0.1, p - 0.1], dtype='float32')
+    values, grads = gp.batch(chain, method='th_loglike', prior=True, grad=True)
+    # without the scan over the rows, the gradients are still those of the requested method, not of the prior logp
+    monkeypatch.setattr(gp, '_compiled_batch', lambda *args, **kwargs: None)
+    fallback_values, fallback_grads = gp.batch(chain, method='th_loglike', prior=True, grad=True)
+    assert np.allclose(fallback_values, values, rtol=1e-4)
+    assert np.allclose(fallback_grads, grads, rtol=1e-3, atol=1e-4)
+    assert not np.allclose(fallback_grads, gp.batch(chain, prior=True, grad=True)[1], rtol=1e-3, atol=1e-4)
+
+
+@pytest.mark.parametrize('vectorize', [False, True])
+def test_sample_hypers_tempering(vectorize):
+    x, y = line_data()
+    gp = g3.GaussianProcess(space=x, location=g3.Zero(), kernel=g3.SE(x), name='GP')
+    gp.observed(x, y)
+    np.random.seed(0)
+    datatrace, stats = gp.sample_hypers(samples=300, ntemps=4, adapt_temps=100, vectorize=vectorize,
+                                        return_stats=True)
+    assert len(datatrace) > 0
+    assert stats['betas'][0] == 1 and np.all(np.diff(stats['betas']) < 0)
+    # the adapted ladder keeps every pair of neighbouring temperatures swapping
+    assert np.all(stats['swap_acceptance'] > 0.05) and np.ptp(stats['swap_acceptance']) < 0.3
+    assert np.isfinite(stats['log_evidence'])
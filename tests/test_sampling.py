@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+from g3py.bayesian.average import mcmc_ensemble, mcmc_nuts
+from g3py.bayesian.selection import optimize
+
+
+def gaussian_loglike(x):
+    return -0.5 * np.sum(x ** 2) - np.log(2 * np.pi)
+
+
+def box_logprior(x):
+    return -np.log(100.0) if np.all(np.abs(x) < 5) else -np.inf
+
+
+def test_adaptive_tempering_gaussian():
+    # N(0, I) likelihood with a uniform prior on [-5, 5]^2, so the evidence is ~ 1 / 100
+    np.random.seed(0)
+    lnprob, echain, stats = mcmc_ensemble(2, samples=2000, chains=16, ntemps=4, start=np.array([0.5, 0.5]),
+                                          loglike=gaussian_loglike, logprior=box_logprior, adapt_temps=50,
+                                          return_stats=True)
+    assert echain.shape == (16, 2000, 2)
+    assert np.all(np.diff(stats['betas']) < 0)
+    assert np.ptp(stats['swap_acceptance']) < 0.3
+    assert abs(stats['log_evidence'] + np.log(100.0)) < 0.5
+    assert np.allclose(np.cov(echain.reshape(-1, 2).T), np.eye(2), atol=0.15)
+
+
+@pytest.mark.parametrize('ntemps', [None, 3])
+def test_checkpoint_resume(tmpdir, ntemps):
+    np.random.seed(1)
+    checkpoint = str(tmpdir.join('checkpoint'))
+    kwargs = dict(chains=8, ntemps=ntemps, start=np.array([0.5, 0.5]), loglike=gaussian_loglike,
+                  logprior=box_logprior, logp=lambda x: gaussian_loglike(x) + box_logprior(x),
+                  checkpoint=checkpoint, checkpoint_every=25)
+    lnprob, echain = mcmc_ensemble(2, samples=50, adapt_temps=20, **kwargs)
+    assert echain.shape == (8, 50, 2)
+    lnprob_resumed, echain_resumed = mcmc_ensemble(2, samples=100, **kwargs)
+    assert echain_resumed.shape == (8, 100, 2)
+    assert np.allclose(echain_resumed[:, :50], echain)
+    assert np.allclose(lnprob_resumed[:, :50], lnprob)
+    assert np.all(np.isfinite(lnprob_resumed))
+
+
+@pytest.mark.parametrize('ntemps', [None, 3])
+def test_batch_pool(ntemps):
+    np.random.seed(2)
+    loglike_batch = lambda ps: np.array([gaussian_loglike(p) for p in ps])
+    logprior_batch = lambda ps: np.array([box_logprior(p) for p in ps])
+    logp_batch = lambda ps: loglike_batch(ps) + logprior_batch(ps)
+    if ntemps is None:
+        batches = dict(logp_batch=logp_batch)
+    else:
+        batches = dict(loglike_batch=loglike_batch, logprior_batch=logprior_batch)
+    # the start is out of the box for some walkers, whose log p must be -inf and not nan
+    lnprob, echain = mcmc_ensemble(2, samples=200, chains=8, ntemps=ntemps, start=np.array([4.9, 4.9]),
+                                   noise_mult=0.05, threads=2, **batches)
+    assert echain.shape == (8, 200, 2)
+    assert not np.any(np.isnan(lnprob))
+    assert np.all(np.isfinite(lnprob[:, -1]))
+
+
+def raising_logp_dlogp(x):
+    # a model whose evaluation fails outside of a box, as a failed decomposition of a degenerate kernel
+    if np.any(np.abs(x) > 2):
+        raise np.linalg.LinAlgError('not positive-definite')
+    return -0.5 * np.sum(x ** 2), -x
+
+
+def test_nuts_model_errors():
+    np.random.seed(2)
+    lnprob, echain = mcmc_nuts(2, samples=300, chains=2, start=np.array([0.5, -0.5]),
+                               logp_dlogp=raising_logp_dlogp)
+    assert echain.shape == (2, 300, 2)
+    assert np.all(np.abs(echain) <= 2)
+    assert np.all(np.isfinite(lnprob))
+
+
+def test_optimize_logp_dlogp():
+    scales = np.array([1.0, 100.0])
+    logp_dlogp = lambda x: (-np.sum(scales * (x - 3) ** 2), -2 * scales * (x - 3))
+    logp = lambda x: logp_dlogp(x)[0]
+    start = np.zeros(2)
+    assert np.allclose(optimize(logp, start, logp_dlogp=logp_dlogp, gtol=1e-8), 3, atol=1e-4)
+    # the keyword arguments of fmin_bfgs are given as options of minimize
+    assert not np.allclose(optimize(logp, start, logp_dlogp=logp_dlogp, maxiter=1), 3, atol=1e-2)
+    with pytest.raises(TypeError):
+        optimize(logp, start, None, 'bfgs', None, logp_dlogp, 1e-8)
+    with pytest.raises(TypeError):
+        optimize(logp, start, logp_dlogp=logp_dlogp, full_output=True)
@@ -0,0 +1,42 @@
+import numpy as np
+import theano as th
+import theano.tensor as tt
+from g3py import config
+from g3py.libs import tensors
+from g3py.libs.tensors import makefn
+
+
+def sum_graph():
+    x = tt.vector('x', dtype='float32')
+    # the models of the other tests leave theano computing test values
+    x.tag.test_value = np.zeros(2, dtype='float32')
+    return [x], tt.sum(tt.exp(x) ** 2)
+
+
+def fail(*args, **kwargs):
+    raise AssertionError('the function is built again')
+
+
+def test_compile_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, 'compile_cache', str(tmpdir))
+    monkeypatch.setattr(tensors, 'compiled_functions', dict())
+    compiled = makefn(*sum_graph(), key='test.sum').compile()
+    assert len(tmpdir.listdir()) == 1
+    # the graph and the optimized graph of a new function are only built by th.function and std_fgraph
+    monkeypatch.setattr(th, 'function', fail)
+    monkeypatch.setattr(th.compile.function_module, 'std_fgraph', fail)
+    # a second makefn of the same graph in the session shares the function, without loading and linking it again
+    assert makefn(*sum_graph(), key='test.sum').compile() is compiled
+    # the first one of the next session loads the optimized function from the cache
+    monkeypatch.setattr(tensors, 'compiled_functions', dict())
+    loaded = makefn(*sum_graph(), key='test.sum').compile()
+    x = np.arange(3, dtype='float32')
+    assert loaded is not compiled and np.isclose(loaded(x), compiled(x))
+
+
+def test_cmodule_key_versioned():
+    # Shape has empty __props__, which theano 1.0 takes as an unversioned C module, compiled in every session
+    x = tt.matrix('x', dtype='float32')
+    x.tag.test_value = np.zeros((2, 2), dtype='float32')
+    linker = th.gof.cc.CLinker().accept(th.gof.FunctionGraph([x], [x.shape]))
+    assert linker.cmodule_key()[0]